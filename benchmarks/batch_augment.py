@@ -0,0 +1,73 @@
+# Throughput of the training augmentation: the per image PIL round trip the methods used to run
+# against the batched tensor transforms of utils/batch_augment.py, on the CPU and on the GPU when there is one.
+# RandAugment on the PIL side needs the randaugment package and is skipped without it.
+#
+#   python -m benchmarks.batch_augment --batch_sizes 16 64 256 --size 32 --pipelines base cutout autoaug randaug
+
+import argparse
+import time
+
+import torch
+from torchvision import transforms
+
+from utils.augment import CIFAR10Policy, Cutout
+from utils.batch_augment import BatchAutoAugment, BatchRandAugment, batch_transform
+
+
+def build(pipeline, size):
+    # PIL pipeline and its batched counterpart, autoaug and randaug are the --batch_augment approximations
+    pil = {"base": [], "cutout": [Cutout(size=16)], "autoaug": [CIFAR10Policy()]}
+    batched = {"base": [], "cutout": [Cutout(size=16)], "autoaug": [BatchAutoAugment(CIFAR10Policy())], "randaug": [BatchRandAugment()]}
+    if pipeline == "randaug":
+        try:
+            from randaugment import RandAugment
+            pil["randaug"] = [RandAugment()]
+        except ImportError:
+            pil["randaug"] = None
+    crop = [transforms.RandomCrop(size, padding=4), transforms.RandomHorizontalFlip()]
+    pil_transform = None if pil[pipeline] is None else transforms.Compose([*crop, *pil[pipeline], transforms.ToTensor()])
+    return pil_transform, transforms.Compose([*crop, *batched[pipeline], transforms.ToTensor()])
+
+
+def timed(function, images, repeat, device):
+    function(images)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(images)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched augmentation benchmark")
+    parser.add_argument("--pipelines", type=str, nargs="*", default=["base", "cutout", "autoaug", "randaug"])
+    parser.add_argument("--batch_sizes", type=int, nargs="*", default=[16, 64, 256])
+    parser.add_argument("--size", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    devices = [torch.device("cpu")] + ([torch.device("cuda")] if torch.cuda.is_available() else [])
+    print(f"images/s on {args.size}x{args.size} uint8 images")
+    print(f"{'pipeline':>8} | {'batch':>5} | {'PIL':>9} | " + " | ".join(f"{'batched ' + d.type:>12}" for d in devices))
+    for pipeline in args.pipelines:
+        pil_transform, transform = build(pipeline, args.size)
+        batched = batch_transform(transform)
+        for batch_size in args.batch_sizes:
+            images = torch.randint(0, 256, (batch_size, 3, args.size, args.size), dtype=torch.uint8)
+            if pil_transform is None:
+                pil = "n/a"
+            else:
+                pil_time = timed(lambda x: torch.stack([pil_transform(transforms.ToPILImage()(i)) for i in x]),
+                                 images, args.repeat, devices[0])
+                pil = f"{batch_size / pil_time:.0f}"
+            rates = [batch_size / timed(batched, images.to(device), args.repeat, device) for device in devices]
+            print(f"{pipeline:>8} | {batch_size:>5} | {pil:>9} | " + " | ".join(f"{rate:>12.0f}" for rate in rates))
+
+
+if __name__ == "__main__":
+    main()
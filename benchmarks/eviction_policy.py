@@ -0,0 +1,72 @@
+# Cost of picking eviction victims in a full replay memory.
+# Compares the per sample scan the methods used to do (deepcopy of the class counts, argmax,
+# then np.random.choice or argmin over the class) against the heap backed policies of utils/memory.py.
+# Images are not written, both sides pay the same class index and score bookkeeping.
+#
+#   python -m benchmarks.eviction_policy --sizes 1000 10000 50000 --n_classes 100
+
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+
+from utils.data_loader import MemoryDataset
+
+
+def fill(size, n_classes, policy, rng):
+    memory = MemoryDataset(None, cls_list=[], memory_size=size, policy=policy)
+    for cls in range(n_classes):
+        memory.add_new_class(list(range(cls + 1)))
+    labels = torch.from_numpy(rng.randint(0, n_classes, size=size))
+    memory.store((torch.zeros(size, 1, 1, 1), labels))
+    memory.loss_decrease[:size] = rng.rand(size)
+    memory.policy.attach(memory)
+    return memory
+
+
+def scan_victims(memory, stream, by_score):
+    start = time.perf_counter()
+    for label in stream:
+        label_frequency = copy.deepcopy(memory.cls_count)
+        label_frequency[label] += 1
+        cand_idx = memory.cls_idx[np.argmax(label_frequency)]
+        if by_score:
+            idx = cand_idx[np.argmin(memory.others_loss_decrease[cand_idx])]
+        else:
+            idx = np.random.choice(cand_idx)
+        memory.assign_slot(int(idx), label, None, len(memory))
+    return time.perf_counter() - start
+
+
+def policy_victims(memory, stream):
+    start = time.perf_counter()
+    for label in stream:
+        idx = memory.policy.victim(memory, 0, label)
+        memory.assign_slot(int(idx), label, None, len(memory))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Eviction policy microbenchmark")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[1000, 5000, 20000, 50000])
+    parser.add_argument("--n_classes", type=int, default=100)
+    parser.add_argument("--n_replace", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    print(f"{'memory':>8} | {'scan random':>12} | {'heap random':>12} | {'scan score':>12} | {'heap score':>12}")
+    for size in args.sizes:
+        stream = rng.randint(0, args.n_classes, size=args.n_replace).tolist()
+        times = []
+        for policy, by_score in [("class_balanced_random", False), ("class_balanced_min_score", True)]:
+            times.append(scan_victims(fill(size, args.n_classes, policy, rng), stream, by_score))
+            times.append(policy_victims(fill(size, args.n_classes, policy, rng), stream))
+        # per sample cost in microseconds, including the class index and score bookkeeping of the replacement
+        print(f"{size:>8} | " + " | ".join(f"{t / args.n_replace * 1e6:>10.2f}us" for t in times))
+
+
+if __name__ == "__main__":
+    main()
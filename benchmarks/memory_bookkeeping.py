@@ -0,0 +1,80 @@
+# Scaling of the replay memory bookkeeping with the memory size.
+# Compares the class index of utils/memory.py against the list based bookkeeping it replaced
+# (list.remove on eviction, np.append of the importance score on insertion).
+#
+#   python -m benchmarks.memory_bookkeeping --sizes 1000 10000 50000 --n_classes 100
+
+import argparse
+import time
+
+import numpy as np
+
+from utils.memory import ClassIndex, grow
+
+
+def list_bookkeeping(labels, stream, victims):
+    cls_idx = [[] for _ in range(labels.max() + 1)]
+    scores = np.array([])
+    for idx, label in enumerate(labels):
+        cls_idx[label].append(idx)
+        scores = np.append(scores, 0)
+    slot_label = labels.copy()
+    start = time.perf_counter()
+    for label, idx in zip(stream, victims):
+        cls_idx[slot_label[idx]].remove(idx)
+        cls_idx[label].append(idx)
+        slot_label[idx] = label
+    replace_time = time.perf_counter() - start
+
+    scores = np.array([])
+    start = time.perf_counter()
+    for _ in range(len(labels)):
+        scores = np.append(scores, 0)
+    insert_time = time.perf_counter() - start
+    return replace_time, insert_time
+
+
+def class_index_bookkeeping(labels, stream, victims):
+    cls_idx = ClassIndex(len(labels))
+    for _ in range(labels.max() + 1):
+        cls_idx.add_class()
+    for idx, label in enumerate(labels):
+        cls_idx.add(idx, label)
+    start = time.perf_counter()
+    for label, idx in zip(stream, victims):
+        cls_idx.remove(idx)
+        cls_idx.add(idx, label)
+    replace_time = time.perf_counter() - start
+
+    scores = np.zeros(0)
+    start = time.perf_counter()
+    for idx in range(len(labels)):
+        scores = grow(scores, idx + 1)
+        scores[idx] = 0
+    insert_time = time.perf_counter() - start
+    return replace_time, insert_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay memory bookkeeping microbenchmark")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[1000, 5000, 20000, 50000])
+    parser.add_argument("--n_classes", type=int, default=100)
+    parser.add_argument("--n_replace", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    print(f"{'memory':>8} | {'list replace':>14} | {'index replace':>14} | {'np.append insert':>16} | {'prealloc insert':>16}")
+    for size in args.sizes:
+        labels = rng.randint(0, args.n_classes, size=size)
+        stream = rng.randint(0, args.n_classes, size=args.n_replace)
+        victims = rng.randint(0, size, size=args.n_replace)
+        list_replace, list_insert = list_bookkeeping(labels, stream, victims)
+        index_replace, index_insert = class_index_bookkeeping(labels, stream, victims)
+        # per operation cost in microseconds
+        print(f"{size:>8} | {list_replace / args.n_replace * 1e6:>12.2f}us | {index_replace / args.n_replace * 1e6:>12.2f}us | "
+              f"{list_insert / size * 1e6:>14.2f}us | {index_insert / size * 1e6:>14.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Replay samples per GB and gather throughput of the raw and encoded replay memory storages.
+# Fills a MemoryDataset with training images and times get_batch, which gathers (and decodes) a replay
+# batch and runs the usual PIL augmentation on it, next to the bare storage gather.
+# Without --data_dir, smooth synthetic images stand in for the datasets, those compress better than noise
+# but not quite like natural images, so run it on the real datasets for numbers worth quoting.
+#
+#   python -m benchmarks.memory_compression --data_dir ./data --datasets cifar10 tinyimagenet --decode_workers 1 4
+
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+
+from utils.data_loader import MemoryDataset
+
+SHAPES = {"cifar10": (3, 32, 32), "cifar100": (3, 32, 32), "tinyimagenet": (3, 64, 64)}
+
+
+def load_images(dataset, data_dir, n_samples, rng):
+    if data_dir is not None:
+        from datasets import CIFAR10, CIFAR100, TinyImageNet
+        data = {"cifar10": CIFAR10, "cifar100": CIFAR100, "tinyimagenet": TinyImageNet}[dataset](
+            root=data_dir, train=True, download=False, transform=transforms.ToTensor())
+        indices = rng.choice(len(data), size=n_samples, replace=False)
+        images = torch.stack([data[i][0] for i in indices])
+        labels = torch.tensor([data.targets[i] for i in indices])
+        return images, labels
+    # Random low resolution colour fields upsampled to full size with a little noise on top
+    c, h, w = SHAPES[dataset]
+    coarse = torch.from_numpy(rng.rand(n_samples, c, h // 8, w // 8)).float()
+    images = F.interpolate(coarse, size=(h, w), mode="bicubic", align_corners=False)
+    images = (images + 0.03 * torch.from_numpy(rng.randn(n_samples, c, h, w)).float()).clamp(0, 1)
+    return images, torch.from_numpy(rng.randint(0, 100, size=n_samples))
+
+
+def run(images, labels, storage, decode_workers, batch_size, repeat, transform):
+    memory = MemoryDataset(transform, cls_list=[], memory_size=len(images), storage=storage, decode_workers=decode_workers)
+    for label in torch.unique(labels).tolist():
+        memory.add_new_class(memory.cls_list + [label])
+    start = time.perf_counter()
+    memory.store((images, labels))
+    store_time = time.perf_counter() - start
+
+    rng = np.random.RandomState(0)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        memory.storage.read(rng.randint(0, len(memory), size=batch_size))
+    gather_time = (time.perf_counter() - start) / repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        memory.get_batch(batch_size)
+    batch_time = (time.perf_counter() - start) / repeat
+    return memory.storage.nbytes() / len(memory), store_time / len(memory), gather_time, batch_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay memory compression benchmark")
+    parser.add_argument("--datasets", type=str, nargs="*", default=["cifar10", "tinyimagenet"])
+    parser.add_argument("--data_dir", type=str, default=None)
+    parser.add_argument("--storages", type=str, nargs="*", default=["ram", "png", "jpeg"])
+    parser.add_argument("--decode_workers", type=int, nargs="*", default=[1, 4])
+    parser.add_argument("--n_samples", type=int, default=5000)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    for dataset in args.datasets:
+        images, labels = load_images(dataset, args.data_dir, args.n_samples, rng)
+        size = SHAPES[dataset][1]
+        transform = transforms.Compose([transforms.RandomCrop(size, padding=4), transforms.RandomHorizontalFlip(),
+                                        transforms.ToTensor()])
+        print(f"{dataset}{'' if args.data_dir else ' (synthetic)'}, {args.n_samples} samples, batches of {args.batch_size}")
+        print(f"{'storage':>8} | {'workers':>7} | {'bytes/sample':>12} | {'samples/GB':>10} | {'store':>9} | "
+              f"{'gather':>8} | {'get_batch':>9}")
+        for storage in args.storages:
+            for workers in (args.decode_workers if storage in ("png", "jpeg") else [0]):
+                nbytes, store, gather, batch = run(images, labels, storage, workers, args.batch_size, args.repeat, transform)
+                print(f"{storage:>8} | {workers:>7} | {nbytes:>12.0f} | {2 ** 30 / nbytes:>10.0f} | {store * 1e6:>7.1f}us | "
+                      f"{gather * 1e3:>6.2f}ms | {batch * 1e3:>7.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
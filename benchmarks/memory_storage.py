@@ -0,0 +1,85 @@
+# Resident memory and batch gather latency of the replay memory storages of utils/memory.py.
+# Every backend runs in a fresh process, which fills a memory with random uint8 images and then
+# gathers random replay batches from it. Anonymous RSS is what the process really holds,
+# file backed RSS is page cache that the kernel can drop under pressure.
+#
+#   python -m benchmarks.memory_storage --n_samples 20000 --shape 3 224 224 --memory_dir /local/scratch
+
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+import torch
+
+from utils.memory import select_storage
+
+
+def rss():
+    # Anonymous and file backed resident memory of this process in MB (Linux only)
+    usage = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(("RssAnon", "RssFile")):
+                name, value, _ = line.split()
+                usage[name[:-1]] = int(value) / 1024
+    return usage.get("RssAnon", float("nan")), usage.get("RssFile", float("nan"))
+
+
+def run(backend, args, queue):
+    rng = np.random.RandomState(args.seed)
+    storage = select_storage(backend, args.n_samples, args.memory_dir, args.cache_size)
+    base_anon, base_file = rss()
+    chunk = 256
+    start = time.perf_counter()
+    for begin in range(0, args.n_samples, chunk):
+        n = min(chunk, args.n_samples - begin)
+        images = torch.from_numpy(rng.randint(0, 256, size=(n, *args.shape), dtype=np.uint8))
+        storage.write_batch(begin + np.arange(n), images, rng.randint(0, 100, size=n))
+    fill_time = time.perf_counter() - start
+    fill_anon, fill_file = rss()
+
+    latency = {}
+    for batch_size in args.batch_sizes:
+        for _ in range(args.warmup):
+            storage.read(rng.randint(0, args.n_samples, size=batch_size))
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            storage.read(rng.randint(0, args.n_samples, size=batch_size))
+        latency[batch_size] = (time.perf_counter() - start) / args.repeat
+    gather_anon, gather_file = rss()
+    queue.put((backend, fill_time, fill_anon - base_anon, fill_file - base_file,
+               gather_anon - base_anon, gather_file - base_file, latency))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay memory storage benchmark")
+    parser.add_argument("--backends", type=str, nargs="*", default=["ram", "disk"])
+    parser.add_argument("--n_samples", type=int, default=20000)
+    parser.add_argument("--shape", type=int, nargs=3, default=[3, 64, 64])
+    parser.add_argument("--batch_sizes", type=int, nargs="*", default=[16, 64, 256])
+    parser.add_argument("--memory_dir", type=str, default=None)
+    parser.add_argument("--cache_size", type=int, default=512)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    size = args.n_samples * int(np.prod(args.shape)) / 2 ** 20
+    print(f"{args.n_samples} samples of {tuple(args.shape)}, {size:.0f}MB of uint8 images")
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{'backend':>8} | {'fill':>8} | {'anon RSS':>10} | {'file RSS':>10} | "
+          + " | ".join(f"{'gather ' + str(b):>11}" for b in args.batch_sizes) + f" | {'anon after':>10} | {'file after':>10}")
+    for backend in args.backends:
+        queue = ctx.Queue()
+        process = ctx.Process(target=run, args=(backend, args, queue))
+        process.start()
+        backend, fill_time, fill_anon, fill_file, gather_anon, gather_file, latency = queue.get()
+        process.join()
+        print(f"{backend:>8} | {fill_time:>7.2f}s | {fill_anon:>8.0f}MB | {fill_file:>8.0f}MB | "
+              + " | ".join(f"{latency[b] * 1e3:>9.2f}ms" for b in args.batch_sizes)
+              + f" | {gather_anon:>8.0f}MB | {gather_file:>8.0f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# End to end throughput of the methods on a synthetic i-Blurry stream of --samples samples, for picking a method
+# under a compute budget. Each method runs as main.py runs it (its _Trainer or the loop of main.py) in a process of its own,
+# with the stream split by OnlineSampler over the images of --dataset synthetic, one of the small
+# models in models/ and the phase profiler on. Reported per method: training samples/s (evaluation left out),
+# the median and tail latency of online_step, the time spent evaluating and the peak resident memory of its
+# process (and of the device on CUDA). A method that fails to build, to run or to finish within --timeout is
+# listed with its error.
+# The first online_step of a method pays for its warm-up and is left out of the latency percentiles, which are only
+# given over at least MIN_STEPS steps. Every method makes online_iter * batchsize updates per stream batch, several
+# seconds with resnet18 on a CPU, so without CUDA the methods run mlp400 on 28x28 images by default and still go
+# through all --samples of the stream. The memory retraining of gdumb and rm runs --memory_epoch epochs.
+#
+#   python -m benchmarks.method_throughput --methods er clib rm --samples 2000 --model_name resnet18
+#   python -m benchmarks.method_throughput --image_size 28 --model_name mlp400 --output methods.json
+
+import argparse
+import contextlib
+import json
+import os
+import queue
+import resource
+import sys
+import tempfile
+import time
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from configuration import config
+from main import run
+from utils.method_manager import METHODS
+
+
+# online_step latencies a percentile needs, the first step is not one of them
+MIN_STEPS = 20
+
+# Methods built around a ViT, run with their model whatever --model_name says
+METHOD_MODELS = {"L2P": "L2P", "ViT_LP": "vit", "ViT_FT": "vit", "clib_vit": "vit"}
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) >= MIN_STEPS else float("nan")
+
+
+def run_method(name, options, results):
+    # Runs in a process of its own, so imports, memory and the peak RSS are per method
+    log_path = tempfile.mkdtemp(prefix=f"method_throughput_{name}_")
+    model_name = METHOD_MODELS.get(name, options["model_name"])
+    image_size = 224 if model_name in ("vit", "L2P") else options["image_size"]
+    argv = ["--mode", name, "--dataset", "synthetic", "--rnd_seed", str(options["seed"]), "--model_name", model_name,
+            "--synthetic_classes", str(options["classes"]), "--synthetic_samples", str(options["samples"]),
+            "--synthetic_test_samples", str(options["test_samples"]), "--synthetic_size", str(image_size),
+            "--n_tasks", str(options["n_tasks"]), "--n", str(options["n"]), "--m", str(options["m"]),
+            "--memory_size", str(options["memory_size"]), "--batchsize", str(options["batchsize"]),
+            "--online_iter", str(options["online_iter"]), "--memory_epoch", str(options["memory_epoch"]),
+            "--eval_period", str(options["eval_period"]),
+            "--log_path", log_path, "--note", "bench", "--profile", "--profile_trace", f"{log_path}/trace.json"]
+    if options["max_steps"] is not None:
+        argv += ["--max_steps", str(options["max_steps"])]
+    # Some method modules parse the command line when imported, they get the arguments of the run
+    sys.argv = sys.argv[:1] + argv
+    try:
+        args = config.base_parser(argv)
+        with open(f"{log_path}/stdout.log", "w") as log, contextlib.redirect_stdout(log):
+            trainer = run(args)
+    except (Exception, SystemExit):
+        results.put({"method": name, "error": traceback.format_exc().strip().splitlines()[-1], "log": log_path})
+        return
+
+    profiler = trainer.profiler
+    steps = [event["dur"] / 1e3 for event in profiler.trace if event["name"] == "online_step"][1:]
+    evaluations = [event["dur"] / 1e3 for event in profiler.trace if event["name"] == "evaluation"]
+    wall = sum(task["wall"] for task in profiler.tasks)
+    samples = sum(task["samples"] for task in profiler.tasks)
+    results.put({
+        "method": name, "model": args.model_name, "samples": samples, "wall": wall,
+        "samples_per_sec": samples / max(wall - sum(evaluations) / 1e3, 1e-9),
+        "steps": len(steps),
+        "step_ms_p50": percentile(steps, 50), "step_ms_p90": percentile(steps, 90), "step_ms_p99": percentile(steps, 99),
+        "eval_count": len(evaluations), "eval_ms_mean": float(np.mean(evaluations)) if evaluations else float("nan"),
+        "eval_share": sum(evaluations) / 1e3 / max(wall, 1e-9),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+        "peak_device_mb": max(task["peak_memory"] for task in profiler.tasks) if trainer.device.type == "cuda" else None,
+        "log": log_path,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end method throughput benchmark")
+    parser.add_argument("--methods", type=str, nargs="*", default=list(METHODS), choices=list(METHODS))
+    parser.add_argument("--classes", type=int, default=10)
+    parser.add_argument("--image_size", type=int, default=None,
+                        help="28 for the mlp models and 32 for the others by default, the ViT methods always use 224")
+    parser.add_argument("--model_name", type=str, default=None,
+                        help="resnet18 by default, mlp400 without CUDA, the ViT methods always use theirs")
+    parser.add_argument("--samples", type=int, default=2000, help="stream samples over all tasks")
+    parser.add_argument("--test_samples", type=int, default=500)
+    parser.add_argument("--eval_period", type=int, default=500)
+    parser.add_argument("--n_tasks", type=int, default=5)
+    parser.add_argument("--max_steps", type=int, default=None, help="stream batches trained on per task, all of them by default")
+    parser.add_argument("--n", type=int, default=50)
+    parser.add_argument("--m", type=int, default=10)
+    parser.add_argument("--memory_size", type=int, default=500)
+    parser.add_argument("--batchsize", type=int, default=16)
+    parser.add_argument("--online_iter", type=float, default=1)
+    parser.add_argument("--memory_epoch", type=int, default=1, help="epochs of the memory retraining of gdumb and rm")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds a method may run before it is stopped")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+    if args.model_name is None:
+        args.model_name = "resnet18" if torch.cuda.is_available() else "mlp400"
+        print(f"Running the methods with {args.model_name}", flush=True)
+    if args.image_size is None:
+        args.image_size = 28 if args.model_name.startswith("mlp") else 32
+    steps = -(-args.samples // args.batchsize)
+    if args.max_steps is not None:
+        steps = min(steps, args.max_steps * args.n_tasks)
+    if steps - 1 < MIN_STEPS:
+        print(f"About {steps} stream batches per method, the step latency percentiles need {MIN_STEPS + 1}", flush=True)
+
+    ctx = mp.get_context("spawn")
+    rows = []
+    print(f"{'method':>8} | {'model':>8} | {'samples/s':>9} | {'p50 ms':>8} | {'p90 ms':>8} | {'p99 ms':>8} | "
+          f"{'evals':>5} | {'eval ms':>8} | {'eval %':>6} | {'RSS MB':>7}", flush=True)
+    for name in args.methods:
+        results = ctx.Queue()
+        process = ctx.Process(target=run_method, args=(name, vars(args), results))
+        process.start()
+        # Polled, a method that dies without a result is noticed right away and one that hangs is stopped
+        row, deadline = None, time.monotonic() + args.timeout
+        while row is None and time.monotonic() < deadline:
+            try:
+                row = results.get(timeout=1)
+            except queue.Empty:
+                if not process.is_alive():
+                    # Its result may have arrived right before it exited
+                    row = results.get(timeout=1) if not results.empty() else \
+                        {"method": name, "error": f"exited with code {process.exitcode}"}
+        if row is None:
+            row = {"method": name, "error": f"timed out after {args.timeout:.0f}s"}
+            process.terminate()
+        process.join()
+        rows.append(row)
+        if "error" in row:
+            print(f"{name:>8} | failed: {row['error']}", flush=True)
+            continue
+        print(f"{name:>8} | {row['model']:>8} | {row['samples_per_sec']:>9.1f} | {row['step_ms_p50']:>8.1f} | "
+              f"{row['step_ms_p90']:>8.1f} | {row['step_ms_p99']:>8.1f} | {row['eval_count']:>5} | "
+              f"{row['eval_ms_mean']:>8.1f} | {100 * row['eval_share']:>5.1f}% | {row['peak_rss_mb']:>7.0f}", flush=True)
+
+    if args.output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({"settings": vars(args), "results": rows}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Training steps per second with the replay batch gathered and augmented on the training thread
+# against batches prepared ahead by the worker processes of utils/prefetch.py.
+# The forward and backward pass is stood in for by a sleep of --compute_ms, which is the time the
+# workers have to hide the gather and augmentation behind. Every step also writes a stream batch into
+# the memory, so the prefetched batches pay for re-gathering the slots rewritten since their request.
+# The overlap needs spare cores, on a single core machine the prefetched run can only be slower.
+#
+#   python -m benchmarks.replay_prefetch --storages ram png --workers 1 2 4 --compute_ms 20
+
+import argparse
+import time
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+
+from utils.data_loader import MemoryDataset
+
+
+def run(images, labels, storage, workers, args, transform):
+    memory = MemoryDataset(transform, cls_list=[], memory_size=len(images), storage=storage)
+    for label in torch.unique(labels).tolist():
+        memory.add_new_class(memory.cls_list + [label])
+    memory.store((images, labels))
+    if workers > 0:
+        memory.enable_prefetch(workers, args.depth)
+
+    rng = np.random.RandomState(args.seed)
+    stream = torch.from_numpy(rng.randint(0, 256, size=(args.stream_batchsize, *images.shape[1:]), dtype=np.uint8))
+    for step in range(args.warmup + args.steps):
+        if step == args.warmup:
+            start = time.perf_counter()
+        memory.get_batch(args.batch_size)
+        slots = rng.randint(0, len(memory), size=args.stream_batchsize)
+        memory.storage.write_batch(slots, stream, labels[slots].numpy())
+        time.sleep(args.compute_ms / 1e3)
+    elapsed = time.perf_counter() - start
+    if memory.prefetcher is not None:
+        memory.prefetcher.close()
+    return args.steps / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay prefetch benchmark")
+    parser.add_argument("--storages", type=str, nargs="*", default=["ram", "png"])
+    parser.add_argument("--workers", type=int, nargs="*", default=[1, 2])
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--n_samples", type=int, default=2000)
+    parser.add_argument("--shape", type=int, nargs=3, default=[3, 32, 32])
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--stream_batchsize", type=int, default=16)
+    parser.add_argument("--compute_ms", type=float, default=20)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    images = torch.from_numpy(rng.rand(args.n_samples, *args.shape)).float()
+    labels = torch.from_numpy(rng.randint(0, 100, size=args.n_samples))
+    size = args.shape[1]
+    transform = transforms.Compose([transforms.RandomCrop(size, padding=4), transforms.RandomHorizontalFlip(),
+                                    transforms.ToTensor()])
+    print(f"{args.n_samples} samples of {tuple(args.shape)}, batches of {args.batch_size}, "
+          f"{args.compute_ms:.0f}ms of compute per step")
+    print(f"{'storage':>8} | {'workers':>7} | {'steps/s':>8} | {'speedup':>7}")
+    for storage in args.storages:
+        baseline = None
+        for workers in [0] + args.workers:
+            steps = run(images, labels, storage, workers, args, transform)
+            baseline = baseline or steps
+            print(f"{storage:>8} | {workers:>7} | {steps:>8.1f} | {steps / baseline:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# Regression suite for the hot paths: the OnlineSampler split, the replay memory, the augmentation policies,
+# prompt selection and the evaluation loop. Everything runs on the CPU on synthetic data, at the sizes of --scale.
+# Every case reports the median time of a call over --repeat calls and is written to --output as JSON.
+# With --baseline the run is compared case by case against an earlier output, and the suite exits with 1
+# when a case is more than --tolerance slower, so a baseline kept from a known good commit catches regressions.
+#
+#   python -m benchmarks.suite --scale small --output baseline.json
+#   python -m benchmarks.suite --scale small --baseline baseline.json --output current.json
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import TensorDataset
+from torchvision import transforms
+
+from utils.augment import CIFAR10Policy, Cutout, ImageNetPolicy, SVHNPolicy
+from utils.batch_augment import batch_transform
+from utils.data_loader import MemoryDataset
+from utils.evaluator import TestSetCache, evaluate, test_loader
+from utils.onlinesampler import OnlineSampler, OnlineTestSampler
+
+
+SCALES = {
+    "small": {"dataset_sizes": [10000], "nm": [(50, 10), (0, 100)], "memory_sizes": [500, 2000],
+              "image_size": 32, "batch_size": 16, "pool_sizes": [10, 50], "test_size": 2000, "exposed": [10, 100]},
+    "full": {"dataset_sizes": [50000, 100000], "nm": [(50, 10), (0, 100), (100, 0)], "memory_sizes": [500, 2000, 10000],
+             "image_size": 64, "batch_size": 64, "pool_sizes": [10, 50, 200], "test_size": 10000, "exposed": [10, 100]},
+}
+N_CLASSES = 100
+
+
+class SyntheticDataset(TensorDataset):
+    # Images and labels with the classes and targets attributes the samplers read
+    def __init__(self, n_samples, image_size, n_classes, seed) -> None:
+        generator = torch.Generator().manual_seed(seed)
+        images = torch.rand(n_samples, 3, image_size, image_size, generator=generator)
+        labels = torch.arange(n_samples) % n_classes
+        super().__init__(images, labels)
+        self.classes = list(range(n_classes))
+        self.targets = labels.tolist()
+
+
+class Targets:
+    # Only the labels, the split of OnlineSampler never reads an image
+    def __init__(self, n_samples, n_classes) -> None:
+        self.classes = list(range(n_classes))
+        self.targets = (np.arange(n_samples) % n_classes).tolist()
+
+
+def sampler_cases(scale, rng):
+    for size in scale["dataset_sizes"]:
+        data = Targets(size, N_CLASSES)
+        for n, m in scale["nm"]:
+            def build(data=data, n=n, m=m):
+                # The sampler prints its split, kept out of the table
+                with contextlib.redirect_stdout(io.StringIO()):
+                    return OnlineSampler(data, 5, m, n, 1)
+            yield f"sampler/build/size{size}_n{n}_m{m}", build, size
+
+
+def memory_cases(scale, rng):
+    size = scale["image_size"]
+    transform = transforms.Compose([transforms.RandomCrop(size, padding=4), transforms.RandomHorizontalFlip(),
+                                    transforms.ToTensor()])
+    for memory_size in scale["memory_sizes"]:
+        memory = MemoryDataset(transform, cls_list=[], memory_size=memory_size)
+        for cls in range(N_CLASSES):
+            memory.add_new_class(memory.cls_list + [cls])
+        images = torch.from_numpy(rng.randint(0, 256, size=(memory_size, 3, size, size), dtype=np.uint8))
+        memory.store((images, torch.from_numpy(rng.randint(0, N_CLASSES, size=memory_size))))
+        image = images[0]
+
+        def replace(memory=memory, image=image):
+            memory.replace_sample((image, torch.tensor(int(rng.randint(N_CLASSES)))), int(rng.randint(len(memory))))
+
+        yield f"memory/replace_sample/size{memory_size}", replace, 1
+        yield (f"memory/get_batch/size{memory_size}_batch{scale['batch_size']}",
+               lambda memory=memory: memory.get_batch(scale["batch_size"]), scale["batch_size"])
+
+
+def augment_cases(scale, rng):
+    size = scale["image_size"]
+    images = torch.from_numpy(rng.randint(0, 256, size=(scale["batch_size"], 3, size, size), dtype=np.uint8))
+    pil_images = [transforms.ToPILImage()(image) for image in images]
+    policies = {"imagenet": ImageNetPolicy(), "cifar10": CIFAR10Policy(), "svhn": SVHNPolicy(), "cutout": Cutout(size=size // 2)}
+    for name, policy in policies.items():
+        yield f"augment/pil/{name}_size{size}", lambda policy=policy: [policy(image) for image in pil_images], len(pil_images)
+        batched = batch_transform(transforms.Compose([policy, transforms.ToTensor()]))
+        if batched is not None:
+            yield f"augment/batched/{name}_size{size}", lambda batched=batched: batched(images), len(images)
+
+
+def prompt_cases(scale, rng):
+    prompts = {}
+    from models.prompt_kearney import Prompt
+    prompts["kearney"] = lambda pool_size: Prompt(pool_size, 5, 5, 768)
+    try:
+        from models.L2P import Prompt as L2PPrompt
+        prompts["l2p"] = lambda pool_size: L2PPrompt(pool_size, 5, 5, 768)
+    except ImportError as error:
+        print(f"Skipping the L2P prompt pool: {error}")
+    query = torch.randn(scale["batch_size"], 768)
+    for name, build in prompts.items():
+        for pool_size in scale["pool_sizes"]:
+            prompt = build(pool_size).eval()
+            yield (f"prompt/forward/{name}_pool{pool_size}",
+                   lambda prompt=prompt: prompt(query), scale["batch_size"])
+
+
+def evaluation_cases(scale, rng):
+    # A linear model, so the time is the loop around it: the test set, the label map and the metrics
+    size = scale["image_size"]
+    test_set = SyntheticDataset(scale["test_size"], size, N_CLASSES, 1)
+    cache = TestSetCache(test_set, "ram")
+    sampler = OnlineTestSampler(test_set, [])
+    for n_exposed in scale["exposed"]:
+        exposed = list(range(n_exposed))
+        model = nn.Sequential(nn.Flatten(), nn.Linear(3 * size * size, n_exposed)).eval()
+        criterion = nn.CrossEntropyLoss()
+        n_samples = scale["test_size"] * n_exposed // N_CLASSES
+        for name, data in [("dataset", test_set), ("cache", cache)]:
+            def run(data=data, exposed=exposed, model=model):
+                loader = test_loader(data, sampler, exposed, 256, 0)
+                return evaluate(model, loader, exposed, criterion, 1, N_CLASSES, "cpu")
+            yield f"evaluation/{name}/exposed{n_exposed}", run, n_samples
+
+
+GROUPS = {"sampler": sampler_cases, "memory": memory_cases, "augment": augment_cases,
+          "prompt": prompt_cases, "evaluation": evaluation_cases}
+
+
+def measure(function, repeat, warmup):
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def compare(results, baseline, tolerance):
+    # Ratio of the median times to the baseline for the cases both runs have, the regressions are returned
+    regressions = []
+    print(f"\n{'case':<48} | {'baseline':>10} | {'current':>10} | {'ratio':>6}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["median"] / baseline[name]["median"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = "  <- slower"
+        print(f"{name:<48} | {baseline[name]['median'] * 1e3:>8.2f}ms | {result['median'] * 1e3:>8.2f}ms | {ratio:>5.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hot path benchmark suite")
+    parser.add_argument("--scale", type=str, default="small", choices=list(SCALES))
+    parser.add_argument("--groups", type=str, nargs="*", default=list(GROUPS), choices=list(GROUPS))
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=1, help="torch threads, fixed so runs compare")
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Slowdown over the baseline reported as a regression")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.threads)
+    rng = np.random.RandomState(args.seed)
+    scale = SCALES[args.scale]
+    results = {}
+    print(f"{'case':<48} | {'median':>10} | {'items/s':>10}")
+    for group in args.groups:
+        for name, function, n_items in GROUPS[group](scale, rng):
+            times = measure(function, args.repeat, args.warmup)
+            median = statistics.median(times)
+            results[name] = {"median": median, "min": min(times), "repeat": len(times), "items": n_items}
+            print(f"{name:<48} | {median * 1e3:>8.2f}ms | {n_items / median:>10.0f}")
+
+    if args.output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({"scale": args.scale, "threads": args.threads, "torch": torch.__version__,
+                       "python": platform.python_version(), "machine": platform.machine(),
+                       "results": results}, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["scale"] != args.scale:
+            print(f"The baseline was run at scale {baseline['scale']}, only the cases both have are compared")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} case(s) more than {args.tolerance:.0%} slower than the baseline")
+            sys.exit(1)
+        print("\nNo regression over the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 import argparse
 
 
-def base_parser():
+def base_parser(argv=None):
     parser = argparse.ArgumentParser(description="Class Incremental Learning Research")
 
     # Mode and Exp. Settings.
@@ -15,7 +15,7 @@ def base_parser():
         "--dataset",
         type=str,
         default="cifar10",
-        help="[mnist, cifar10, cifar100, imagenet]",
+        help="[mnist, cifar10, cifar100, imagenet, synthetic]",
     )
     parser.add_argument("--n_tasks", type=int, default=5, help="The number of tasks")
     parser.add_argument("--n", type=int, default=50, help="The percentage of disjoint split. Disjoint=100, Blurry=0")
@@ -25,6 +25,15 @@ def base_parser():
     parser.add_argument(
         "--memory_size", type=int, default=500, help="Episodic memory size"
     )
+    parser.add_argument("--memory_storage", type=str, default="ram", choices=["ram", "disk", "png", "jpeg"],
+                        help="how the episodic memory keeps its samples, disk uses a memory-mapped file, png and jpeg encode them")
+    parser.add_argument("--memory_dir", type=str, default=None, help="location of the disk memory, the system temp dir if not given")
+    parser.add_argument("--memory_cache_size", type=int, default=512, help="number of samples the disk memory caches in RAM")
+    parser.add_argument("--memory_decode_workers", type=int, default=4, help="number of threads coding png and jpeg memory samples")
+    parser.add_argument("--replay_workers", type=int, default=0, help="number of processes preparing replay batches ahead, disabled if 0")
+    parser.add_argument("--replay_prefetch", type=int, default=2, help="number of replay batches prepared ahead")
+    parser.add_argument("--stream_dir", type=str, default=None, help="location of the training streams packed in sampler order, read from the dataset if not given")
+    parser.add_argument("--stream_prefetch", type=int, default=2, help="number of stream batches read ahead from a packed stream")
     # Dataset
     parser.add_argument(
         "--log_path",
@@ -72,6 +81,10 @@ def base_parser():
     )
 
     parser.add_argument("--gpu_transform", action="store_true", help="perform data transform on gpu (for faster AutoAug).")
+    parser.add_argument("--batch_augment", action="store_true",
+                        help="Run autoaug and randaug as the batched operations of utils/batch_augment.py. They use the utils/augment.py "
+                             "policy tables and approximate the PIL operations, so the augmentations differ from torchvision's AutoAugment "
+                             "and the randaugment package")
 
     # Regularization
     parser.add_argument(
@@ -82,14 +95,38 @@ def base_parser():
     )
 
     parser.add_argument("--data_dir", type=str, help="location of the dataset")
+    parser.add_argument("--cache_dir", type=str, default=None, help="location of the cached task splits and dataset file lists, disabled if not given")
+    parser.add_argument("--shard_dir", type=str, default=None, help="local directory of decoded image shards of tinyimagenet, notmnist, cub200 and their gray variants, made on first use, disabled if not given")
+    parser.add_argument("--shard_image_size", type=int, default=None, help="size images are resized to in the shards, needed when the images of a dataset differ in size")
+    parser.add_argument("--synthetic_classes", type=int, default=10, help="number of classes of --dataset synthetic")
+    parser.add_argument("--synthetic_samples", type=int, default=50000, help="number of training samples of --dataset synthetic")
+    parser.add_argument("--synthetic_test_samples", type=int, default=10000, help="number of test samples of --dataset synthetic")
+    parser.add_argument("--synthetic_size", type=int, default=32, help="image size of --dataset synthetic, the mlp models need 28")
+    parser.add_argument("--synthetic_channels", type=int, default=3, choices=[1, 3], help="3 for color, 1 for gray images of --dataset synthetic")
 
     # Debug
     parser.add_argument("--debug", action="store_true", help="Turn on Debug mode")
+    parser.add_argument("--max_steps", type=int, default=None,
+                        help="Train on at most this many stream batches per task and skip the rest of its stream, for benchmarks")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time the phases of the online loop and print samples/s and peak memory per task at the end")
+    parser.add_argument("--profile_trace", type=str, default=None,
+                        help="With --profile, also write every phase as a Chrome trace (JSON) to this file")
     # Note
     parser.add_argument("--note", type=str, help="Short description of the exp")
 
     # Eval period
     parser.add_argument("--eval_period", type=int, default=100, help="evaluation period for true online setup")
+    parser.add_argument("--report_freq", type=int, default=10,
+                        help="Report the training loss and accuracy every N stream batches, and before each evaluation. "
+                             "They are read back from the device only when reported")
+    parser.add_argument("--async_eval", action="store_true",
+                        help="Evaluate snapshots of the model in a background process while training goes on")
+    parser.add_argument("--eval_snapshots", type=int, default=2,
+                        help="Maximum number of model snapshots waiting for asynchronous evaluation")
+    parser.add_argument("--test_cache", type=str, default="none", choices=["none", "ram", "disk", "auto"],
+                        help="Keep the test set, resized and as uint8, in RAM or in a file under --memory_dir, auto picks RAM up to 2GB. "
+                             "Off by default, ImageNet val takes about 7.5GB")
 
     parser.add_argument("--temp_batchsize", type=int, help="temporary batch size, for true online")
     parser.add_argument("--online_iter", type=float, default=1, help="number of model updates per samples seen.")
@@ -117,5 +154,5 @@ def base_parser():
     # MIR
     parser.add_argument('--mir_cands', type=int, default=50, help='# candidates to use for MIR')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
@@ -2,27 +2,27 @@ from typing import Callable, Optional
 
 import torch
 from torch.utils.data import Dataset, random_split
-from torchvision.datasets import ImageFolder
 from torchvision.transforms import transforms
 
+from datasets._manifest import ManifestFolder
+
 class CUB200(Dataset):
     def __init__(self, 
                  root             : str, 
                  train            : bool, 
                  transform        : Optional[Callable] = None, 
                  target_transform : Optional[Callable] = None, 
-                 download         : bool = False
+                 download         : bool = False,
+                 cache_dir        : Optional[str] = None,
                  ) -> None:
         super().__init__()
-        self.dataset = ImageFolder(root + '/CUB200-2011/images', transforms.ToTensor() if transform is None else transform, target_transform)
+        self.dataset = ManifestFolder(root + '/CUB200-2011/images', transforms.ToTensor() if transform is None else transform, target_transform, cache_dir=cache_dir)
         len_train    = int(len(self.dataset) * 0.8)
         len_val      = len(self.dataset) - len_train
         train, test  = random_split(self.dataset, [len_train, len_val], generator=torch.Generator().manual_seed(42))
         self.dataset = train if train else test
         self.classes = self.dataset.dataset.classes
-        self.targets = []
-        for i in self.dataset.indices:
-            self.targets.append(self.dataset.dataset.targets[i])
+        self.targets = self.dataset.dataset.targets[self.dataset.indices].tolist()
         pass
     
     def __getitem__(self, index):
@@ -0,0 +1,19 @@
+from typing import Callable, Optional
+
+import torchvision
+from torchvision.transforms import transforms
+
+from datasets._manifest import ManifestFolder
+
+class ImageNet(torchvision.datasets.ImageNet, ManifestFolder):
+    def __init__(self, 
+                 root             : str, 
+                 train            : bool, 
+                 transform        : Optional[Callable] = None, 
+                 target_transform : Optional[Callable] = None, 
+                 download         : bool = False,
+                 cache_dir        : Optional[str] = None,
+                 ) -> None:
+        # torchvision's ImageNet builds its split folder through ManifestFolder, which comes next in the MRO
+        super().__init__(root, split="train" if train else "val", transform=transforms.ToTensor() if transform is None else transform,
+                         target_transform=target_transform, cache_dir=cache_dir)
@@ -0,0 +1,62 @@
+# Generated images, for runs that should not need the files of a real dataset
+
+from typing import Callable, Optional
+
+import numpy as np
+from PIL import Image
+from torch.utils.data import Dataset
+
+class Synthetic(Dataset):
+    def __init__(
+        self,
+        root: str = None,
+        train: bool = True,
+        transform: Optional[Callable] = None,
+        target_transform: Optional[Callable] = None,
+        download: bool = False,
+        num_classes: int = 10,
+        num_samples: int = 50000,
+        num_test_samples: int = 10000,
+        image_size: int = 32,
+        channels: int = 3,
+        seed: int = 0,
+    ) -> None:
+        """Images made up from `seed`, with the classes/targets contract of the other datasets.
+        Every class has a coarse 4x4 color pattern of its own, and a sample is its class pattern scaled
+        up to `image_size` with uniform noise on top, so a model can learn the classes.
+        Images are generated on access, from the seed, the split and the index only, so the same
+        index gives the same image in every process and run and nothing is kept in memory.
+        `channels` is 3 (color) or 1 (gray).
+        `root` and `download` are only there to be built like the others.
+        """
+        super().__init__()
+        self.train = train
+        self.transform = transform
+        self.target_transform = target_transform
+        self.image_size = image_size
+        self.channels = channels
+        self.seed = seed
+
+        rng = np.random.default_rng((seed, int(train)))
+        num_samples = num_samples if train else num_test_samples
+        self.classes = [str(i) for i in range(num_classes)]
+        self.targets = rng.permutation(np.arange(num_samples) % num_classes).tolist()
+        self.patterns = np.random.default_rng(seed).random((num_classes, 4, 4, channels), dtype=np.float32)
+        self.upscale = np.arange(image_size) * 4 // image_size
+
+    def __getitem__(self, index):
+        label = self.targets[index]
+        rng = np.random.default_rng((self.seed, int(self.train), index))
+        pattern = self.patterns[label][self.upscale][:, self.upscale]
+        noise = rng.random((self.image_size, self.image_size, self.channels), dtype=np.float32)
+        image = ((0.6 * pattern + 0.4 * noise) * 255).astype(np.uint8)
+        # Gray images are handed out with three equal channels, like the gray* datasets
+        image = Image.fromarray(image[:, :, 0]).convert("RGB") if self.channels == 1 else Image.fromarray(image)
+        if self.transform is not None:
+            image = self.transform(image)
+        if self.target_transform is not None:
+            label = self.target_transform(label)
+        return image, label
+
+    def __len__(self):
+        return len(self.targets)
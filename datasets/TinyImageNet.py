@@ -1,40 +1,40 @@
+import os
 from typing import Callable, Optional
 
-from torchvision.datasets import ImageFolder
 import torchvision.transforms as transforms
 
-class TinyImageNet(ImageFolder):
+from datasets._manifest import ManifestFolder
+
+class TinyImageNet(ManifestFolder):
     def __init__(self, 
                  root             : str, 
                  train            : bool, 
                  transform        : Optional[Callable] = None, 
                  target_transform : Optional[Callable] = None, 
-                 download         : bool = False
+                 download         : bool = False,
+                 cache_dir        : Optional[str] = None,
                  ) -> None:
         self.path = root + '/tiny-imagenet-200/'
+        self.train = train
+        super().__init__(self.path + ("train" if train else "val"), transform=transforms.ToTensor() if transform is None else transform,
+                         target_transform=target_transform, cache_dir=cache_dir)
+
+    def find_classes(self, directory):
+        classes = []
+        with open(self.path + "wnids.txt", 'r') as f:
+            for id in f.readlines():
+                classes.append(id.split("\n")[0])
+        return classes, {clss: idx for idx, clss in enumerate(classes)}
 
-        if train:
-            super().__init__(self.path + "train", transform=transforms.ToTensor() if transform is None else transform, target_transform=target_transform)
-            self.classes = []
-            with open(self.path + "wnids.txt", 'r') as f:
-                for id in f.readlines():
-                    self.classes.append(id.split("\n")[0])
-            self.class_to_idx = {clss: idx for idx, clss in enumerate(self.classes)}
-            self.targets = []
-            for idx, (path, _) in enumerate(self.samples):
-                self.samples[idx] = (path, self.class_to_idx[path.split("/")[-3]])
-                self.targets.append(self.class_to_idx[path.split("/")[-3]])
+    def make_dataset(self, directory, class_to_idx, extensions=None, is_valid_file=None, allow_empty=False):
+        if self.train:
+            # train/<wnid>/images/*.JPEG, labelled by the wnid folder
+            return super().make_dataset(directory, class_to_idx, extensions, is_valid_file, allow_empty)
+        # val/images/*.JPEG, labelled by the annotations
+        with open(self.path + "val/val_annotations.txt", 'r') as f:
+            file_to_idx = {line.split('\t')[0] : class_to_idx[line.split('\t')[1]] for line in f.readlines()}
+        samples = super().make_dataset(directory, {"images": 0}, extensions, is_valid_file, allow_empty)
+        return [(path, file_to_idx[os.path.basename(path)]) for path, _ in samples]
 
-        else:
-            super().__init__(self.path + "val", transform=transforms.ToTensor() if transform is None else transform, target_transform=target_transform)
-            self.classes = []
-            with open(self.path + "wnids.txt", 'r') as f:
-                for id in f.readlines():
-                    self.classes.append(id.split("\n")[0])
-            self.class_to_idx = {clss: idx for idx, clss in enumerate(self.classes)}
-            self.targets = []
-            with open(self.path + "val/val_annotations.txt", 'r') as f:
-                file_to_idx = {line.split('\t')[0] : self.class_to_idx[line.split('\t')[1]] for line in f.readlines()}
-                for idx, (path, _) in enumerate(self.samples):
-                    self.samples[idx] = (path, file_to_idx[path.split("/")[-1]])
-                    self.targets.append(file_to_idx[path.split("/")[-1]])
+    def manifest_sources(self):
+        return [self.path + "wnids.txt"] + ([] if self.train else [self.path + "val/val_annotations.txt"])
@@ -1,30 +1,54 @@
+import os
 from typing import Callable, Optional
 
+import numpy as np
 import torch
-import torchvision.transforms as transforms
 from torch.utils.data import DataLoader, Dataset, Subset
 from torchvision.datasets import SVHN
 
 
 class _DatasetCopy(Dataset):
-    def __init__(self, dataset : Dataset|Subset, transform: Optional[Callable] = None) -> None:
+    def __init__(self, dataset : Dataset|Subset, transform: Optional[Callable] = None, num_workers: int = 4, path: Optional[str] = None) -> None:
+        """A copy of `dataset`, whose items are ToTensor images, kept as one preallocated uint8 tensor.
+        It is filled in a single pass by `num_workers` loader processes, each batch written in place.
+        With `path` the copy is saved to `<path>_images.npy`/`<path>_targets.npy` and memory-mapped from there next time.
+        `transform` gets the image as a float tensor in [0, 1], like ToTensor hands it out, there is no PIL image in between.
+        """
         super().__init__()
-        dl = DataLoader(dataset, 256, shuffle=False, num_workers=4)
-        for n, (data, target) in enumerate(dl):
-            if n == 0:
-                self.data    = data
-                self.targets = target
-                continue
-            self.data = torch.concat((self.data, data), dim = 0)
-            self.targets = torch.concat((self.targets, target), dim = 0)
+        if path is not None and os.path.exists(path + "_targets.npy"):
+            self.data    = torch.from_numpy(np.load(path + "_images.npy", mmap_mode='c'))
+            self.targets = torch.from_numpy(np.load(path + "_targets.npy"))
+        else:
+            image, _ = dataset[0]
+            self.data    = torch.empty((len(dataset), *image.shape), dtype=torch.uint8)
+            self.targets = torch.empty(len(dataset), dtype=torch.long)
+            begin = 0
+            for data, target in DataLoader(dataset, 256, shuffle=False, num_workers=num_workers):
+                # The same conversion ToPILImage did on every access before
+                self.data[begin:begin + len(data)] = data.mul(255).byte()
+                self.targets[begin:begin + len(data)] = target
+                begin += len(data)
+            if path is not None:
+                self.save(path)
         if isinstance(dataset, Subset) : self.classes = dataset.dataset.classes
         elif isinstance(dataset, SVHN) : self.classes = [i for i in range(10)]
         else:                            self.classes = dataset.classes
         self.transform = transform
 
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Private file and rename like the other caches, the targets go last since they mark a finished copy
+        for suffix, array in (("_images.npy", self.data), ("_targets.npy", self.targets)):
+            tmp_path = f"{path}{suffix}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array.numpy())
+            os.replace(tmp_path, path + suffix)
+
     def __getitem__(self, index):
-        t = transforms.ToPILImage()
-        return self.transform(t(self.data[index])), self.targets[index]
+        image = self.data[index].float().div_(255)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[index]
 
     def __len__(self):
-        return len(self.data)
\ No newline at end of file
+        return len(self.data)
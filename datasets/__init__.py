@@ -1,35 +1,90 @@
-from .CUB200 import CUB200
-from .multiDatasets import multiDatasets
-from .Flowers102 import Flowers102
-from .NotMNIST import NotMNIST
-from .SVHN import SVHN
-from .TinyImageNet import TinyImageNet
-from .grayCUB200 import grayCUB200
-from .grayFlowers102 import grayFlowers102
-from .graySVHN import graySVHN
-from .grayTinyImageNet import grayTinyImageNet
-from .grayCIFAR10 import grayCIFAR10
-from .grayCIFAR100 import grayCIFAR100
-from .MNIST import MNIST
-from .FashionMNIST import FashionMNIST
-from torchvision.datasets import CIFAR10, CIFAR100, ImageNet
-
-__all__ = [
-    "CUB200",
-    "multiDatasets",
-    "Flowers102",
-    "NotMNIST",
-    "SVHN",
-    "TinyImageNet",
-    "CIFAR10",
-    "CIFAR100",
-    "MNIST",
-    "FashionMNIST",
-    "ImageNet",
-    "grayCUB200",
-    "grayFlowers102",
-    "graySVHN",
-    "grayTinyImageNet",
-    "grayCIFAR10",
-    "grayCIFAR100",
-]
\ No newline at end of file
+import hashlib
+import importlib
+import os
+
+from utils.registry import Registry
+
+# Class name -> module, imported on first access, so importing the package does not import every dataset
+_CLASSES = {
+    "CUB200": ".CUB200",
+    "multiDatasets": ".multiDatasets",
+    "Flowers102": ".Flowers102",
+    "NotMNIST": ".NotMNIST",
+    "SVHN": ".SVHN",
+    "TinyImageNet": ".TinyImageNet",
+    "grayCUB200": ".grayCUB200",
+    "grayFlowers102": ".grayFlowers102",
+    "graySVHN": ".graySVHN",
+    "grayTinyImageNet": ".grayTinyImageNet",
+    "grayCIFAR10": ".grayCIFAR10",
+    "grayCIFAR100": ".grayCIFAR100",
+    "MNIST": ".MNIST",
+    "FashionMNIST": ".FashionMNIST",
+    "Synthetic": ".Synthetic",
+    "CIFAR10": "torchvision.datasets",
+    "CIFAR100": "torchvision.datasets",
+    "ImageNet": ".ImageNet",
+}
+
+# --dataset name -> class
+DATASETS = Registry("dataset", {
+    "cifar10": "torchvision.datasets:CIFAR10",
+    "cifar100": "torchvision.datasets:CIFAR100",
+    "svhn": "datasets:SVHN",
+    "fashionmnist": "datasets:FashionMNIST",
+    "mnist": "datasets:MNIST",
+    "tinyimagenet": "datasets:TinyImageNet",
+    "notmnist": "datasets:NotMNIST",
+    "cub200": "datasets:CUB200",
+    "imagenet": "datasets:ImageNet",
+    "synthetic": "datasets:Synthetic",
+    "graytinyimagenet": "datasets:grayTinyImageNet",
+    "graycub200": "datasets:grayCUB200",
+})
+
+# Image folders whose file list is kept under --cache_dir, see datasets/_manifest.py
+MANIFEST_DATASETS = {"tinyimagenet", "notmnist", "cub200", "imagenet", "graytinyimagenet", "graycub200"}
+# Encoded image datasets that can be decoded once into --shard_dir, see datasets/_shards.py.
+# The gray variants read the shards of their color dataset and take the channel mean after the transform
+SHARD_DATASETS = {"tinyimagenet", "notmnist", "cub200", "graytinyimagenet", "graycub200"}
+SHARD_COLOR = {"graytinyimagenet": "tinyimagenet", "graycub200": "cub200"}
+# Datasets whose images differ in size, their shards need --shard_image_size
+SHARD_RESIZE = {"cub200", "graycub200"}
+
+
+def load_dataset(options, train, transform):
+    # options has the dataset, data_dir, cache_dir, shard_dir, rnd_seed and synthetic_* arguments, the parsed args or a trainer
+    if options.dataset == "synthetic":
+        return DATASETS.get("synthetic")(options.data_dir, train, transform, num_classes=options.synthetic_classes,
+                                         num_samples=options.synthetic_samples, num_test_samples=options.synthetic_test_samples,
+                                         image_size=options.synthetic_size, channels=options.synthetic_channels,
+                                         seed=options.rnd_seed or 0)
+    kwargs = {}
+    if options.dataset in MANIFEST_DATASETS:
+        kwargs["cache_dir"] = options.cache_dir
+    if options.shard_dir is not None and options.dataset in SHARD_DATASETS:
+        from datasets._shards import Shards, ToArray
+        size = options.shard_image_size
+        if size is None and options.dataset in SHARD_RESIZE:
+            raise ValueError(f"The images of {options.dataset} differ in size, give their size in the shards with --shard_image_size")
+        color = SHARD_COLOR.get(options.dataset, options.dataset)
+        # One directory per data tree, split and size
+        root = hashlib.sha1(os.path.abspath(options.data_dir).encode()).hexdigest()[:12]
+        path = os.path.join(options.shard_dir, f"{color}_{root}_{'train' if train else 'test'}" + (f"_{size}" if size else ""))
+        if not os.path.exists(os.path.join(path, "index.json")):
+            images = DATASETS.get(color)(root=options.data_dir, train=train, download=True, transform=ToArray(size), **kwargs)
+            Shards.convert(images, path, num_workers=options.n_worker)
+        return Shards(path, transform, gray=color != options.dataset)
+    return DATASETS.get(options.dataset)(root=options.data_dir, train=train, download=True, transform=transform, **kwargs)
+
+
+def __getattr__(name):
+    if name not in _CLASSES:
+        raise AttributeError(f"module {__name__} has no attribute {name}")
+    # Importing a submodule binds it to its name here, the class takes that name back
+    cls = getattr(importlib.import_module(_CLASSES[name], __name__), name)
+    globals()[name] = cls
+    return cls
+
+
+__all__ = list(_CLASSES)
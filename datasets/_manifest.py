@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+from typing import Callable, Optional
+
+import numpy as np
+from torchvision.datasets import ImageFolder, VisionDataset
+from torchvision.datasets.folder import IMG_EXTENSIONS, default_loader
+
+
+def folder_stamp(directory, leaves, *files):
+    # Cheap validity check of a manifest, adding or removing a file changes the mtime of the directory holding it.
+    # The directory, its immediate subdirectories (new classes) and the `leaves` holding the files are looked at,
+    # not the files themselves
+    stamps = [os.stat(directory).st_mtime_ns]
+    with os.scandir(directory) as it:
+        stamps.extend(entry.stat().st_mtime_ns for entry in it if entry.is_dir())
+    for leaf in leaves:
+        try:
+            stamps.append(os.stat(os.path.join(directory, leaf)).st_mtime_ns)
+        except FileNotFoundError:
+            return None
+    stamps.extend(os.stat(file).st_mtime_ns for file in files)
+    return np.array([len(stamps), max(stamps)], dtype=np.int64)
+
+
+class Manifest:
+    def __init__(self, root, paths, offsets, labels) -> None:
+        """(path, label) list of an image folder, compact enough to be saved once and memory-mapped on later runs.
+        Paths are relative to `root`, utf-8 encoded back to back in `paths`, the i-th one is paths[offsets[i]:offsets[i + 1]].
+        Paths are only decoded when a sample is asked for, `labels` is an int64 array usable as the targets.
+        """
+        self.root = root
+        self.paths = paths
+        self.offsets = offsets
+        self.labels = labels
+
+    @classmethod
+    def from_samples(cls, root, samples):
+        # Paths outside of root stay absolute, joining them to root gives them back unchanged
+        prefix = os.path.join(root, "")
+        encoded = [(path[len(prefix):] if path.startswith(prefix) else path).encode() for path, _ in samples]
+        offsets = np.cumsum([0] + [len(path) for path in encoded], dtype=np.int64)
+        paths = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        labels = np.array([label for _, label in samples], dtype=np.int64)
+        return cls(root, paths, offsets, labels)
+
+    def path(self, index):
+        # Path of a sample as stored, relative to root unless it is outside of it
+        return self.paths[self.offsets[index]:self.offsets[index + 1]].tobytes().decode()
+
+    def leaves(self):
+        # Directories the files are in, relative to root
+        return sorted({os.path.dirname(self.path(index)) for index in range(len(self))})
+
+    @classmethod
+    def load(cls, root, cache_path, sources):
+        if not os.path.exists(cache_path + "_stamp.npy"):
+            return None
+        with open(cache_path + "_leaves.json", "r") as f:
+            stamp = folder_stamp(root, json.load(f), *sources)
+        if stamp is None or not np.array_equal(np.load(cache_path + "_stamp.npy"), stamp):
+            return None
+        # Copy-on-write maps, the arrays are writable like the lists they replace but nothing is read up front
+        return cls(root, *(np.load(cache_path + suffix, mmap_mode='c') for suffix in ("_paths.npy", "_offsets.npy", "_labels.npy")))
+
+    def save(self, cache_path, sources):
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        leaves = self.leaves()
+        stamp = folder_stamp(self.root, leaves, *sources)
+        tmp_path = f"{cache_path}_leaves.json.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(leaves, f)
+        os.replace(tmp_path, cache_path + "_leaves.json")
+        # Same as the task splits, every file is written to a private file and renamed so that processes racing
+        # on the same folder never read a partial file. The stamp goes last, a manifest only counts once it exists
+        for suffix, array in (("_paths.npy", self.paths), ("_offsets.npy", self.offsets),
+                              ("_labels.npy", self.labels), ("_stamp.npy", stamp)):
+            tmp_path = f"{cache_path}{suffix}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, cache_path + suffix)
+
+    def __getitem__(self, index):
+        return os.path.join(self.root, self.path(index)), int(self.labels[index])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class ManifestFolder(ImageFolder):
+    def __init__(self,
+                 root             : str,
+                 transform        : Optional[Callable] = None,
+                 target_transform : Optional[Callable] = None,
+                 loader           : Callable = default_loader,
+                 is_valid_file    : Optional[Callable] = None,
+                 allow_empty      : bool = False,
+                 cache_dir        : Optional[str] = None,
+                 ) -> None:
+        """ImageFolder that walks its directory tree once and keeps the result as a Manifest under `cache_dir`.
+        Later constructions, in later runs or other ranks, only check the mtimes of the folders and map the saved arrays.
+        Subclasses relabel samples in `make_dataset` and list the files their labels come from in `manifest_sources`.
+        """
+        VisionDataset.__init__(self, root, transform=transform, target_transform=target_transform)
+        self.classes, self.class_to_idx = self.find_classes(self.root)
+        extensions = IMG_EXTENSIONS if is_valid_file is None else None
+
+        manifest = None
+        if cache_dir is not None:
+            key = hashlib.sha1(os.path.abspath(self.root).encode()).hexdigest()[:16]
+            cache_path = os.path.join(cache_dir, "manifests", f"{type(self).__name__.lower()}_{key}")
+            manifest = Manifest.load(self.root, cache_path, self.manifest_sources())
+        if manifest is None:
+            samples = self.make_dataset(self.root, self.class_to_idx, extensions, is_valid_file, allow_empty)
+            manifest = Manifest.from_samples(self.root, samples)
+            if cache_dir is not None:
+                manifest.save(cache_path, self.manifest_sources())
+
+        self.loader = loader
+        self.extensions = extensions
+        self.samples = self.imgs = manifest
+        self.targets = manifest.labels
+
+    def manifest_sources(self):
+        return []
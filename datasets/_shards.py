@@ -0,0 +1,109 @@
+import json
+import os
+import shutil
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+
+class ToArray:
+    def __init__(self, image_size: Optional[int] = None) -> None:
+        """Decoded image as a HxWx3 uint8 array, resized to image_size x image_size if given"""
+        self.image_size = image_size
+
+    def __call__(self, image):
+        image = image.convert("RGB")
+        if self.image_size is not None and image.size != (self.image_size, self.image_size):
+            image = image.resize((self.image_size, self.image_size), Image.BILINEAR)
+        return np.asarray(image, dtype=np.uint8)
+
+
+def stack_images(batch):
+    images, labels = zip(*batch)
+    shapes = {image.shape for image in images}
+    if len(shapes) > 1:
+        raise ValueError(f"Images of different sizes {sorted(shapes)} cannot be sharded, resize them with ToArray(image_size)")
+    return torch.from_numpy(np.stack(images)), torch.as_tensor(labels)
+
+
+class Shards(Dataset):
+    def __init__(self,
+                 path             : str,
+                 transform        : Optional[Callable] = None,
+                 target_transform : Optional[Callable] = None,
+                 gray             : bool = False,
+                 ) -> None:
+        """A dataset split decoded once into uint8 array shards of `shard_length` images under `path`, see `convert`.
+        Shards are memory-mapped, reading a sample is a slice of the page cache and nothing is decoded anymore.
+        `gray` converts the transformed images the way the gray* datasets do.
+        """
+        super().__init__()
+        with open(os.path.join(path, "index.json"), "r") as f:
+            index = json.load(f)
+        self.path = path
+        self.classes = index["classes"]
+        self.shard_length = index["shard_length"]
+        self.targets = np.load(os.path.join(path, "targets.npy"), mmap_mode='c')
+        self.transform = transform
+        self.target_transform = target_transform
+        self.gray = gray
+        # Opened on first access, so every DataLoader worker maps the files itself
+        self.shards = {}
+
+    @staticmethod
+    def convert(dataset, path, shard_length=4096, num_workers=4):
+        """Writes `dataset` (built with a ToArray transform) to `path`, skipped if it is already there.
+        Every image of a split must have the same size, ToArray(image_size) gives them one.
+        The shards are written to a private directory and renamed, processes converting the same split never see a partial one.
+        """
+        if os.path.exists(os.path.join(path, "index.json")):
+            return path
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        loader = DataLoader(dataset, shard_length, shuffle=False, num_workers=num_workers, collate_fn=stack_images)
+        targets = np.empty(len(dataset), dtype=np.int64)
+        try:
+            for n, (images, labels) in enumerate(loader):
+                np.save(os.path.join(tmp_path, f"shard_{n:05d}.npy"), images.numpy())
+                targets[n * shard_length:n * shard_length + len(labels)] = labels.numpy()
+            np.save(os.path.join(tmp_path, "targets.npy"), targets)
+            # The index is the last file, a directory without it is not a finished conversion
+            with open(os.path.join(tmp_path, "index.json"), "w") as f:
+                json.dump({"classes": list(dataset.classes), "shard_length": shard_length, "length": len(dataset)}, f)
+        except BaseException:
+            # A failed conversion leaves nothing behind, the shards can be several GB
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Another process finished the same split first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return path
+
+    def shard(self, n):
+        if n not in self.shards:
+            self.shards[n] = np.load(os.path.join(self.path, f"shard_{n:05d}.npy"), mmap_mode='r')
+        return self.shards[n]
+
+    def __getitem__(self, index):
+        image = Image.fromarray(self.shard(index // self.shard_length)[index % self.shard_length])
+        label = int(self.targets[index])
+        if self.transform is not None:
+            image = self.transform(image)
+        if self.gray:
+            image = image.mean(dim=0, keepdim=True).expand(3,-1,-1)
+        if self.target_transform is not None:
+            label = self.target_transform(label)
+        return image, label
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shards"] = {}
+        return state
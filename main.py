@@ -1,38 +1,235 @@
 import logging.config
 import os
 import random
-import pickle
 from collections import defaultdict
 
 import numpy as np
 import torch
-from randaugment import RandAugment
 from torch import nn
-from torch.utils.tensorboard import SummaryWriter
-from torch.utils.data import DataLoader, SequentialSampler
 from torchvision import transforms
 
 from configuration import config
+from methods._trainer import _Trainer
+from utils.augment import Cutout
+from utils.batch_augment import augment_transforms
+from utils.data_loader import get_statistics
+from utils.evaluator import test_loader
+from utils.method_manager import METHODS, select_method
+from utils.metric import MetricsSink
 from utils.onlinesampler import OnlineSampler, OnlineTestSampler
-from utils.augment import Cutout, select_autoaugment
-from utils.data_loader import get_test_datalist, get_statistics
-from utils.data_loader import get_train_datalist
-from utils.method_manager import select_method
-from datasets import *
+from utils.profiler import PhaseProfiler
+from utils.stream import PackedStream
+from datasets import load_dataset
 
-from sklearn.manifold import TSNE
-import matplotlib.pyplot as plt
+os.environ["CUDA_LAUNCH_BLOCKING"]="1"
+
+def run_online(args):
+    # The single process loop of the methods that are not a _Trainer, returns the method
+    logging.config.fileConfig("./configuration/logging.conf")
+    logger = logging.getLogger()
+
+    os.makedirs(f"{args.log_path}/logs/{args.dataset}/{args.note}", exist_ok=True)
+    os.makedirs(f"{args.log_path}/tensorboard/{args.dataset}/{args.note}", exist_ok=True)
+    fileHandler = logging.FileHandler(f'{args.log_path}/logs/{args.dataset}/{args.note}/seed_{args.rnd_seed}.log', mode="w")
+
+    formatter = logging.Formatter(
+        "[%(levelname)s] %(filename)s:%(lineno)d > %(message)s"
+    )
+    fileHandler.setFormatter(formatter)
+    logger.addHandler(fileHandler)
+
+    writer = MetricsSink(f'{args.log_path}/logs/{args.dataset}/{args.note}/seed_{args.rnd_seed}_metrics',
+                         f'{args.log_path}/tensorboard/{args.dataset}/{args.note}/seed_{args.rnd_seed}')
+
+    logger.info(args)
+
+    if torch.cuda.is_available():
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+        if args.gpu_transform:
+            args.gpu_transform = False
+            logger.warning("Augmentation on GPU not available!")
+    logger.info(f"Set the device ({device})")
+
+    # Fix the random seeds
+    torch.manual_seed(args.rnd_seed)
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = False
+    np.random.seed(args.rnd_seed)
+    random.seed(args.rnd_seed)
+
+    # Transform Definition
+    mean, std, n_classes, inp_size, _ = get_statistics(dataset=args.dataset)
+    if args.dataset == "synthetic":
+        n_classes, inp_size = args.synthetic_classes, args.synthetic_size
+    if args.model_name == 'vit':
+        inp_size = 224
+    train_transform = []
+    if "cutout" in args.transforms:
+        train_transform.append(Cutout(size=16))
+    train_transform.extend(augment_transforms(args.transforms, args.dataset, args.batch_augment))
+
+    train_transform = transforms.Compose(
+        [
+            transforms.Resize((inp_size, inp_size)),
+            transforms.RandomCrop(inp_size, padding=4),
+            transforms.RandomHorizontalFlip(),
+            *train_transform,
+            transforms.ToTensor(),
+            transforms.Normalize(mean, std),
+        ]
+    )
+    logger.info(f"Using train-transforms {train_transform}")
+
+    test_transform = transforms.Compose(
+        [
+            transforms.Resize((inp_size, inp_size)),
+            transforms.ToTensor(),
+            transforms.Normalize(mean, std),
+        ]
+    )
+
+    logger.info(f"[1] Select a CIL method ({args.mode})")
+    criterion = nn.CrossEntropyLoss(reduction="mean")
+    method = select_method(
+        args, criterion, device, train_transform, test_transform, n_classes, writer
+    )
+
+    logger.info(f"[2] Incrementally training {args.n_tasks} tasks")
+    task_records = defaultdict(list)
+    eval_results = defaultdict(list)
+    samples_cnt = 0
+
+    train_dataset   = load_dataset(args, train=True, transform=transforms.ToTensor())
+    test_dataset    = load_dataset(args, train=False, transform=test_transform)
+    train_sampler   = OnlineSampler(train_dataset, args.n_tasks, args.m, args.n, args.rnd_seed, 0, args.rnd_NM,
+                                    cache_dir=args.cache_dir)
+    test_sampler    = OnlineTestSampler(test_dataset, [])
+    method.total_samples = train_sampler.stream_size()
+    if args.stream_dir is not None:
+        train_stream = PackedStream(train_dataset, train_sampler, args.batchsize, args.stream_dir, args.stream_prefetch, args.n_worker)
+    method.profiler = profiler = PhaseProfiler(args.profile, device, args.profile_trace)
+
+    num_eval = args.eval_period
+    features = []
+    for cur_iter in range(args.n_tasks):
+        if args.mode == "joint" and cur_iter > 0:
+            return method
+        print("\n" + "#" * 50)
+        print(f"# Task {cur_iter} iteration")
+        print("#" * 50 + "\n")
+        logger.info("[2-1] Prepare a datalist for the current task")
+
+        train_sampler.set_task(cur_iter)
+        if args.stream_dir is not None:
+            train_dataloader = train_stream
+        else:
+            train_dataloader= torch.utils.data.DataLoader(train_dataset, batch_size=args.batchsize, sampler=train_sampler,
+                                                          num_workers=args.n_worker)
+
+        profiler.begin_task(cur_iter)
+        method.online_before_task(cur_iter)
+        for i, data in enumerate(profiler.iterate(train_dataloader, "data")):
+            if args.debug and i == 2000 : break
+            if args.max_steps is not None and i >= args.max_steps : break
+            samples_cnt += data[0].size(0)
+            profiler.add_samples(data[0].size(0))
+            with profiler.phase("online_step"):
+                method.online_step(data, samples_cnt, args.n_worker)
+            if samples_cnt > num_eval:
+                num_eval += args.eval_period
+                with profiler.phase("evaluation"):
+                    eval_dict = method.online_evaluate(test_loader(test_dataset, test_sampler, method.exposed_classes, 512, args.n_worker), samples_cnt)
+                eval_results["test_acc"].append(eval_dict['avg_acc'])
+                eval_results["avg_acc"].append(eval_dict['cls_acc'])
+                eval_results["data_cnt"].append(samples_cnt)
+        method.online_after_task(cur_iter)
+
+        with profiler.phase("evaluation"):
+            loader = test_loader(test_dataset, test_sampler, method.exposed_classes, 512, args.n_worker)
+            if args.mode == "ViT":
+                eval_dict = method.evaluation_with_feature(loader, method.criterion)
+            else:
+                eval_dict = method.evaluation(loader, method.criterion)
+        task_acc = eval_dict['avg_acc']
+        task = profiler.end_task()
+        if args.profile:
+            writer.log("profile", cur_iter, samples_per_sec=task["samples"] / task["wall"],
+                       peak_memory=task["peak_memory"], **task["time"])
+
+        if args.mode == "ViT":
+            features.append(eval_dict['embedding'])
+
+        logger.info("[2-4] Update the information for the current task")
+        task_records["task_acc"].append(task_acc)
+        task_records["cls_acc"].append(eval_dict["cls_acc"])
+
+        logger.info("[2-5] Report task result")
+        writer.log("task", cur_iter, acc=task_acc)
+
+    if args.profile:
+        print(profiler.summary())
+        profiler.close()
+
+    if args.mode == "ViT":
+        from sklearn.manifold import TSNE
+        import matplotlib.pyplot as plt
+        # Tsne visualization feature
+        for class_idx in range(n_classes):
+            class_feature = []
+            for i in range(args.n_tasks):
+                class_feature.append(features[i][class_idx])
+            class_feature = np.concatenate(class_feature, axis=0)
+            X_2d = TSNE(n_components=2).fit_transform(class_feature)
+            plt.figure(figsize=(10, 10))
+            for i in range(args.n_tasks):
+                plt.scatter(X_2d[i*1000:(i+1)*1000, 0], X_2d[i*1000:(i+1)*1000, 1])
+            plt.savefig(f'{args.log_path}/logs/{args.dataset}/{args.note}/seed_{args.rnd_seed}_tsne_{class_idx}.png')
+
+    if args.mode == 'gdumb':
+        # GDumb trains its models once the stream is over, the task results come with them
+        eval_results, task_records = method.evaluate_all(test_dataset, args.memory_epoch, args.batchsize, args.n_worker)
+    np.save(f"{args.log_path}/logs/{args.dataset}/{args.note}/seed_{args.rnd_seed}.npy", task_records["task_acc"])
+    if args.eval_period is not None:
+        np.save(f'{args.log_path}/logs/{args.dataset}/{args.note}/seed_{args.rnd_seed}_eval.npy', eval_results['test_acc'])
+        np.save(f'{args.log_path}/logs/{args.dataset}/{args.note}/seed_{args.rnd_seed}_eval_time.npy', eval_results['data_cnt'])
+
+    # Accuracy (A)
+    A_auc = np.mean(eval_results["test_acc"])
+    A_avg = np.mean(task_records["task_acc"])
+    A_last = task_records["task_acc"][args.n_tasks - 1]
+
+    # Forgetting (F)
+    cls_acc = np.array(task_records["cls_acc"])
+    acc_diff = []
+    for j in range(n_classes):
+        if np.max(cls_acc[:-1, j]) > 0:
+            acc_diff.append(np.max(cls_acc[:-1, j]) - cls_acc[-1, j])
+    F_last = np.mean(acc_diff)
+
+    logger.info(f"======== Summary =======")
+    logger.info(f"A_auc {A_auc} | A_avg {A_avg} | A_last {A_last} | F_last {F_last}")
+    writer.log("summary", samples_cnt, A_auc=A_auc, A_avg=A_avg, A_last=A_last, F_last=F_last)
+    writer.close()
+    return method
+
+
+def run(args):
+    # Runs the method of args.mode and returns it, a _Trainer or the method run by run_online
+    method = METHODS.get(args.mode)
+    if issubclass(method, _Trainer):
+        trainer = method(**vars(args))
+        trainer.run()
+        return trainer
+    return run_online(args)
 
-from methods.er_baseline import ER
 
-methods = { "er": ER }
-os.environ["CUDA_LAUNCH_BLOCKING"]="1"
 def main():
     # Get Configurations
     args = config.base_parser()
     print(args)
-    trainer = methods[args.mode](**vars(args))
-    trainer.run()
+    run(args)
 
 if __name__ == "__main__":
     main()
@@ -13,7 +13,6 @@ import torch
 import torch.nn as nn
 from torch import optim
 from torch.utils.data import DataLoader
-from torch.utils.tensorboard import SummaryWriter
 from utils.augment import Cutout, Invert, Solarize, select_autoaugment
 from torchvision import transforms
 from randaugment.randaugment import RandAugment
@@ -32,11 +31,14 @@ import pandas as pd
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
-from torch.utils.tensorboard import SummaryWriter
 from torch import optim
 
 from utils.data_loader import ImageDataset, StreamDataset, MemoryDataset, cutmix_data, get_statistics
 from utils.train_utils import select_model, select_optimizer, select_scheduler,select_optimizer_with_extern_params
+from utils.batch_augment import transform_batch
+from utils.label_map import LabelMap
+from utils.evaluator import MetricsAccumulator, interpret_pred
+from utils.metric import MetricsSink, TrainMetrics
 
 import timm
 from timm.models.registry import register_model
@@ -47,7 +49,6 @@ from models.prompt_kearney import Prompt
 
 
 logger = logging.getLogger()
-writer = SummaryWriter("tensorboard")
 
 T = TypeVar('T', bound = 'nn.Module')
 
@@ -228,14 +229,12 @@ def vit_base_patch16_224_l2p(pretrained=False, **kwargs):
 # import torch
 # import torch.nn as nn
 # from torch.utils.data import DataLoader
-# from torch.utils.tensorboard import SummaryWriter
-# from torch import optim
+# # from torch import optim
 
 # from utils.data_loader import ImageDataset, StreamDataset, MemoryDataset, cutmix_data, get_statistics
 # from utils.train_utils import select_model, select_optimizer, select_scheduler
 
 # logger = logging.getLogger()
-# writer = SummaryWriter("tensorboard")
 
 
 def cycle(iterable):
@@ -253,11 +252,19 @@ class L2P:
         self.num_learning_class = 1
         self.n_classes = n_classes
         self.exposed_classes = []
+        self.label_map = LabelMap(self.exposed_classes)
         self.seen = 0
         self.topk = kwargs["topk"]
+        self.report_freq = kwargs["report_freq"]
+        # Stream batches seen by online_step, training is reported every report_freq of them
+        self.stream_batches = 0
+        # Summed over the steps since the last report, flushed by report_training
+        self.train_metrics = TrainMetrics()
 
         self.device = device
         self.dataset = kwargs["dataset"]
+        # The run's sink from main.py, records are dropped without one
+        self.writer = kwargs.get("writer") or MetricsSink()
         self.model_name = kwargs["model_name"]
         self.opt_name = kwargs["opt_name"]
         self.sched_name = kwargs["sched_name"]
@@ -310,28 +317,32 @@ class L2P:
 
         self.criterion = criterion.to(self.device)
         self.memory = MemoryDataset(self.train_transform, cls_list=self.exposed_classes,
-                                    test_transform=self.test_transform)
+                                    test_transform=self.test_transform, memory_size=self.memory_size,
+                                    storage=kwargs["memory_storage"], storage_dir=kwargs["memory_dir"],
+                                    cache_size=kwargs["memory_cache_size"], decode_workers=kwargs["memory_decode_workers"])
+        if kwargs["replay_workers"] > 0:
+            self.memory.enable_prefetch(kwargs["replay_workers"], kwargs["replay_prefetch"])
         self.temp_batch = []
         self.num_updates = 0
         self.train_count = 0
         self.batch_size = kwargs["batchsize"]
 
         self.start_time = time.time()
-        num_samples = {'cifar10': 50000, 'cifar100': 50000, 'tinyimagenet': 100000, 'imagenet': 1281167}
-        self.total_samples = num_samples[self.dataset]
+        # Length of the training stream, main.py sets it to train_sampler.stream_size() before the first step
+        self.total_samples = None
 
     def online_step(self, sample, sample_num, n_worker):
         image, label = sample
-        for l in label:
-            if l.item() not in self.exposed_classes:
-                self.add_new_class(l.item())
+        for cls in self.label_map.unseen(label):
+            self.add_new_class(cls)
 
         self.num_updates += self.online_iter * self.batch_size
-        train_loss, train_acc = self.online_train([image, label], self.batch_size * 2, n_worker,
-                                                    iterations=int(self.num_updates), stream_batch_size=self.batch_size)
-        self.report_training(sample_num, train_loss, train_acc)
-        for stored_sample, stored_label in zip(image, label):
-            self.update_memory((stored_sample, stored_label))
+        self.online_train([image, label], self.batch_size * 2, n_worker,
+                          iterations=int(self.num_updates), stream_batch_size=self.batch_size)
+        self.stream_batches += 1
+        if self.stream_batches % self.report_freq == 0:
+            self.report_training(sample_num)
+        self.update_memory((image, label))
         self.temp_batch = []
         self.num_updates -= int(self.num_updates)
 
@@ -355,15 +366,15 @@ class L2P:
 
     def online_train(self, sample, batch_size, n_worker, iterations=1, stream_batch_size=1):
         
-        total_loss, correct, num_data = 0.0, 0.0, 0.0
+        metrics = self.train_metrics
 
         if len(self.memory) > 0 and batch_size - stream_batch_size > 0:
             memory_batch_size = min(len(self.memory), batch_size - stream_batch_size)
         for i in range(iterations):
             self.model.train()
             x, y = sample
-            x = torch.cat([self.train_transform(transforms.ToPILImage()(img)).unsqueeze(0) for img in x])
-            y = torch.cat([torch.tensor([self.exposed_classes.index(label)]) for label in y])
+            x = transform_batch(x, self.train_transform)
+            y = self.label_map(y)
             if len(self.memory) > 0:
                 memory_data = self.memory.get_batch(memory_batch_size)
                 x = torch.cat([x, memory_data['image']])
@@ -387,11 +398,9 @@ class L2P:
 
             self.update_schedule()
 
-            total_loss += loss.item()
-            correct += torch.sum(preds == y.unsqueeze(1)).item()
-            num_data += y.size(0)
+            metrics.update(loss, preds, y)
 
-        return total_loss / iterations, correct / num_data
+        return metrics
 
     def model_forward(self, x, y):
         do_cutmix = self.cutmix and np.random.rand(1) < 0.5
@@ -517,9 +526,13 @@ class L2P:
                 # loss = self.criterion(logit, y)
         return logit, loss
 
-    def report_training(self, sample_num, train_loss, train_acc):
-        writer.add_scalar(f"train/loss", train_loss, sample_num)
-        writer.add_scalar(f"train/acc", train_acc, sample_num)
+    def report_training(self, sample_num):
+        # Reports the training loss and accuracy of the steps since the last report
+        metrics = self.train_metrics.flush()
+        if metrics is None:
+            return
+        train_loss, train_acc = metrics
+        self.writer.log("train", sample_num, loss=train_loss, acc=train_acc)
         logger.info(
             f"Train | Sample # {sample_num} | train_loss {train_loss:.4f} | train_acc {train_acc:.4f} | "
             f"lr {self.optimizer.param_groups[0]['lr']:.6f} | "
@@ -528,8 +541,7 @@ class L2P:
         )
 
     def report_test(self, sample_num, avg_loss, avg_acc):
-        writer.add_scalar(f"test/loss", avg_loss, sample_num)
-        writer.add_scalar(f"test/acc", avg_acc, sample_num)
+        self.writer.log("test", sample_num, loss=avg_loss, acc=avg_acc)
         logger.info(
             f"Test | Sample # {sample_num} | test_loss {avg_loss:.4f} | test_acc {avg_acc:.4f} | "
         )
@@ -559,30 +571,20 @@ class L2P:
         pass
 
     def reservoir_memory(self, sample):
-        self.seen += 1
-        if len(self.memory.images) >= self.memory_size:
-            j = np.random.randint(0, self.seen)
-            if j < self.memory_size:
-                self.memory.replace_sample(sample, j)
-        else:
-            self.memory.replace_sample(sample)
+        self.memory.store(sample)
 
     def reset_opt(self):
         self.optimizer = select_optimizer_with_extern_params(self.opt_name, self.lr, self.model,self.prompt)
         self.scheduler = select_scheduler(self.sched_name, self.optimizer, self.lr_gamma)
 
     def evaluation(self, test_loader, criterion):
-        total_correct, total_num_data, total_loss = 0.0, 0.0, 0.0
-        correct_l = torch.zeros(self.n_classes)
-        num_data_l = torch.zeros(self.n_classes)
-        label = []
+        metrics = MetricsAccumulator(self.n_classes, self.topk, self.device)
 
         self.model.eval()
         with torch.no_grad():
             for i, data in enumerate(test_loader):
                 x, y = data
-                for j in range(len(y)):
-                    y[j] = self.exposed_classes.index(y[j].item())
+                y = self.label_map(y)
                 x = x.to(self.device)
                 y = y.to(self.device)
                 
@@ -614,38 +616,12 @@ class L2P:
                 
 
                 loss = criterion(logit, y)
-                pred = torch.argmax(logit, dim=-1)
-                _, preds = logit.topk(self.topk, 1, True, True)
-
-                total_correct += torch.sum(preds == y.unsqueeze(1)).item()
-                total_num_data += y.size(0)
-
-                xlabel_cnt, correct_xlabel_cnt = self._interpret_pred(y, pred)
-                correct_l += correct_xlabel_cnt.detach().cpu()
-                num_data_l += xlabel_cnt.detach().cpu()
-
-                total_loss += loss.item()
-                label += y.tolist()
+                metrics.update(logit, y, loss)
 
-        avg_acc = total_correct / total_num_data
-        avg_loss = total_loss / len(test_loader)
-        cls_acc = (correct_l / (num_data_l + 1e-5)).numpy().tolist()
-        ret = {"avg_loss": avg_loss, "avg_acc": avg_acc, "cls_acc": cls_acc}
+        ret = metrics.result()
 
         return ret
 
     def _interpret_pred(self, y, pred):
         # xlable is batch
-        ret_num_data = torch.zeros(self.n_classes)
-        ret_corrects = torch.zeros(self.n_classes)
-
-        xlabel_cls, xlabel_cnt = y.unique(return_counts=True)
-        for cls_idx, cnt in zip(xlabel_cls, xlabel_cnt):
-            ret_num_data[cls_idx] = cnt
-
-        correct_xlabel = y.masked_select(y == pred)
-        correct_cls, correct_cnt = correct_xlabel.unique(return_counts=True)
-        for cls_idx, cnt in zip(correct_cls, correct_cnt):
-            ret_corrects[cls_idx] = cnt
-
-        return ret_num_data, ret_corrects
+        return interpret_pred(y, pred, self.n_classes)
@@ -11,19 +11,23 @@ import random
 from collections import defaultdict
 import numpy as np
 import torch
-from randaugment import RandAugment
 from torch import nn
-from torch.utils.tensorboard import SummaryWriter
 from torch.utils.data import DataLoader
 from torchvision import transforms
 from utils.onlinesampler import OnlineSampler, OnlineTestSampler
+from utils.profiler import PhaseProfiler
+from utils.stream import PackedStream
 from utils.augment import Cutout
+from utils.batch_augment import augment_transforms
 from utils.data_loader import get_statistics
-from datasets import *
+from datasets import load_dataset
 from utils.train_utils import select_model, select_optimizer, select_scheduler
 import copy
 
 from utils.memory import Memory
+from utils.evaluator import AsyncEvaluator, TestSetCache, interpret_pred, test_loader
+from utils.label_map import LabelMap
+from utils.metric import MetricsSink, TrainMetrics
 
 ########################################################################################################################
 # This is trainer with a DistributedDataParallel                                                                       #
@@ -34,6 +38,8 @@ from utils.memory import Memory
 ########################################################################################################################
 
 class _Trainer():
+    memory_policy = "reservoir"
+
     def __init__(self, *args, **kwargs) -> None:
         self.mode    = kwargs.get("mode")
         self.dataset = kwargs.get("dataset")
@@ -45,6 +51,14 @@ class _Trainer():
         self.rnd_seed    = kwargs.get("rnd_seed")
 
         self.memory_size = kwargs.get("memory_size")
+        self.memory_storage = kwargs.get("memory_storage")
+        self.memory_dir  = kwargs.get("memory_dir")
+        self.memory_cache_size = kwargs.get("memory_cache_size")
+        self.memory_decode_workers = kwargs.get("memory_decode_workers")
+        self.replay_workers  = kwargs.get("replay_workers")
+        self.replay_prefetch = kwargs.get("replay_prefetch")
+        self.stream_dir  = kwargs.get("stream_dir")
+        self.stream_prefetch = kwargs.get("stream_prefetch")
         self.log_path    = kwargs.get("log_path")
         self.model_name  = kwargs.get("model_name")
         self.opt_name    = kwargs.get("opt_name")
@@ -58,14 +72,31 @@ class _Trainer():
         self.topk    = kwargs.get("topk")
         self.use_amp = kwargs.get("use_amp")
         self.transforms  = kwargs.get("transforms")
+        self.batch_augment = kwargs.get("batch_augment", False)
+        self.gpu_transform   = kwargs.get("gpu_transform")
 
         self.reg_coef    = kwargs.get("reg_coef")
 
         self.data_dir    = kwargs.get("data_dir")
+        self.cache_dir   = kwargs.get("cache_dir")
+        self.shard_dir   = kwargs.get("shard_dir")
+        self.shard_image_size    = kwargs.get("shard_image_size")
+        self.synthetic_classes   = kwargs.get("synthetic_classes")
+        self.synthetic_samples   = kwargs.get("synthetic_samples")
+        self.synthetic_test_samples  = kwargs.get("synthetic_test_samples")
+        self.synthetic_size  = kwargs.get("synthetic_size")
+        self.synthetic_channels  = kwargs.get("synthetic_channels")
         self.debug   = kwargs.get("debug")
+        self.max_steps   = kwargs.get("max_steps")
+        self.profile = kwargs.get("profile")
+        self.profile_trace   = kwargs.get("profile_trace")
         self.note    = kwargs.get("note")
         
         self.eval_period     = kwargs.get("eval_period")
+        self.report_freq     = kwargs.get("report_freq")
+        self.async_eval  = kwargs.get("async_eval")
+        self.test_cache_storage  = kwargs.get("test_cache")
+        self.eval_snapshots  = kwargs.get("eval_snapshots")
         self.temp_batchsize  = kwargs.get("temp_batchsize")
         self.online_iter     = kwargs.get("online_iter")
         self.num_gpus    = kwargs.get("num_gpus")
@@ -93,7 +124,7 @@ class _Trainer():
         if "WORLD_SIZE" in os.environ:
             self.world_size  = int(os.environ["WORLD_SIZE"]) * self.ngpus_per_nodes
         else:
-            self.world_size  = self.world_size * self.ngpus_per_nodes
+            self.world_size  = self.ngpus_per_nodes
         self.distributed     = self.world_size > 1
 
         if self.distributed:
@@ -105,6 +136,9 @@ class _Trainer():
         self.memory_batchsize = self.batchsize - self.temp_batchsize
 
         self.exposed_classes = []
+        self.label_map = LabelMap(self.exposed_classes)
+        self.train_metrics = TrainMetrics()
+        self.profiler = PhaseProfiler()
         # # Set the logger
         # logging.config.fileConfig("./configuration/logging.conf")
         # self.logger  = logging.getLogger()
@@ -122,45 +156,24 @@ class _Trainer():
 
         return
 
-    def setup_dataset_for_distributed(self):
-
-        datasets = {
-        "cifar10": CIFAR10,
-        "cifar100": CIFAR100,
-        "svhn": SVHN,
-        "fashionmnist": FashionMNIST,
-        "mnist": MNIST,
-        "tinyimagenet": TinyImageNet,
-        "notmnist": NotMNIST,
-        "cub200": CUB200,
-        "imagenet": ImageNet
-        }
+    def load_dataset(self, train, transform):
+        return load_dataset(self, train, transform)
 
+    def setup_dataset_for_distributed(self):
         mean, std, n_classes, inp_size, _ = get_statistics(dataset=self.dataset)
+        if self.dataset == "synthetic":
+            n_classes, inp_size = self.synthetic_classes, self.synthetic_size
         self.n_classes = n_classes
 
         train_transform = []
         if self.model_name == 'vit':
             inp_size = 224
         self.cutmix = "cutmix" in self.transforms 
+        # Cutout, crops and flips run batched on the device with --gpu_transform, AutoAugment and RandAugment too with --batch_augment
         if "cutout" in self.transforms:
             train_transform.append(Cutout(size=16))
-            if self.gpu_transform:
-                self.gpu_transform = False
-                # self.logger.warning("cutout not supported on GPU!")
-        if "randaug" in self.transforms:
-            train_transform.append(RandAugment())
-            if self.gpu_transform:
-                self.gpu_transform = False
-                # self.logger.warning("randaug not supported on GPU!")
-        if "autoaug" in self.transforms:
-            if 'cifar' in self.dataset:
-                train_transform.append(transforms.AutoAugment(transforms.AutoAugmentPolicy('cifar10')))
-            elif 'imagenet' in self.dataset:
-                train_transform.append(transforms.AutoAugment(transforms.AutoAugmentPolicy('imagenet')))
-            elif 'svhn' in self.dataset:
-                train_transform.append(transforms.AutoAugment(transforms.AutoAugmentPolicy('svhn')))
-                
+        train_transform.extend(augment_transforms(self.transforms, self.dataset, self.batch_augment))
+
         self.train_transform = transforms.Compose([
                 transforms.Resize((inp_size, inp_size)),
                 transforms.RandomCrop(inp_size, padding=4),
@@ -177,23 +190,41 @@ class _Trainer():
         _r = dist.get_rank() if self.distributed else None       # means that it is not distributed
         _w = dist.get_world_size() if self.distributed else None # means that it is not distributed
 
-        self.train_dataset   = datasets[self.dataset](root=self.data_dir, train=True,  download=True, 
-                                                      transform=transforms.ToTensor())
-        self.test_dataset    = datasets[self.dataset](root=self.data_dir, train=False, download=True, transform=self.test_transform)
-        self.train_sampler   = OnlineSampler(self.train_dataset, self.n_tasks, self.m, self.n, self.rnd_seed, 0, self.rnd_NM, _w, _r)
+        self.train_dataset   = self.load_dataset(train=True, transform=transforms.ToTensor())
+        self.test_dataset    = self.load_dataset(train=False, transform=self.test_transform)
+        self.train_sampler   = OnlineSampler(self.train_dataset, self.n_tasks, self.m, self.n, self.rnd_seed, 0, self.rnd_NM, _w, _r, self.cache_dir)
         self.test_sampler    = OnlineTestSampler(self.test_dataset, [], _w, _r)
-
-        self.train_dataloader    = DataLoader(self.train_dataset, batch_size=self.temp_batchsize, sampler=self.train_sampler, num_workers=self.n_worker)
+        # Every rank evaluates the whole exposed test set, the sampler grows with the exposed classes
+        self.eval_sampler    = OnlineTestSampler(self.test_dataset, [])
+        self.test_set    = self.test_dataset
+        if self.test_cache_storage not in (None, "none"):
+            # Cached before Normalize, which the cache applies to the batches it reads
+            cache_dataset = self.load_dataset(train=False, transform=transforms.Compose(self.test_transform.transforms[:-1]))
+            self.test_set = TestSetCache(cache_dataset, self.test_cache_storage, self.memory_dir, self.batchsize*2, self.n_worker,
+                                         self.test_transform.transforms[-1])
+
+        if self.stream_dir is not None:
+            self.train_dataloader    = PackedStream(self.train_dataset, self.train_sampler, self.temp_batchsize, self.stream_dir, self.stream_prefetch, self.n_worker)
+        else:
+            self.train_dataloader    = DataLoader(self.train_dataset, batch_size=self.temp_batchsize, sampler=self.train_sampler, num_workers=self.n_worker)
         
         self.seen = 0
-        self.memory = Memory(self.train_dataset)
+        self.memory = Memory(self.train_dataset, self.memory_size, self.memory_policy,
+                             self.memory_storage, self.memory_dir, self.memory_cache_size, self.memory_decode_workers)
+        if self.replay_workers:
+            self.memory.enable_prefetch(self.train_transform, self.replay_workers, self.replay_prefetch)
 
     def setup_distributed_model(self):
 
         print("Building model...")
         self.model = select_model(self.model_name, self.dataset, 1)
         self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp)
-        self.writer = SummaryWriter(f"{self.log_path}/tensorboard/{self.dataset}/{self.note}/seed_{self.rnd_seed}")
+        # Only the main process keeps the metrics, the sink of the other ranks drops them
+        if self.is_main_process():
+            self.metrics_sink = MetricsSink(f"{self.log_path}/logs/{self.dataset}/{self.note}/seed_{self.rnd_seed}_metrics",
+                                            f"{self.log_path}/tensorboard/{self.dataset}/{self.note}/seed_{self.rnd_seed}")
+        else:
+            self.metrics_sink = MetricsSink()
         
         self.model.to(self.device)
         self.model_without_ddp = self.model
@@ -227,8 +258,8 @@ class _Trainer():
             self.main_worker(0)
     
     def main_worker(self, gpu) -> None:
-        self.gpu    = gpu % self.ngpus_per_nodes
-        self.device = torch.device(self.gpu)
+        self.gpu    = gpu % max(self.ngpus_per_nodes, 1)
+        self.device = torch.device(self.gpu) if torch.cuda.is_available() else torch.device("cpu")
         if self.distributed:
             self.local_rank = self.gpu
             if 'SLURM_PROCID' in os.environ.keys():
@@ -249,7 +280,8 @@ class _Trainer():
             pass
 
         self.setup_dataset_for_distributed()
-        self.total_samples = len(self.train_dataset)
+        self.total_samples = self.train_sampler.stream_size()
+        self.profiler = PhaseProfiler(self.profile, self.device, self.profile_trace)
 
         print(f"[1] Select a CIL method ({self.mode})")
         self.setup_distributed_model()
@@ -268,10 +300,18 @@ class _Trainer():
         cudnn.benchmark = True
     
         print(f"[2] Incrementally training {self.n_tasks} tasks")
-        task_records = defaultdict(list)
-        eval_results = defaultdict(list)
+        task_records = self.task_records = defaultdict(list)
+        eval_results = self.eval_results = defaultdict(list)
         samples_cnt = 0
 
+        self.evaluator = None
+        if self.async_eval:
+            if self.distributed:
+                print("Asynchronous evaluation is not supported with distributed training, evaluating synchronously")
+            else:
+                self.evaluator = AsyncEvaluator(self.test_set, self.eval_sampler, self.batchsize*2, self.topk, self.n_classes,
+                                                self.device, self.record_eval, self.eval_snapshots)
+
         num_eval = self.eval_period
         for task_id in range(self.n_tasks):
             if self.mode == "joint" and task_id > 0:
@@ -282,49 +322,39 @@ class _Trainer():
             print("[2-1] Prepare a datalist for the current task")
             self.train_sampler.set_task(task_id)
             
+            self.profiler.begin_task(task_id)
             self.online_before_task(task_id)
-            for i, (image, label) in enumerate(self.train_dataloader):
+            for i, (image, label) in enumerate(self.profiler.iterate(self.train_dataloader, "data")):
                 if self.debug and i >= 100 : break
-                samples_cnt += image.size(0)
-                if samples_cnt > num_eval:
+                if self.max_steps is not None and i >= self.max_steps : break
+                if samples_cnt + image.size(0) > num_eval:
                 # if samples_cnt % args.eval_period == 0:
-                    test_sampler = OnlineTestSampler(self.test_dataset, self.exposed_classes)
-                    test_dataloader = DataLoader(self.test_dataset, batch_size=self.batchsize*2, sampler=test_sampler, num_workers=self.n_worker)
-                    eval_dict = self.online_evaluate(test_dataloader)
-                    if self.distributed:
-                        eval_dict =  torch.tensor([eval_dict['avg_loss'], eval_dict['avg_acc'], *eval_dict['cls_acc']], device=self.device)
-                        dist.all_reduce(eval_dict, op=dist.ReduceOp.SUM)
-                        eval_dict = eval_dict.cpu().numpy()
-                        eval_dict = {'avg_loss': eval_dict[0]/self.world_size, 'avg_acc': eval_dict[1]/self.world_size, 'cls_acc': eval_dict[2:]/self.world_size}
-                    eval_results["test_acc"].append(eval_dict['avg_acc'])
-                    eval_results["avg_acc"].append(eval_dict['cls_acc'])
-                    eval_results["data_cnt"].append(num_eval)
-                    self.report_test(num_eval, eval_dict["avg_loss"], eval_dict['avg_acc'])
+                    self.report_training(samples_cnt)
+                    with self.profiler.phase("evaluation"):
+                        self.evaluate(("online", num_eval))
                     num_eval += self.eval_period
-                loss, acc = self.online_step([image,label], samples_cnt)
-                self.report_training(samples_cnt, loss, acc)
+                samples_cnt += image.size(0)
+                self.profiler.add_samples(image.size(0))
+                with self.profiler.phase("online_step"):
+                    self.online_step([image,label], samples_cnt)
+                if (i + 1) % self.report_freq == 0:
+                    self.report_training(samples_cnt)
+                if self.evaluator is not None:
+                    self.evaluator.poll()
+            self.report_training(samples_cnt)
             self.online_after_task(task_id)
-            test_sampler = OnlineTestSampler(self.test_dataset, self.exposed_classes)
-            test_dataloader = DataLoader(self.test_dataset, batch_size=self.batchsize*2, sampler=test_sampler, num_workers=self.n_worker)
-            eval_dict = self.online_evaluate(test_dataloader)
-            if self.distributed:
-                eval_dict =  torch.tensor([eval_dict['avg_loss'], eval_dict['avg_acc'], *eval_dict['cls_acc']], device=self.device)
-                dist.all_reduce(eval_dict, op=dist.ReduceOp.SUM)
-                eval_dict = eval_dict.cpu().numpy()
-                eval_dict = {'avg_loss': eval_dict[0]/self.world_size, 'avg_acc': eval_dict[1]/self.world_size, 'cls_acc': eval_dict[2:]/self.world_size}
-            task_acc = eval_dict['avg_acc']
-
-            print("[2-4] Update the information for the current task")
-            task_records["task_acc"].append(task_acc)
-            task_records["cls_acc"].append(eval_dict["cls_acc"])
-
-            print("[2-5] Report task result")
-            self.writer.add_scalar("Metrics/TaskAcc", task_acc, task_id)
-        
-        np.save(f"{self.log_path}/logs/{self.dataset}/{self.note}/seed_{self.rnd_seed}.npy", task_records["task_acc"])
-
+            with self.profiler.phase("evaluation"):
+                self.evaluate(("task", task_id))
+            self.record_profile(self.profiler.end_task())
+
+        if self.evaluator is not None:
+            self.evaluator.close()
+        if self.profile:
+            print(self.profiler.summary())
+            self.profiler.close()
         if self.mode == 'gdumb':
             eval_results, task_records = self.evaluate_all(self.test_dataset, self.memory_epoch, self.batchsize, self.n_worker)
+        np.save(f"{self.log_path}/logs/{self.dataset}/{self.note}/seed_{self.rnd_seed}.npy", task_records["task_acc"])
         if self.eval_period is not None:
             np.save(f'{self.log_path}/logs/{self.dataset}/{self.note}/seed_{self.rnd_seed}_eval.npy', eval_results['test_acc'])
             np.save(f'{self.log_path}/logs/{self.dataset}/{self.note}/seed_{self.rnd_seed}_eval_time.npy', eval_results['data_cnt'])
@@ -344,7 +374,44 @@ class _Trainer():
 
         print(f"======== Summary =======")
         print(f"A_auc {A_auc} | A_avg {A_avg} | A_last {A_last} | F_last {F_last}")
+        self.metrics_sink.log("summary", samples_cnt, A_auc=A_auc, A_avg=A_avg, A_last=A_last, F_last=F_last)
+        self.metrics_sink.close()
     
+    def evaluate(self, tag):
+        # tag is ("online", data_cnt) or ("task", task_id), the result goes to record_eval either way
+        if self.evaluator is not None:
+            self.evaluator.submit(tag, self.model_without_ddp, self.exposed_classes)
+            return
+        eval_dict = self.online_evaluate(test_loader(self.test_set, self.eval_sampler, self.exposed_classes, self.batchsize*2, self.n_worker))
+        if self.distributed:
+            eval_dict =  torch.tensor([eval_dict['avg_loss'], eval_dict['avg_acc'], *eval_dict['cls_acc']], device=self.device)
+            dist.all_reduce(eval_dict, op=dist.ReduceOp.SUM)
+            eval_dict = eval_dict.cpu().numpy()
+            eval_dict = {'avg_loss': eval_dict[0]/self.world_size, 'avg_acc': eval_dict[1]/self.world_size, 'cls_acc': eval_dict[2:]/self.world_size}
+        self.record_eval(tag, eval_dict)
+
+    def record_eval(self, tag, eval_dict):
+        kind, step = tag
+        if kind == "online":
+            self.eval_results["test_acc"].append(eval_dict['avg_acc'])
+            self.eval_results["avg_acc"].append(eval_dict['cls_acc'])
+            self.eval_results["data_cnt"].append(step)
+            self.report_test(step, eval_dict["avg_loss"], eval_dict['avg_acc'], eval_dict['cls_acc'])
+            return
+        task_acc = eval_dict['avg_acc']
+
+        print("[2-4] Update the information for the current task")
+        self.task_records["task_acc"].append(task_acc)
+        self.task_records["cls_acc"].append(eval_dict["cls_acc"])
+
+        print("[2-5] Report task result")
+        self.metrics_sink.log("task", step, acc=task_acc, cls_acc=eval_dict["cls_acc"])
+
+    def record_profile(self, task):
+        if self.profile:
+            self.metrics_sink.log("profile", task["id"], samples_per_sec=task["samples"] / task["wall"],
+                                  peak_memory=task["peak_memory"], **task["time"])
+
     def add_new_class(self, class_name):
         self.exposed_classes.append(class_name)
         self.num_learned_class = len(self.exposed_classes)
@@ -408,35 +475,26 @@ class _Trainer():
                 builtin_print(*args, **kwargs)
         __builtin__.print = print
 
-    def report_training(self, sample_num, train_loss, train_acc):
-        self.writer.add_scalar(f"train/loss", train_loss, sample_num)
-        self.writer.add_scalar(f"train/acc", train_acc, sample_num)
+    def report_training(self, sample_num):
+        # Reports the training loss and accuracy of the steps since the last report
+        metrics = self.train_metrics.flush()
+        if metrics is None:
+            return
+        train_loss, train_acc = metrics
+        self.metrics_sink.log("train", sample_num, loss=train_loss, acc=train_acc)
         print(
             f"Train | Sample # {sample_num} | train_loss {train_loss:.4f} | train_acc {train_acc:.4f} | "
             f"lr {self.optimizer.param_groups[0]['lr']:.6f} | "
             f"running_time {datetime.timedelta(seconds=int(time.time() - self.start_time))} | "
-            f"ETA {datetime.timedelta(seconds=int((time.time() - self.start_time) * (self.total_samples-sample_num) / sample_num))}"
+            f"ETA {datetime.timedelta(seconds=int(self.profiler.eta(self.total_samples)))}"
         )
 
-    def report_test(self, sample_num, avg_loss, avg_acc):
-        self.writer.add_scalar(f"test/loss", avg_loss, sample_num)
-        self.writer.add_scalar(f"test/acc", avg_acc, sample_num)
+    def report_test(self, sample_num, avg_loss, avg_acc, cls_acc):
+        self.metrics_sink.log("test", sample_num, loss=avg_loss, acc=avg_acc, cls_acc=cls_acc)
         print(
             f"Test | Sample # {sample_num} | test_loss {avg_loss:.4f} | test_acc {avg_acc:.4f} | "
         )
 
     def _interpret_pred(self, y, pred):
         # xlable is batch
-        ret_num_data = torch.zeros(self.n_classes)
-        ret_corrects = torch.zeros(self.n_classes)
-
-        xlabel_cls, xlabel_cnt = y.unique(return_counts=True)
-        for cls_idx, cnt in zip(xlabel_cls, xlabel_cnt):
-            ret_num_data[cls_idx] = cnt
-
-        correct_xlabel = y.masked_select(y == pred)
-        correct_cls, correct_cnt = correct_xlabel.unique(return_counts=True)
-        for cls_idx, cnt in zip(correct_cls, correct_cnt):
-            ret_corrects[cls_idx] = cnt
-
-        return ret_num_data, ret_corrects
\ No newline at end of file
+        return interpret_pred(y, pred, self.n_classes)
\ No newline at end of file
@@ -9,19 +9,17 @@ import logging
 import copy
 from copy import deepcopy
 
-import pandas as pd
 import torch
 import numpy as np
 from torch import nn
-from torch.utils.data import DataLoader
 
 from methods.er_baseline import ER
-from utils.data_loader import ImageDataset, cutmix_data, StreamDataset
+from utils.batch_augment import transform_batch
+from utils.data_loader import cutmix_data
 from utils.train_utils import select_model, cycle
-from torch.utils.tensorboard import SummaryWriter
+from utils.evaluator import MetricsAccumulator
 
 logger = logging.getLogger()
-writer = SummaryWriter("tensorboard")
 
 
 class BiasCorrectionLayer(nn.Module):
@@ -42,7 +40,7 @@ class BiasCorrection(ER):
         self, criterion, device, train_transform, test_transform, n_classes, **kwargs
     ):
         """
-        self.valid_list: valid set which is used for training bias correction layer.
+        self.valid_images, self.valid_labels: valid set which is used for training bias correction layer.
         self.memory_list: training set only including old classes. As already mentioned in the paper,
             memory list and valid list are exclusive.
         self.bias_layer_list - the list of bias correction layers. The index of the list means the task number.
@@ -54,7 +52,9 @@ class BiasCorrection(ER):
             self.model_name, self.dataset, 1
         )
         self.bias_layer = None
-        self.valid_list = []
+        # Stream images held out to fit the bias correction and their labels
+        self.valid_images = []
+        self.valid_labels = []
 
         self.valid_size = round(self.memory_size * 0.1)
         self.memory_size = self.memory_size - self.valid_size
@@ -81,91 +81,65 @@ class BiasCorrection(ER):
             self.prev_model = deepcopy(self.model)
 
     def online_step(self, sample, sample_num, n_worker):
-        if sample['klass'] not in self.exposed_classes:
-            self.add_new_class(sample['klass'])
+        image, label = sample
+        for cls in self.label_map.unseen(label):
+            self.add_new_class(cls)
 
         use_sample = self.online_valid_update(sample)
-        self.num_updates += self.online_iter
-
-        if use_sample:
-            self.temp_batch.append(sample)
-            if len(self.temp_batch) == self.temp_batchsize:
-                train_loss, train_acc = self.online_train(self.temp_batch, self.batch_size, n_worker,
-                                                          iterations=int(self.num_updates),
-                                                          stream_batch_size=self.temp_batchsize)
-                self.report_training(sample_num, train_loss, train_acc)
-                for stored_sample in self.temp_batch:
-                    self.update_memory(stored_sample)
-                self.temp_batch = []
-                self.num_updates -= int(self.num_updates)
+        if not use_sample.any():
+            return
+        image, label = image[use_sample], label[use_sample]
+        self.num_updates += self.online_iter * len(label)
+        self.online_train([image, label], self.batch_size * 2, n_worker,
+                          iterations=int(self.num_updates), stream_batch_size=len(label))
+        self.stream_batches += 1
+        if self.stream_batches % self.report_freq == 0:
+            self.report_training(sample_num)
+        self.update_memory((image, label))
+        self.num_updates -= int(self.num_updates)
 
     def add_new_class(self, class_name):
         if self.distilling:
             self.prev_model = deepcopy(self.model)
-        self.exposed_classes.append(class_name)
-        self.num_learned_class = len(self.exposed_classes)
-        prev_weight = copy.deepcopy(self.model.fc.weight.data)
-        self.model.fc = nn.Linear(self.model.fc.in_features, self.num_learned_class).to(self.device)
-
-        with torch.no_grad():
-            if self.num_learned_class > 1:
-                self.model.fc.weight[:self.num_learned_class - 1] = prev_weight
-        for param in self.optimizer.param_groups[1]['params']:
-            if param in self.optimizer.state.keys():
-                del self.optimizer.state[param]
-        del self.optimizer.param_groups[1]
-        self.optimizer.add_param_group({'params': self.model.fc.parameters()})
-        self.memory.add_new_class(cls_list=self.exposed_classes)
+        super().add_new_class(class_name)
 
         self.bias_labels[self.cur_iter].append(self.num_learned_class - 1)
         if self.num_learned_class > 1:
             self.online_reduce_valid(self.num_learned_class)
 
-        if 'reset' in self.sched_name:
-            self.update_schedule(reset=True)
-
     def online_reduce_valid(self, num_learned_class):
         self.val_per_cls = self.valid_size//num_learned_class
-        val_df = pd.DataFrame(self.valid_list)
-        valid_list = []
-        for klass in val_df["klass"].unique():
-            class_val = val_df[val_df.klass == klass]
+        valid_labels = torch.tensor(self.valid_labels, dtype=torch.long)
+        kept = []
+        for klass in valid_labels.unique():
+            class_val = torch.nonzero(valid_labels == klass).squeeze(1)
             if len(class_val) > self.val_per_cls:
-                new_class_val = class_val.sample(n=self.val_per_cls)
-            else:
-                new_class_val = class_val
-            valid_list += new_class_val.to_dict(orient="records")
-        self.valid_list = valid_list
+                class_val = class_val[torch.randperm(len(class_val))[:self.val_per_cls]]
+            kept.extend(class_val.tolist())
+        self.valid_images = [self.valid_images[i] for i in kept]
+        self.valid_labels = [self.valid_labels[i] for i in kept]
         self.val_full = False
 
     def online_valid_update(self, sample):
-        val_df = pd.DataFrame(self.valid_list, columns=['klass', 'file_name', 'label'])
-        if not self.val_full:
-            if len(val_df[val_df["klass"] == sample["klass"]]) < self.val_per_cls:
-                self.valid_list.append(sample)
-                if len(self.valid_list) == self.val_per_cls*self.num_learned_class:
+        # Fills the validation set of the bias correction first, returns which samples of the batch are left for training
+        image, label = sample
+        use_sample = torch.ones(len(label), dtype=torch.bool)
+        if self.val_full:
+            return use_sample
+        for i, klass in enumerate(label.tolist()):
+            if self.valid_labels.count(klass) < self.val_per_cls:
+                self.valid_images.append(image[i])
+                self.valid_labels.append(klass)
+                use_sample[i] = False
+                if len(self.valid_labels) == self.val_per_cls*self.num_learned_class:
                     self.val_full = True
-                use_sample = False
-            else:
-                use_sample = True
-        else:
-            use_sample = True
+                    break
         return use_sample
 
     def online_train(self, sample, batch_size, n_worker, iterations=1, stream_batch_size=1):
         self.model.train()
-        total_loss, distill_loss, classify_loss, correct, num_data = 0.0, 0.0, 0.0, 0.0, 0.0
-
-        if stream_batch_size > 0:
-            sample_dataset = StreamDataset(
-                sample,
-                dataset=self.dataset,
-                transform=self.train_transform,
-                cls_list=self.exposed_classes,
-                data_dir=self.data_dir,
-                device=self.device,
-                transform_on_gpu=self.gpu_transform
-            )
+        metrics = self.train_metrics
+
         if len(self.memory) > 0 and batch_size - stream_batch_size > 0:
             memory_batch_size = min(len(self.memory), batch_size - stream_batch_size)
 
@@ -173,9 +147,9 @@ class BiasCorrection(ER):
             x = []
             y = []
             if stream_batch_size > 0:
-                stream_data = sample_dataset.get_data()
-                x.append(stream_data['image'])
-                y.append(stream_data['label'])
+                stream_x, stream_y = self.stream_batch(sample)
+                x.append(stream_x)
+                y.append(stream_y)
             if len(self.memory) > 0 and batch_size - stream_batch_size > 0:
                 memory_data = self.memory.get_batch(memory_batch_size)
                 x.append(memory_data['image'])
@@ -249,13 +223,9 @@ class BiasCorrection(ER):
                 torch.nn.utils.clip_grad_norm_(self.model.parameters(), 10)
                 self.optimizer.step()
             self.update_schedule()
-            total_loss += loss.item()
-            distill_loss += loss_d.item()
-            classify_loss += loss_c.item()
-            correct += torch.sum(preds == y.unsqueeze(1)).item()
-            num_data += y.size(0)
+            metrics.update(loss, preds, y)
 
-        return total_loss / iterations, correct / num_data
+        return metrics
 
     def online_bias_forward(self, input, iter):
         bias_labels = self.bias_labels[iter]
@@ -264,78 +234,44 @@ class BiasCorrection(ER):
             input[:, bias_labels] = bias_layer(input[:, bias_labels])
         return input
 
-    def online_evaluate(self, test_list, sample_num, batch_size, n_worker):
+    def online_evaluate(self, test_loader, sample_num):
         self.online_bias_correction()
-        test_df = pd.DataFrame(test_list)
-        exp_test_df = test_df[test_df['klass'].isin(self.exposed_classes)]
-        test_dataset = ImageDataset(
-            exp_test_df,
-            dataset=self.dataset,
-            transform=self.test_transform,
-            cls_list=self.exposed_classes,
-            data_dir=self.data_dir
-        )
-        test_loader = DataLoader(
-            test_dataset,
-            shuffle=True,
-            batch_size=batch_size,
-            num_workers=n_worker,
-        )
-        total_correct, total_num_data, total_loss = (
-            0.0,
-            0.0,
-            0.0,
+        eval_dict = self.evaluation(test_loader, self.criterion)
+        self.writer.log("test", sample_num, loss=eval_dict["avg_loss"], acc=eval_dict["avg_acc"], cls_acc=eval_dict["cls_acc"])
+        logger.info(
+            f"Test | Sample # {sample_num} | test_loss {eval_dict['avg_loss']:.4f} | test_acc {eval_dict['avg_acc']:.4f} | "
         )
-        correct_l = torch.zeros(self.n_classes)
-        num_data_l = torch.zeros(self.n_classes)
-        label = []
+        return eval_dict
+
+    def evaluation(self, test_loader, criterion):
+        metrics = MetricsAccumulator(self.n_classes, self.topk, self.device)
 
         self.model.eval()
-        self.bias_layer.eval()
+        self.bias_layer_list[self.cur_iter].eval()
 
         with torch.no_grad():
             for i, data in enumerate(test_loader):
-                x = data["image"]
-                xlabel = data["label"]
+                x, xlabel = data
+                xlabel = self.label_map(xlabel)
                 x = x.to(self.device)
+                xlabel = xlabel.to(self.device)
                 logit = self.model(x)
                 logit = self.online_bias_forward(logit, self.cur_iter)
-                logit = logit.detach().cpu()
-                loss = self.criterion(logit, xlabel)
-                pred = torch.argmax(logit, dim=-1)
-                _, preds = logit.topk(self.topk, 1, True, True)
-                total_correct += torch.sum(preds == xlabel.unsqueeze(1)).item()
-                total_num_data += xlabel.size(0)
-
-                xlabel_cnt, correct_xlabel_cnt = self._interpret_pred(xlabel, pred)
-                correct_l += correct_xlabel_cnt.detach().cpu()
-                num_data_l += xlabel_cnt.detach().cpu()
-
-                total_loss += loss.item()
-                label += xlabel.tolist()
-
-        avg_acc = total_correct / total_num_data
-        avg_loss = total_loss / len(test_loader)
+                loss = criterion(logit, xlabel)
+                metrics.update(logit, xlabel, loss)
 
-        cls_acc = (correct_l / (num_data_l + 1e-5)).numpy().tolist()
-        eval_dict = {"avg_loss": avg_loss, "avg_acc": avg_acc, "cls_acc": cls_acc}
-
-        writer.add_scalar(f"test/loss", eval_dict["avg_loss"], sample_num)
-        writer.add_scalar(f"test/acc", eval_dict["avg_acc"], sample_num)
-        logger.info(
-            f"Test | Sample # {sample_num} | test_loss {eval_dict['avg_loss']:.4f} | test_acc {eval_dict['avg_acc']:.4f} | "
-        )
-        return eval_dict
+        return metrics.result()
 
     def online_bias_correction(self, n_iter=256, batch_size=100, n_worker=4):
         self.bias_layer_list[self.cur_iter] = BiasCorrectionLayer().to(self.device)
         self.bias_layer = self.bias_layer_list[self.cur_iter]
 
         if self.val_full and self.cur_iter > 0 and len(self.bias_labels[self.cur_iter]) > 0:
-            val_df = pd.DataFrame(self.valid_list)
-            val_dataset = ImageDataset(val_df, dataset=self.dataset, transform=self.test_transform,
-                                       cls_list=self.exposed_classes, data_dir=self.data_dir, preload=True)
-            bias_loader = DataLoader(val_dataset, shuffle=True, batch_size=batch_size, num_workers=n_worker)
+            valid_images = torch.stack(self.valid_images)
+            valid_labels = self.label_map(torch.tensor(self.valid_labels, dtype=torch.long))
+            order = torch.randperm(len(valid_labels))
+            bias_loader = [(transform_batch(valid_images[batch], self.test_transform), valid_labels[batch])
+                           for batch in order.split(batch_size)]
             criterion = self.criterion
             self.bias_layer = self.bias_layer_list[self.cur_iter]
             optimizer = torch.optim.Adam(params=self.bias_layer.parameters(), lr=0.001)
@@ -343,9 +279,7 @@ class BiasCorrection(ER):
             total_loss = None
             model_out = []
             xlabels = []
-            for i, data in enumerate(bias_loader):
-                x = data["image"]
-                xlabel = data["label"]
+            for i, (x, xlabel) in enumerate(bias_loader):
                 x = x.to(self.device)
                 xlabel = xlabel.to(self.device)
                 with torch.no_grad():
@@ -356,7 +290,7 @@ class BiasCorrection(ER):
                 self.bias_layer.train()
                 total_loss = 0.0
                 for i, out in enumerate(model_out):
-                    logit = self.online_bias_forward(out.to(self.device), self.cur_iter)
+                    logit = self.online_bias_forward(out.to(self.device, copy=True), self.cur_iter)
                     xlabel = xlabels[i]
                     loss = criterion(logit, xlabel.to(self.device))
                     optimizer.zero_grad()
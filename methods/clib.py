@@ -9,16 +9,17 @@ import torch.nn.functional as F
 import pandas as pd
 from torch.utils.data import DataLoader
 import torchvision.transforms as transforms
-from torch.utils.tensorboard import SummaryWriter
 from scipy.stats import ttest_ind
 
 from methods.er_baseline import ER
 from utils.data_loader import cutmix_data, ImageDataset, StreamDataset, MemoryDataset
+from utils.batch_augment import transform_batch
 
 logger = logging.getLogger()
-writer = SummaryWriter("tensorboard")
 
 class CLIB(ER):
+    memory_policy = "class_balanced_min_score"
+
     def __init__(self, criterion, device, train_transform, test_transform, n_classes, **kwargs):
         super().__init__(criterion, device, train_transform, test_transform, n_classes, **kwargs)
         self.memory_size = kwargs["memory_size"]
@@ -28,8 +29,6 @@ class CLIB(ER):
         self.dropped_idx = []
         self.memory_dropped_idx = []
         self.imp_update_counter = 0
-        self.memory = MemoryDataset(self.train_transform, cls_list=self.exposed_classes,
-                                    test_transform=self.test_transform, save_test=True, keep_history=True)
         self.imp_update_period = kwargs['imp_update_period']
         if kwargs["sched_name"] == 'default':
             self.sched_name = 'adaptive_lr'
@@ -46,18 +45,22 @@ class CLIB(ER):
         self.low_lr_loss = []
         self.current_lr = self.lr
 
+    def build_memory(self, memory_size, kwargs, **options):
+        # The full memory_size, with the test images and loss history of every sample for the importance updates
+        return super().build_memory(kwargs["memory_size"], kwargs, save_test=True, keep_history=True, **options)
+
     def online_step(self, sample, sample_num, n_worker):
         image, label = sample
-        for l in label:
-            if l.item() not in self.exposed_classes:
-                self.add_new_class(l.item())
-        for stored_sample, stored_label in zip(image, label):
-            self.update_memory((stored_sample, stored_label))
+        for cls in self.label_map.unseen(label):
+            self.add_new_class(cls)
+        self.update_memory((image, label))
         self.num_updates += self.online_iter * self.batch_size
         # if len(self.temp_batch) == self.temp_batchsize:
-        train_loss, train_acc = self.online_train([], self.batch_size, n_worker,
-                                                    iterations=int(self.num_updates), stream_batch_size=0)
-        self.report_training(sample_num, train_loss, train_acc)
+        self.online_train([], self.batch_size, n_worker,
+                          iterations=int(self.num_updates), stream_batch_size=0)
+        self.stream_batches += 1
+        if self.stream_batches % self.report_freq == 0:
+            self.report_training(sample_num)
         self.temp_batch = []
         self.num_updates -= int(self.num_updates)
     def update_memory(self, sample):
@@ -65,7 +68,7 @@ class CLIB(ER):
 
     def online_train(self, sample, batch_size, n_worker, iterations=1, stream_batch_size=0):
         # print("This is an online_train process in clib.py")
-        total_loss, correct, num_data = 0.0, 0.0, 0.0
+        metrics = self.train_metrics
         if len(self.memory) > 0 and batch_size - stream_batch_size > 0:
             memory_batch_size = min(len(self.memory), batch_size - stream_batch_size)
 
@@ -73,8 +76,8 @@ class CLIB(ER):
             self.model.train()
             if len(sample) > 0:
                 x, y = sample
-                x = torch.cat([self.train_transform(transforms.ToPILImage()(img)).unsqueeze(0) for img in x])
-                y = torch.cat([torch.tensor([self.exposed_classes.index(label)]) for label in y])
+                x = transform_batch(x, self.train_transform)
+                y = self.label_map(y)
             if len(self.memory) > 0:
                 if len(sample) > 0:
                     memory_data = self.memory.get_batch(memory_batch_size)
@@ -101,11 +104,9 @@ class CLIB(ER):
                 self.optimizer.step()
             self.samplewise_loss_update()
 
-            total_loss += loss.item()
-            correct += torch.sum(preds == y.unsqueeze(1)).item()
-            num_data += y.size(0)
+            metrics.update(loss, preds, y)
 
-        return total_loss / iterations, correct / num_data
+        return metrics
 
     def add_new_class(self, class_name):
         self.exposed_classes.append(class_name)
@@ -118,7 +119,9 @@ class CLIB(ER):
                 self.model.fc.weight[:self.num_learned_class - 1] = prev_weight
         sdict = copy.deepcopy(self.optimizer.state_dict())
         fc_params = sdict['param_groups'][1]['params']
-        if len(sdict['state']) > 0:
+        # The head has no optimizer state until a step touched it
+        fc_state = fc_params[0] in sdict['state'] and fc_params[1] in sdict['state']
+        if fc_state:
             fc_weight_state = sdict['state'][fc_params[0]]
             fc_bias_state = sdict['state'][fc_params[1]]
         for param in self.optimizer.param_groups[1]['params']:
@@ -126,7 +129,7 @@ class CLIB(ER):
                 del self.optimizer.state[param]
         del self.optimizer.param_groups[1]
         self.optimizer.add_param_group({'params': self.model.fc.parameters()})
-        if len(sdict['state']) > 0:
+        if fc_state:
             if 'adam' in self.opt_name:
                 fc_weight = self.optimizer.param_groups[1]['params'][0]
                 fc_bias = self.optimizer.param_groups[1]['params'][1]
@@ -182,21 +185,9 @@ class CLIB(ER):
                 self.loss = loss
 
     def samplewise_importance_memory(self, sample):
-        x, y = sample
-        if len(self.memory.images) >= self.memory_size:
-            label_frequency = copy.deepcopy(self.memory.cls_count)
-            label_frequency[self.exposed_classes.index(y.item())] += 1
-            cls_to_replace = np.argmax(np.array(label_frequency))
-            cand_idx = self.memory.cls_idx[cls_to_replace]
-            score = self.memory.others_loss_decrease[cand_idx]
-            idx_to_replace = cand_idx[np.argmin(score)]
-            self.memory.replace_sample(sample, idx_to_replace)
-            self.dropped_idx.append(idx_to_replace)
-            self.memory_dropped_idx.append(idx_to_replace)
-        else:
-            self.memory.replace_sample(sample)
-            self.dropped_idx.append(len(self.memory) - 1)
-            self.memory_dropped_idx.append(len(self.memory) - 1)
+        slots = self.memory.store(sample).tolist()
+        self.dropped_idx.extend(slots)
+        self.memory_dropped_idx.extend(slots)
 
     def adaptive_lr(self, period=10, min_iter=10, significance=0.05):
         if self.imp_update_counter % self.imp_update_period == 0:
@@ -258,100 +249,3 @@ class CLIB(ER):
                             for param_group in self.optimizer.param_groups:
                                 param_group["lr"] = self.high_lr
                                 param_group["initial_lr"] = self.high_lr
-
-class CLIB(ER):
-    def __init__(self, *args, **kwargs) -> None:
-        super(CLIB, self).__init__(*args, **kwargs)
-
-    def online_step(self, sample, samples_cnt):
-        image, label = sample
-        for l in label:
-            if l.item() not in self.exposed_classes:
-                self.add_new_class(l.item())
-        for img,lbl in zip(image, label):
-            self.update_memory([img, lbl])
-        self.num_updates += self.online_iter * self.batchsize
-        train_loss, train_acc = self.online_train([torch.empty((0,)), torch.empty((0,))], iterations=int(self.num_updates))
-        self.num_updates -= int(self.num_updates)
-        return train_loss, train_acc
-    
-    def update_memory(self, sample):
-        x, y = sample
-        if len(self.memory) >= self.memory_size:
-            label_frequency = copy.deepcopy(self.memory.cls_count)
-            label_frequency[self.exposed_classes.index(y.item())] += 1
-            cls_to_replace = np.argmax(np.array(label_frequency))
-            cand_idx = self.memory.cls_idx[cls_to_replace]
-            score = self.memory.others_loss_decrease[cand_idx]
-            idx_to_replace = cand_idx[np.argmin(score)]
-            self.memory.replace_sample(sample, idx_to_replace)
-            self.dropped_idx.append(idx_to_replace)
-            self.memory_dropped_idx.append(idx_to_replace)
-        else:
-            self.memory.replace_sample(sample)
-            self.dropped_idx.append(len(self.memory) - 1)
-            self.memory_dropped_idx.append(len(self.memory) - 1)
-
-    def online_before_task(self, task_id):
-        pass
-
-    def online_after_task(self, task_id):
-        pass
-
-    def model_forward(self, x, y):
-        do_cutmix = self.cutmix and np.random.rand(1) < 0.5
-        if do_cutmix:
-            x, labels_a, labels_b, lam = cutmix_data(x=x, y=y, alpha=1.0)
-            with torch.cuda.amp.autocast(enabled=self.use_amp):
-                logit = self.model(x)
-                loss = lam * self.criterion(logit, labels_a) + (1 - lam) * self.criterion(logit, labels_b)
-        else:
-            with torch.cuda.amp.autocast(enabled=self.use_amp):
-                logit = self.model(x)
-                loss = self.criterion(logit, y)
-        return logit, loss
-
-    def online_evaluate(self, test_loader):
-        total_correct, total_num_data, total_loss = 0.0, 0.0, 0.0
-        correct_l = torch.zeros(self.n_classes)
-        num_data_l = torch.zeros(self.n_classes)
-        label = []
-
-        self.model.eval()
-        with torch.no_grad():
-            for i, data in enumerate(test_loader):
-                x, y = data
-                for j in range(len(y)):
-                    y[j] = self.exposed_classes.index(y[j].item())
-
-                x = x.to(self.device)
-                y = y.to(self.device)
-
-                logit = self.model(x)
-                loss = self.criterion(logit, y)
-                pred = torch.argmax(logit, dim=-1)
-                _, preds = logit.topk(self.topk, 1, True, True)
-                total_correct += torch.sum(preds == y.unsqueeze(1)).item()
-                total_num_data += y.size(0)
-
-                xlabel_cnt, correct_xlabel_cnt = self._interpret_pred(y, pred)
-                correct_l += correct_xlabel_cnt.detach().cpu()
-                num_data_l += xlabel_cnt.detach().cpu()
-
-                total_loss += loss.item()
-                label += y.tolist()
-
-        avg_acc = total_correct / total_num_data
-        avg_loss = total_loss / len(test_loader)
-        cls_acc = (correct_l / (num_data_l + 1e-5)).numpy().tolist()
-        
-        eval_dict = {"avg_loss": avg_loss, "avg_acc": avg_acc, "cls_acc": cls_acc}
-        return eval_dict
-
-    def update_schedule(self, reset=False):
-        if reset:
-            self.scheduler = select_scheduler(self.sched_name, self.optimizer, self.lr_gamma)
-            for param_group in self.optimizer.param_groups:
-                param_group["lr"] = self.lr
-        else:
-            self.scheduler.step()
\ No newline at end of file
@@ -9,30 +9,42 @@ import torch.nn.functional as F
 import pandas as pd
 from torch.utils.data import DataLoader
 import torchvision.transforms as transforms
-from torch.utils.tensorboard import SummaryWriter
 from scipy.stats import ttest_ind
 
 from methods.er_baseline import ER
 from utils.data_loader import ImageDataset, StreamDataset, MemoryDataset, cutmix_data, get_statistics
 from utils.train_utils import select_model, select_optimizer, select_scheduler
+from utils.batch_augment import transform_batch
+from utils.label_map import LabelMap
+from utils.evaluator import MetricsAccumulator
+from utils.metric import MetricsSink, TrainMetrics
 
 import time
 
 logger = logging.getLogger()
-writer = SummaryWriter("tensorboard")
 
 class CLIB_ViT(ER):
+    memory_policy = "class_balanced_min_score"
+
     def __init__(self, criterion, device, train_transform, test_transform, n_classes, **kwargs):
         
         self.num_learned_class = 0
         self.num_learning_class = 1
         self.n_classes = n_classes
         self.exposed_classes = []
+        self.label_map = LabelMap(self.exposed_classes)
         self.seen = 0
         self.topk = kwargs["topk"]
+        self.report_freq = kwargs["report_freq"]
+        # Stream batches seen by online_step, training is reported every report_freq of them
+        self.stream_batches = 0
+        # Summed over the steps since the last report, flushed by report_training
+        self.train_metrics = TrainMetrics()
 
         self.device = device
         self.dataset = kwargs["dataset"]
+        # The run's sink from main.py, records are dropped without one
+        self.writer = kwargs.get("writer") or MetricsSink()
         self.model_name = kwargs["model_name"]
         self.opt_name = kwargs["opt_name"]
         self.sched_name = kwargs["sched_name"]
@@ -63,8 +75,9 @@ class CLIB_ViT(ER):
         if self.use_amp:
             self.scaler = torch.cuda.amp.GradScaler()
 
+        # The ViT of models/vit.py, its classifier is the fc and it returns the logits
         self.model = select_model(self.model_name, self.dataset, 1).to(self.device)
-        self.optimizer = select_optimizer(self.opt_name, self.lr, self.model, True)
+        self.optimizer = select_optimizer(self.opt_name, self.lr, self.model)
         if 'imagenet' in self.dataset:
             self.lr_gamma = 0.99995
         else:
@@ -73,6 +86,7 @@ class CLIB_ViT(ER):
         self.scheduler = select_scheduler(self.sched_name, self.optimizer, self.lr_gamma)
 
         self.criterion = criterion.to(self.device)
+        self.memory = self.build_memory(self.memory_size, kwargs)
         self.temp_batch = []
         self.temp_label = []
         self.num_updates = 0
@@ -80,8 +94,8 @@ class CLIB_ViT(ER):
         self.batch_size = kwargs["batchsize"]
 
         self.start_time = time.time()
-        num_samples = {'cifar10': 50000, 'cifar100': 50000, 'tinyimagenet': 100000, 'imagenet': 1281167}
-        self.total_samples = num_samples[self.dataset]
+        # Length of the training stream, main.py sets it to train_sampler.stream_size() before the first step
+        self.total_samples = None
 
         self.memory_size = kwargs["memory_size"]
 
@@ -90,8 +104,6 @@ class CLIB_ViT(ER):
         self.dropped_idx = []
         self.memory_dropped_idx = []
         self.imp_update_counter = 0
-        self.memory = MemoryDataset(self.train_transform, cls_list=self.exposed_classes,
-                                    test_transform=self.test_transform, save_test=True, keep_history=True)
         self.imp_update_period = kwargs['imp_update_period']
         if kwargs["sched_name"] == 'default':
             self.sched_name = 'adaptive_lr'
@@ -110,19 +122,23 @@ class CLIB_ViT(ER):
         
         self.convert_li = ['airplane','automobile','bird','cat','deer','dog','frog','horse','ship','truck']
 
+    def build_memory(self, memory_size, kwargs, **options):
+        # The full memory_size, with the test images and loss history of every sample for the importance updates
+        return super().build_memory(kwargs["memory_size"], kwargs, save_test=True, keep_history=True, **options)
+
     def online_step(self, sample, sample_num, n_worker):
         image, label = sample
-        for l in label:
-            if l.item() not in self.exposed_classes:
-                self.add_new_class(l.item())
+        for cls in self.label_map.unseen(label):
+            self.add_new_class(cls)
 
-        for stored_sample, stored_label in zip(image, label):
-            self.update_memory((stored_sample, stored_label))
+        self.update_memory((image, label))
 
         self.num_updates += self.online_iter * self.batch_size
-        train_loss, train_acc = self.online_train([], self.batch_size, n_worker,
-                                                    iterations=int(self.num_updates), stream_batch_size=0)
-        self.report_training(sample_num, train_loss, train_acc)
+        self.online_train([], self.batch_size, n_worker,
+                          iterations=int(self.num_updates), stream_batch_size=0)
+        self.stream_batches += 1
+        if self.stream_batches % self.report_freq == 0:
+            self.report_training(sample_num)
         self.temp_batch = []
         self.num_updates -= int(self.num_updates)
     def update_memory(self, sample):
@@ -130,7 +146,7 @@ class CLIB_ViT(ER):
 
     def online_train(self, sample, batch_size, n_worker, iterations=1, stream_batch_size=0):
 
-        total_loss, correct, num_data = 0.0, 0.0, 0.0
+        metrics = self.train_metrics
         
         if len(self.memory) > 0 and batch_size - stream_batch_size > 0:
             memory_batch_size = min(len(self.memory), batch_size - stream_batch_size)
@@ -139,8 +155,8 @@ class CLIB_ViT(ER):
             self.model.train()
             if len(sample) > 0:
                 x, y = sample
-                x = torch.cat([self.train_transform(transforms.ToPILImage()(img)).unsqueeze(0) for img in x])
-                y = torch.cat([torch.tensor([self.exposed_classes.index(label)]) for label in y])
+                x = transform_batch(x, self.train_transform)
+                y = self.label_map(y)
             if len(self.memory) > 0:
                 if len(sample) > 0:
                     memory_data = self.memory.get_batch(memory_batch_size)
@@ -167,11 +183,9 @@ class CLIB_ViT(ER):
                 self.optimizer.step()
             self.samplewise_loss_update()
 
-            total_loss += loss.item()
-            correct += torch.sum(preds == y.unsqueeze(1)).item()
-            num_data += y.size(0)
+            metrics.update(loss, preds, y)
 
-        return total_loss / iterations, correct / num_data
+        return metrics
 
     def model_forward(self, x, y):
         do_cutmix = self.cutmix and np.random.rand(1) < 0.5
@@ -179,32 +193,32 @@ class CLIB_ViT(ER):
             x, labels_a, labels_b, lam = cutmix_data(x=x, y=y, alpha=1.0)
             if self.use_amp:
                 with torch.cuda.amp.autocast():
-                    logit = self.model(x)['logits']
+                    logit = self.model(x)
                     loss = lam * self.criterion(logit, labels_a) + (1 - lam) * self.criterion(logit, labels_b)
             else:
-                logit = self.model(x)['logits']
+                logit = self.model(x)
                 loss = lam * self.criterion(logit, labels_a) + (1 - lam) * self.criterion(logit, labels_b)
         else:
             if self.use_amp:
                 with torch.cuda.amp.autocast():
-                    logit = self.model(x)['logits']
+                    logit = self.model(x)
                     loss = self.criterion(logit, y)
             else:
-                logit = self.model(x)['logits']
+                logit = self.model(x)
                 loss = self.criterion(logit, y)
         return logit, loss
 
     def add_new_class(self, class_name):
         self.exposed_classes.append(class_name)
         self.num_learned_class = len(self.exposed_classes)
-        prev_weight = copy.deepcopy(self.model.head.weight.data)
-        prev_bias = copy.deepcopy(self.model.head.bias.data)
+        prev_weight = copy.deepcopy(self.model.fc.weight.data)
+        prev_bias = copy.deepcopy(self.model.fc.bias.data)
         self.model.reset_classifier(self.num_learned_class)
 
         with torch.no_grad():
             if self.num_learned_class > 1:
-                self.model.head.weight.data[:self.num_learned_class - 1] = prev_weight
-                self.model.head.bias.data[:self.num_learned_class - 1] = prev_bias
+                self.model.fc.weight.data[:self.num_learned_class - 1] = prev_weight
+                self.model.fc.bias.data[:self.num_learned_class - 1] = prev_bias
         self.model.to(self.device)
         sdict = copy.deepcopy(self.optimizer.state_dict())
         fc_params = sdict['param_groups'][1]['params']
@@ -215,7 +229,7 @@ class CLIB_ViT(ER):
             if param in self.optimizer.state.keys():
                 del self.optimizer.state[param]
         del self.optimizer.param_groups[1]
-        self.optimizer.add_param_group({'params': self.model.head.parameters()})
+        self.optimizer.add_param_group({'params': self.model.fc.parameters()})
         if len(sdict['state']) > 0:
             if 'adam' in self.opt_name:
                 fc_weight = self.optimizer.param_groups[1]['params'][0]
@@ -258,12 +272,12 @@ class CLIB_ViT(ER):
                     if self.use_amp:
                         with torch.cuda.amp.autocast():
                             logit = torch.cat(
-                                [self.model(torch.cat(x[i * batchsize:min((i + 1) * batchsize, len(x))]).to(self.device))['logits']
+                                [self.model(torch.cat(x[i * batchsize:min((i + 1) * batchsize, len(x))]).to(self.device))
                                 for i in range(-(-len(x) // batchsize))], dim=0)
 
                     else:
                         logit = torch.cat(
-                            [self.model(torch.cat(x[i * batchsize:min((i + 1) * batchsize, len(x))]).to(self.device))['logits']
+                            [self.model(torch.cat(x[i * batchsize:min((i + 1) * batchsize, len(x))]).to(self.device))
                              for i in range(-(-len(x) // batchsize))], dim=0)
 
                     loss = F.cross_entropy(logit, y, reduction='none').cpu().numpy()
@@ -272,21 +286,9 @@ class CLIB_ViT(ER):
                 self.loss = loss
 
     def samplewise_importance_memory(self, sample):
-        x, y = sample
-        if len(self.memory.images) >= self.memory_size:
-            label_frequency = copy.deepcopy(self.memory.cls_count)
-            label_frequency[self.exposed_classes.index(y.item())] += 1
-            cls_to_replace = np.argmax(np.array(label_frequency))
-            cand_idx = self.memory.cls_idx[cls_to_replace]
-            score = self.memory.others_loss_decrease[cand_idx]
-            idx_to_replace = cand_idx[np.argmin(score)]
-            self.memory.replace_sample(sample, idx_to_replace)
-            self.dropped_idx.append(idx_to_replace)
-            self.memory_dropped_idx.append(idx_to_replace)
-        else:
-            self.memory.replace_sample(sample)
-            self.dropped_idx.append(len(self.memory) - 1)
-            self.memory_dropped_idx.append(len(self.memory) - 1)
+        slots = self.memory.store(sample).tolist()
+        self.dropped_idx.extend(slots)
+        self.memory_dropped_idx.extend(slots)
 
     def adaptive_lr(self, period=10, min_iter=10, significance=0.05):
         if self.imp_update_counter % self.imp_update_period == 0:
@@ -350,66 +352,24 @@ class CLIB_ViT(ER):
                                 param_group["initial_lr"] = self.high_lr
 
     def evaluation(self, test_loader, criterion):
-        total_correct, total_num_data, total_loss = 0.0, 0.0, 0.0
-        correct_l = torch.zeros(self.n_classes)
-        num_data_l = torch.zeros(self.n_classes)
-        label = []
+        metrics = MetricsAccumulator(self.n_classes, self.topk, self.device)
 
         self.model.eval()
         with torch.no_grad():
             for i, data in enumerate(test_loader):
                 x, y = data
-                for j in range(len(y)):
-                    y[j] = self.exposed_classes.index(y[j].item())
+                y = self.label_map(y)
 
                 x = x.to(self.device)
                 y = y.to(self.device)
 
-                logit = self.model(x)['logits']
+                logit = self.model(x)
                 loss = self.criterion(logit, y)
-                pred = torch.argmax(logit, dim=-1)
-                _, preds = logit.topk(self.topk, 1, True, True)
-                total_correct += torch.sum(preds == y.unsqueeze(1)).item()
-                total_num_data += y.size(0)
+                metrics.update(logit, y, loss)
 
-                xlabel_cnt, correct_xlabel_cnt = self._interpret_pred(y, pred)
-                correct_l += correct_xlabel_cnt.detach().cpu()
-                num_data_l += xlabel_cnt.detach().cpu()
-
-                total_loss += loss.item()
-                label += y.tolist()
-
-        avg_acc = total_correct / total_num_data
-        avg_loss = total_loss / len(test_loader)
-        cls_acc = (correct_l / (num_data_l + 1e-5)).numpy().tolist()
-        
-        ret = {"avg_loss": avg_loss, "avg_acc": avg_acc, "cls_acc": cls_acc}
+        ret = metrics.result()
         return ret
     
-    def online_before_task(self,train_loader,debug):
-        #todo 현재 Task Class 및 Sample 확인
-        data_info = {}
-        for i, data in enumerate(train_loader):
-            # if debug and (i+1)*self.batch_size == 200:
-            #     break
-            _,label = data
-            # image = image.to(self.device)
-            label = label.to(self.device)
-            
-            for b in range(label.shape[0]):
-                if 'Class_'+str(label[b].item()) in data_info.keys():
-                    data_info['Class_'+str(label[b].item())] +=1
-                else:
-                    data_info['Class_'+str(label[b].item())] =1
-        
-        print("Current Task Data Info")
-        print(data_info)
-        print("<<Convert to str>>")
-        convert_data_info = self.convert_class_from_int_to_str(data_info)
-        print(convert_data_info)
-        print()
-        
-
     def train_data_config(self,n_task, train_dataset,train_sampler):
         from torch.utils.data import DataLoader
         for t_i in range(n_task):
@@ -10,18 +10,20 @@ import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
 import torchvision.transforms as transforms
-from torch.utils.tensorboard import SummaryWriter
 from torch import optim
 
 from utils.data_loader import ImageDataset, StreamDataset, MemoryDataset, cutmix_data, get_statistics
 from utils.train_utils import select_model, select_optimizer, select_scheduler
+from utils.batch_augment import transform_batch
+from utils.evaluator import MetricsAccumulator, evaluate, interpret_pred
 
 import torchvision.transforms as transforms
 from methods._trainer import _Trainer
+from utils.label_map import LabelMap
+from utils.metric import MetricsSink, TrainMetrics
 
 
 logger = logging.getLogger()
-writer = SummaryWriter("tensorboard")
 
 
 def cycle(iterable):
@@ -31,6 +33,8 @@ def cycle(iterable):
             yield i
 
 class ER:
+    memory_policy = "reservoir"
+
     def __init__(
             self, criterion, device, train_transform, test_transform, n_classes, **kwargs
     ):
@@ -38,11 +42,19 @@ class ER:
         self.num_learning_class = 1
         self.n_classes = n_classes
         self.exposed_classes = []
+        self.label_map = LabelMap(self.exposed_classes)
         self.seen = 0
         self.topk = kwargs["topk"]
+        self.report_freq = kwargs["report_freq"]
+        # Stream batches seen by online_step, training is reported every report_freq of them
+        self.stream_batches = 0
+        # Summed over the steps since the last report, flushed by report_training
+        self.train_metrics = TrainMetrics()
 
         self.device = device
         self.dataset = kwargs["dataset"]
+        # The run's sink from main.py, records are dropped without one
+        self.writer = kwargs.get("writer") or MetricsSink()
         self.model_name = kwargs["model_name"]
         self.opt_name = kwargs["opt_name"]
         self.sched_name = kwargs["sched_name"]
@@ -83,8 +95,7 @@ class ER:
         self.scheduler = select_scheduler(self.sched_name, self.optimizer, self.lr_gamma)
 
         self.criterion = criterion.to(self.device)
-        self.memory = MemoryDataset(self.train_transform, cls_list=self.exposed_classes,
-                                    test_transform=self.test_transform)
+        self.memory = self.build_memory(self.memory_size, kwargs)
         self.temp_batch = []
         self.temp_label = []
         self.num_updates = 0
@@ -92,21 +103,33 @@ class ER:
         self.batch_size = kwargs["batchsize"]
 
         self.start_time = time.time()
-        num_samples = {'cifar10': 50000, 'cifar100': 50000, 'tinyimagenet': 100000, 'imagenet': 1281167}
-        self.total_samples = num_samples[self.dataset]
+        # Length of the training stream, main.py sets it to train_sampler.stream_size() before the first step
+        self.total_samples = None
+
+    def build_memory(self, memory_size, kwargs, **options):
+        # Methods that keep another size or more per sample override this instead of replacing self.memory,
+        # so no prefetcher is started for a memory that is thrown away
+        memory = MemoryDataset(self.train_transform, cls_list=self.exposed_classes,
+                               test_transform=self.test_transform, memory_size=memory_size,
+                               policy=self.memory_policy, storage=kwargs["memory_storage"],
+                               storage_dir=kwargs["memory_dir"], cache_size=kwargs["memory_cache_size"],
+                               decode_workers=kwargs["memory_decode_workers"], **options)
+        if kwargs["replay_workers"] > 0:
+            memory.enable_prefetch(kwargs["replay_workers"], kwargs["replay_prefetch"])
+        return memory
 
     def online_step(self, sample, sample_num, n_worker):
         image, label = sample
-        for l in label:
-            if l.item() not in self.exposed_classes:
-                self.add_new_class(l.item())
+        for cls in self.label_map.unseen(label):
+            self.add_new_class(cls)
 
         self.num_updates += self.online_iter * self.batch_size
-        train_loss, train_acc = self.online_train([image, label], self.batch_size * 2, n_worker,
-                                                    iterations=int(self.num_updates), stream_batch_size=self.batch_size)
-        self.report_training(sample_num, train_loss, train_acc)
-        for stored_sample, stored_label in zip(image, label):
-            self.update_memory((stored_sample, stored_label))
+        self.online_train([image, label], self.batch_size * 2, n_worker,
+                          iterations=int(self.num_updates), stream_batch_size=self.batch_size)
+        self.stream_batches += 1
+        if self.stream_batches % self.report_freq == 0:
+            self.report_training(sample_num)
+        self.update_memory((image, label))
         self.temp_batch = []
         self.num_updates -= int(self.num_updates)
 
@@ -129,7 +152,7 @@ class ER:
             self.update_schedule(reset=True)
 
     def online_train(self, sample, batch_size, n_worker, iterations=1, stream_batch_size=1):
-        total_loss, correct, num_data = 0.0, 0.0, 0.0
+        metrics = self.train_metrics
         # sample = self.train_transform(sample)
 
         # if stream_batch_size > 0:
@@ -142,9 +165,7 @@ class ER:
             self.model.train()
             # x = []
             # y = []
-            x, y = sample
-            x = torch.cat([self.train_transform(transforms.ToPILImage()(img)).unsqueeze(0) for img in x])
-            y = torch.cat([torch.tensor([self.exposed_classes.index(label.item())]) for label in y])
+            x, y = self.stream_batch(sample)
             # if stream_batch_size > 0:
             #     # sample = sample_dataset.get_data()
             #     x.append(sample['image'])
@@ -177,11 +198,14 @@ class ER:
 
             self.update_schedule()
 
-            total_loss += loss.item()
-            correct += torch.sum(preds == y.unsqueeze(1)).item()
-            num_data += y.size(0)
+            metrics.update(loss, preds, y)
+
+        return metrics
 
-        return total_loss / iterations, correct / num_data
+    def stream_batch(self, sample):
+        # Stream part of a training batch, transformed as a whole and with labels mapped to the exposed classes
+        x, y = sample
+        return transform_batch(x, self.train_transform), self.label_map(y)
 
     def model_forward(self, x, y):
         do_cutmix = self.cutmix and np.random.rand(1) < 0.5
@@ -204,9 +228,13 @@ class ER:
                 loss = self.criterion(logit, y)
         return logit, loss
 
-    def report_training(self, sample_num, train_loss, train_acc):
-        writer.add_scalar(f"train/loss", train_loss, sample_num)
-        writer.add_scalar(f"train/acc", train_acc, sample_num)
+    def report_training(self, sample_num):
+        # Reports the training loss and accuracy of the steps since the last report
+        metrics = self.train_metrics.flush()
+        if metrics is None:
+            return
+        train_loss, train_acc = metrics
+        self.writer.log("train", sample_num, loss=train_loss, acc=train_acc)
         logger.info(
             f"Train | Sample # {sample_num} | train_loss {train_loss:.4f} | train_acc {train_acc:.4f} | "
             f"lr {self.optimizer.param_groups[0]['lr']:.6f} | "
@@ -215,8 +243,7 @@ class ER:
         )
 
     def report_test(self, sample_num, avg_loss, avg_acc):
-        writer.add_scalar(f"test/loss", avg_loss, sample_num)
-        writer.add_scalar(f"test/acc", avg_acc, sample_num)
+        self.writer.log("test", sample_num, loss=avg_loss, acc=avg_acc)
         logger.info(
             f"Test | Sample # {sample_num} | test_loss {avg_loss:.4f} | test_acc {avg_acc:.4f} | "
         )
@@ -246,13 +273,7 @@ class ER:
         pass
 
     def reservoir_memory(self, sample):
-        self.seen += 1
-        if len(self.memory.images) >= self.memory_size:
-            j = np.random.randint(0, self.seen)
-            if j < self.memory_size:
-                self.memory.replace_sample(sample, j)
-        else:
-            self.memory.replace_sample(sample)
+        self.memory.store(sample)
 
     def reset_opt(self):
         self.optimizer = select_optimizer(self.opt_name, self.lr, self.model)
@@ -260,83 +281,45 @@ class ER:
         self.scheduler = select_scheduler(self.sched_name, self.optimizer, self.lr_gamma)
 
     def evaluation(self, test_loader, criterion):
-        total_correct, total_num_data, total_loss = 0.0, 0.0, 0.0
-        correct_l = torch.zeros(self.n_classes)
-        num_data_l = torch.zeros(self.n_classes)
-        label = []
+        metrics = MetricsAccumulator(self.n_classes, self.topk, self.device)
 
         self.model.eval()
         with torch.no_grad():
             for i, data in enumerate(test_loader):
                 x, y = data
-                for j in range(len(y)):
-                    y[j] = self.exposed_classes.index(y[j].item())
+                y = self.label_map(y)
 
                 x = x.to(self.device)
                 y = y.to(self.device)
 
                 logit = self.model(x)
                 loss = criterion(logit, y)
-                pred = torch.argmax(logit, dim=-1)
-                _, preds = logit.topk(self.topk, 1, True, True)
-                total_correct += torch.sum(preds == y.unsqueeze(1)).item()
-                total_num_data += y.size(0)
-
-                xlabel_cnt, correct_xlabel_cnt = self._interpret_pred(y, pred)
-                correct_l += correct_xlabel_cnt.detach().cpu()
-                num_data_l += xlabel_cnt.detach().cpu()
+                metrics.update(logit, y, loss)
 
-                total_loss += loss.item()
-                label += y.tolist()
-
-        avg_acc = total_correct / total_num_data
-        avg_loss = total_loss / len(test_loader)
-        cls_acc = (correct_l / (num_data_l + 1e-5)).numpy().tolist()
-        
-        ret = {"avg_loss": avg_loss, "avg_acc": avg_acc, "cls_acc": cls_acc}
+        ret = metrics.result()
         return ret
 
     def _interpret_pred(self, y, pred):
         # xlable is batch
-        ret_num_data = torch.zeros(self.n_classes)
-        ret_corrects = torch.zeros(self.n_classes)
-
-        xlabel_cls, xlabel_cnt = y.unique(return_counts=True)
-        for cls_idx, cnt in zip(xlabel_cls, xlabel_cnt):
-            ret_num_data[cls_idx] = cnt
-
-        correct_xlabel = y.masked_select(y == pred)
-        correct_cls, correct_cnt = correct_xlabel.unique(return_counts=True)
-        for cls_idx, cnt in zip(correct_cls, correct_cnt):
-            ret_corrects[cls_idx] = cnt
+        return interpret_pred(y, pred, self.n_classes)
 
-        return ret_num_data, ret_corrects
 
-
-class ER(_Trainer):
+class ERTrainer(_Trainer):
     def __init__(self, *args, **kwargs) -> None:
-        super(ER, self).__init__(*args, **kwargs)
+        super(ERTrainer, self).__init__(*args, **kwargs)
 
     def online_step(self, sample, samples_cnt):
         image, label = sample
-        for l in label:
-            if l.item() not in self.exposed_classes:
-                self.add_new_class(l.item())
+        for cls in self.label_map.unseen(label):
+            self.add_new_class(cls)
         self.num_updates += self.online_iter * self.batchsize
-        train_loss, train_acc = self.online_train([image, label], iterations=int(self.num_updates))
-        for img,lbl in zip(image, label):
-            self.update_memory([img, lbl])
+        self.online_train([image, label], iterations=int(self.num_updates))
+        with self.profiler.phase("update_memory"):
+            self.update_memory((image, label))
         self.num_updates -= int(self.num_updates)
-        return train_loss, train_acc
     
     def update_memory(self, sample):
-        self.seen += 1
-        if len(self.memory) >= self.memory_size:
-            j = np.random.randint(0, self.seen)
-            if j < self.memory_size:
-                self.memory.replace_data(sample, j)
-        else:
-            self.memory.replace_data(sample)
+        self.memory.store(sample)
 
     def online_before_task(self, task_id):
         pass
@@ -345,39 +328,36 @@ class ER(_Trainer):
         pass
     
     def online_train(self, data, iterations):
+        # The loss and accuracy go to self.train_metrics and are read back when they are reported
         self.model.train()
-        total_loss, total_correct, total_num_data = 0.0, 0.0, 0.0
         image, label = data
-        for j in range(len(label)):
-            label[j] = self.exposed_classes.index(label[j].item())
+        label = self.label_map(label)
         for i in range(iterations):
             x = image.detach().clone()
             y = label.detach().clone()
+            with self.profiler.phase("augmentation"):
+                x = transform_batch(x.to(self.device) if self.gpu_transform else x, self.train_transform)
             if len(self.memory) > 0 and self.memory_batchsize > 0:
                 memory_batchsize = min(self.memory_batchsize, len(self.memory))
-                memory_images, memory_labels = self.memory.get_batch(memory_batchsize)
-                x = torch.cat([x, memory_images], dim=0)
+                with self.profiler.phase("memory_sampling"):
+                    memory_images, memory_labels = self.memory.get_batch(memory_batchsize, transform=self.train_transform)
+                x = torch.cat([x, memory_images.to(x.device)], dim=0)
                 y = torch.cat([y, memory_labels], dim=0)
-            
-            x = torch.cat([self.train_transform(transforms.ToPILImage()(_x)).unsqueeze(0) for _x in x])
 
             x = x.to(self.device)
             y = y.to(self.device)
 
-            self.optimizer.zero_grad()
-            logit, loss = self.model_forward(x,y)
-            _, preds = logit.topk(self.topk, 1, True, True)
-           
-            self.scaler.scale(loss).backward()
-            self.scaler.step(self.optimizer)
-            self.scaler.update()
-            self.update_schedule()
+            with self.profiler.phase("forward_backward"):
+                self.optimizer.zero_grad()
+                logit, loss = self.model_forward(x,y)
+                _, preds = logit.topk(self.topk, 1, True, True)
 
-            total_loss += loss.item()
-            total_correct += torch.sum(preds == y.unsqueeze(1)).item()
-            total_num_data += y.size(0)
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.update_schedule()
 
-        return total_loss / iterations, total_correct / total_num_data
+            self.train_metrics.update(loss, preds, y)
 
     def model_forward(self, x, y):
         do_cutmix = self.cutmix and np.random.rand(1) < 0.5
@@ -393,41 +373,7 @@ class ER(_Trainer):
         return logit, loss
 
     def online_evaluate(self, test_loader):
-        total_correct, total_num_data, total_loss = 0.0, 0.0, 0.0
-        correct_l = torch.zeros(self.n_classes)
-        num_data_l = torch.zeros(self.n_classes)
-        label = []
-
-        self.model.eval()
-        with torch.no_grad():
-            for i, data in enumerate(test_loader):
-                x, y = data
-                for j in range(len(y)):
-                    y[j] = self.exposed_classes.index(y[j].item())
-
-                x = x.to(self.device)
-                y = y.to(self.device)
-
-                logit = self.model(x)
-                loss = self.criterion(logit, y)
-                pred = torch.argmax(logit, dim=-1)
-                _, preds = logit.topk(self.topk, 1, True, True)
-                total_correct += torch.sum(preds == y.unsqueeze(1)).item()
-                total_num_data += y.size(0)
-
-                xlabel_cnt, correct_xlabel_cnt = self._interpret_pred(y, pred)
-                correct_l += correct_xlabel_cnt.detach().cpu()
-                num_data_l += xlabel_cnt.detach().cpu()
-
-                total_loss += loss.item()
-                label += y.tolist()
-
-        avg_acc = total_correct / total_num_data
-        avg_loss = total_loss / len(test_loader)
-        cls_acc = (correct_l / (num_data_l + 1e-5)).numpy().tolist()
-        
-        eval_dict = {"avg_loss": avg_loss, "avg_acc": avg_acc, "cls_acc": cls_acc}
-        return eval_dict
+        return evaluate(self.model, test_loader, self.exposed_classes, self.criterion, self.topk, self.n_classes, self.device)
 
     def update_schedule(self, reset=False):
         if reset:
@@ -11,14 +11,12 @@ import torch
 import torch.nn as nn
 import pandas as pd
 from torch.utils.data import DataLoader
-from torch.utils.tensorboard import SummaryWriter
 
 from methods.er_baseline import ER
-from utils.data_loader import cutmix_data, ImageDataset, StreamDataset
+from utils.data_loader import cutmix_data, ImageDataset
 from utils.train_utils import cycle
 
 logger = logging.getLogger()
-writer = SummaryWriter("tensorboard")
 
 
 class EWCpp(ER):
@@ -86,11 +84,7 @@ class EWCpp(ER):
 
     def online_train(self, sample, batch_size, n_worker, iterations=1, stream_batch_size=1):
         self.model.train()
-        total_loss, correct, num_data = 0.0, 0.0, 0.0
-        if stream_batch_size > 0:
-            sample_dataset = StreamDataset(sample, dataset=self.dataset, transform=self.train_transform,
-                                           cls_list=self.exposed_classes, data_dir=self.data_dir, device=self.device,
-                                           transform_on_gpu=self.gpu_transform)
+        metrics = self.train_metrics
         if len(self.memory) > 0 and batch_size - stream_batch_size > 0:
             memory_batch_size = min(len(self.memory), batch_size - stream_batch_size)
 
@@ -99,9 +93,9 @@ class EWCpp(ER):
             x = []
             y = []
             if stream_batch_size > 0:
-                stream_data = sample_dataset.get_data()
-                x.append(stream_data['image'])
-                y.append(stream_data['label'])
+                stream_x, stream_y = self.stream_batch(sample)
+                x.append(stream_x)
+                y.append(stream_y)
             if len(self.memory) > 0 and batch_size - stream_batch_size > 0:
                 memory_data = self.memory.get_batch(memory_batch_size)
                 x.append(memory_data['image'])
@@ -141,11 +135,9 @@ class EWCpp(ER):
             }
             self.update_fisher_and_score(new_params, old_params, new_grads, old_grads)
             _, preds = logit.topk(self.topk, 1, True, True)
-            total_loss += loss.item()
-            correct += torch.sum(preds == y.unsqueeze(1)).item()
-            num_data += y.size(0)
+            metrics.update(loss, preds, y)
 
-        return total_loss / iterations, correct / num_data
+        return metrics
 
     def online_after_task(self, cur_iter):
         # 2.Backup the weight of current task
@@ -8,13 +8,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 import pandas as pd
 from torch.utils.data import DataLoader
-from torch.utils.tensorboard import SummaryWriter
 
 from methods.er_baseline import ER
-from utils.data_loader import cutmix_data, ImageDataset, StreamDataset
+from utils.data_loader import cutmix_data, ImageDataset
 
 logger = logging.getLogger()
-writer = SummaryWriter("tensorboard")
 
 class MIR(ER):
     def __init__(
@@ -27,16 +25,11 @@ class MIR(ER):
 
     def online_train(self, sample, batch_size, n_worker, iterations=1, stream_batch_size=1):
         self.model.train()
-        total_loss, correct, num_data = 0.0, 0.0, 0.0
+        metrics = self.train_metrics
         assert stream_batch_size > 0
-        sample_dataset = StreamDataset(sample, dataset=self.dataset, transform=self.train_transform,
-                                       cls_list=self.exposed_classes, data_dir=self.data_dir, device=self.device,
-                                       transform_on_gpu=self.gpu_transform)
 
         for i in range(iterations):
-            stream_data = sample_dataset.get_data()
-            str_x = stream_data['image']
-            str_y = stream_data['label']
+            str_x, str_y = self.stream_batch(sample)
             x = str_x.to(self.device)
             y = str_y.to(self.device)
             logit = self.model(x)
@@ -95,8 +88,6 @@ class MIR(ER):
                 self.optimizer.step()
             self.update_schedule()
 
-            total_loss += loss.item()
-            correct += torch.sum(preds == y.unsqueeze(1)).item()
-            num_data += y.size(0)
+            metrics.update(loss, preds, y)
 
-        return total_loss / iterations, correct / num_data
\ No newline at end of file
+        return metrics
\ No newline at end of file
@@ -7,7 +7,6 @@ import torch
 import torch.nn as nn
 from torch import optim
 from torch.utils.data import DataLoader
-from torch.utils.tensorboard import SummaryWriter
 from utils.augment import Cutout, Invert, Solarize, select_autoaugment
 from torchvision import transforms
 from randaugment.randaugment import RandAugment
@@ -16,8 +15,8 @@ from methods.er_baseline import ER
 from utils.data_loader import cutmix_data, ImageDataset
 from utils.augment import Cutout, Invert, Solarize, select_autoaugment
 from utils.train_utils import select_model, select_optimizer, select_scheduler
+from utils.metric import TrainMetrics
 logger = logging.getLogger()
-writer = SummaryWriter("tensorboard")
 
 
 def cycle(iterable):
@@ -28,6 +27,8 @@ def cycle(iterable):
 
 
 class RM(ER):
+    memory_policy = "class_balanced_random"
+
     def __init__(
         self, criterion, device, train_transform, test_transform, n_classes, **kwargs
     ):
@@ -43,18 +44,18 @@ class RM(ER):
     
     def online_step(self, sample, sample_num, n_worker):
         image, label = sample
-        for l in label:
-            if l.item() not in self.exposed_classes:
-                self.add_new_class(l.item())
-                print(self.exposed_classes)
+        for cls in self.label_map.unseen(label):
+            self.add_new_class(cls)
+            print(self.exposed_classes)
 
         self.num_updates += self.online_iter * self.batch_size
         # if len(self.temp_batch) == self.temp_batchsize:
-        train_loss, train_acc = self.online_train([image, label], self.batch_size * 2, n_worker,
-                                                    iterations=int(self.num_updates), stream_batch_size=self.batch_size)
-        self.report_training(sample_num, train_loss, train_acc)
-        for stored_sample, stored_label in zip(image, label):
-            self.update_memory((stored_sample, stored_label))
+        self.online_train([image, label], self.batch_size * 2, n_worker,
+                          iterations=int(self.num_updates), stream_batch_size=self.batch_size)
+        self.stream_batches += 1
+        if self.stream_batches % self.report_freq == 0:
+            self.report_training(sample_num)
+        self.update_memory((image, label))
         self.temp_batch = []
         self.num_updates -= int(self.num_updates)
 
@@ -71,15 +72,7 @@ class RM(ER):
         self.reset_opt()
 
     def update_memory(self, sample):
-        x,y = sample
-        if len(self.memory.images) >= self.memory_size:
-            label_frequency = copy.deepcopy(self.memory.cls_count)
-            label_frequency[self.exposed_classes.index(y.item())] += 1
-            cls_to_replace = np.argmax(np.array(label_frequency))
-            idx_to_replace = np.random.choice(self.memory.cls_idx[cls_to_replace])
-            self.memory.replace_sample(sample, idx_to_replace)
-        else:
-            self.memory.replace_sample(sample)
+        self.memory.store(sample)
 
     def online_before_task(self, cur_iter):
         self.reset_opt()
@@ -128,7 +121,7 @@ class RM(ER):
                     param_group["lr"] = self.lr
             else:  # Aand go!
                 self.scheduler.step()
-            total_loss, correct, num_data = 0.0, 0.0, 0.0
+            metrics = TrainMetrics()
 
             idxlist = mem_dataset.generate_idx(batch_size)
             for idx in idxlist:
@@ -154,12 +147,9 @@ class RM(ER):
                     loss.backward()
                     torch.nn.utils.clip_grad_norm_(self.model.parameters(), 10)
                     self.optimizer.step()
-                total_loss += loss.item()
-                correct += torch.sum(preds == y.unsqueeze(1)).item()
-                num_data += y.size(0)
+                metrics.update(loss, preds, y)
                 
-            n_batches = len(idxlist)
-            train_loss, train_acc = total_loss / n_batches, correct / num_data
+            train_loss, train_acc = metrics.flush()
             logger.info(
                 f"Task {cur_iter} | Epoch {epoch + 1}/{n_epoch} | train_loss {train_loss:.4f} | train_acc {train_acc:.4f} | "
                 f"lr {self.optimizer.param_groups[0]['lr']:.4f}"
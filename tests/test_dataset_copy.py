@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Subset
+from torchvision import transforms
+
+from datasets._DatasetCopy import _DatasetCopy
+
+
+class Pixels(Dataset):
+    def __init__(self, num, num_classes, seed=0) -> None:
+        # Float images in [0, 1], not all of them multiples of 1/255
+        rng = np.random.RandomState(seed)
+        self.images = torch.from_numpy(rng.rand(num, 3, 5, 5).astype(np.float32))
+        self.images[:num // 2] = torch.from_numpy(rng.randint(0, 256, size=(num // 2, 3, 5, 5)).astype(np.float32) / 255)
+        self.targets = rng.randint(0, num_classes, size=num).tolist()
+        self.classes = [f"class_{cls}" for cls in range(num_classes)]
+        self.reads = 0
+
+    def __getitem__(self, index):
+        self.reads += 1
+        return self.images[index], self.targets[index]
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def baseline_item(dataset, index, transform):
+    # The copy kept the float images and went through PIL on every access
+    image, label = dataset[index]
+    return transform(transforms.ToPILImage()(image)), label
+
+
+def test_copy_hands_out_what_the_pil_round_trip_did():
+    dataset = Pixels(600, 4)
+    copy = _DatasetCopy(dataset, num_workers=0)
+    assert copy.data.dtype == torch.uint8 and copy.data.shape == (600, 3, 5, 5)
+    assert len(copy) == 600 and copy.classes == dataset.classes
+    for index in range(len(dataset)):
+        image, label = copy[index]
+        expected, expected_label = baseline_item(dataset, index, transforms.ToTensor())
+        assert torch.equal(image, expected)
+        assert int(label) == expected_label
+
+
+def test_copy_applies_tensor_transforms():
+    dataset = Pixels(20, 2)
+    flip = transforms.RandomHorizontalFlip(p=1.0)
+    copy = _DatasetCopy(dataset, transform=flip, num_workers=0)
+    for index in range(len(dataset)):
+        expected, _ = baseline_item(dataset, index, transforms.Compose([flip, transforms.ToTensor()]))
+        assert torch.equal(copy[index][0], expected)
+
+
+def test_copy_of_a_subset_takes_the_classes_of_its_dataset():
+    dataset = Pixels(50, 3)
+    subset = Subset(dataset, list(range(10, 40, 3)))
+    copy = _DatasetCopy(subset, num_workers=0)
+    assert copy.classes == dataset.classes
+    assert copy.targets.tolist() == [dataset.targets[i] for i in subset.indices]
+
+
+def test_saved_copy_is_mapped_instead_of_read_again(tmp_path):
+    path = str(tmp_path / "copies" / "pixels_train")
+    dataset = Pixels(300, 5)
+    built = _DatasetCopy(dataset, num_workers=0, path=path)
+    assert sorted(os.listdir(tmp_path / "copies")) == ["pixels_train_images.npy", "pixels_train_targets.npy"]
+
+    reads = dataset.reads
+    loaded = _DatasetCopy(dataset, num_workers=0, path=path)
+    # Only the classes are taken from the dataset
+    assert dataset.reads == reads
+    assert torch.equal(loaded.data, built.data) and torch.equal(loaded.targets, built.targets)
+    assert all(torch.equal(loaded[index][0], built[index][0]) for index in range(len(dataset)))
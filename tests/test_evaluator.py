@@ -0,0 +1,89 @@
+import pickle
+
+import numpy as np
+import pytest
+import torch
+from torch import nn
+from torch.utils.data import Dataset
+from torchvision import transforms
+
+# The module is imported whole, pytest would collect its test_loader and TestSetCache
+from utils import evaluator
+from utils.onlinesampler import OnlineTestSampler
+
+
+class Pixels(Dataset):
+    def __init__(self, num, num_classes, transform=None, seed=0) -> None:
+        # ToTensor images, uint8 pixels divided by 255, followed by `transform`
+        rng = np.random.RandomState(seed)
+        self.pixels = torch.from_numpy(rng.randint(0, 256, size=(num, 3, 6, 6)).astype(np.uint8))
+        self.targets = rng.randint(0, num_classes, size=num).tolist()
+        self.classes = list(range(num_classes))
+        self.transform = transform
+
+    def __getitem__(self, index):
+        image = self.pixels[index].float().div(255)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[index]
+
+    def __len__(self):
+        return len(self.targets)
+
+
+NORMALIZE = transforms.Normalize((0.5, 0.4, 0.3), (0.2, 0.25, 0.3))
+
+
+def run_evaluation(dataset, test_set, exposed_classes):
+    # Batches handed out for the exposed classes and the metrics of a fixed model on them
+    sampler = OnlineTestSampler(dataset, [])
+    loader = evaluator.test_loader(test_set, sampler, exposed_classes, 16, 0)
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Flatten(), nn.Linear(3 * 6 * 6, len(exposed_classes)))
+    return list(loader), evaluator.evaluate(model, loader, exposed_classes, nn.CrossEntropyLoss(), 1, len(dataset.classes), "cpu")
+
+
+def assert_same_evaluation(expected, cached, exact=True):
+    (expected_batches, expected_metrics), (cached_batches, cached_metrics) = expected, cached
+    assert len(cached_batches) == len(expected_batches)
+    for (x, y), (cached_x, cached_y) in zip(expected_batches, cached_batches):
+        assert torch.equal(cached_y, y)
+        if exact:
+            assert torch.equal(cached_x, x)
+        else:
+            torch.testing.assert_close(cached_x, x)
+    assert cached_metrics["avg_acc"] == expected_metrics["avg_acc"]
+    assert cached_metrics["avg_loss"] == pytest.approx(expected_metrics["avg_loss"], rel=1e-6)
+    np.testing.assert_allclose(cached_metrics["cls_acc"], expected_metrics["cls_acc"])
+
+
+@pytest.mark.parametrize("storage", ["ram", "disk"])
+def test_cache_evaluates_like_the_dataset(storage, tmp_path):
+    dataset = Pixels(150, 6, transform=NORMALIZE)
+    cache = evaluator.TestSetCache(dataset, storage=storage, storage_dir=str(tmp_path), batch_size=32)
+    for exposed in ([2], [2, 5, 0], [2, 5, 0, 1, 4, 3]):
+        assert_same_evaluation(run_evaluation(dataset, dataset, exposed), run_evaluation(dataset, cache, exposed))
+
+
+@pytest.mark.parametrize("storage", ["ram", "disk"])
+def test_uint8_cache_normalizes_like_the_dataset(storage, tmp_path):
+    # The cache keeps the ToTensor images as uint8 and normalizes the batches it reads
+    dataset = Pixels(150, 6, transform=NORMALIZE)
+    cache = evaluator.TestSetCache(Pixels(150, 6), storage=storage, storage_dir=str(tmp_path), normalize=NORMALIZE)
+    assert cache.images.dtype == torch.uint8
+    for exposed in ([4, 1], [4, 1, 3, 0, 2, 5]):
+        assert_same_evaluation(run_evaluation(dataset, dataset, exposed), run_evaluation(dataset, cache, exposed), exact=False)
+
+
+def test_uint8_cache_refuses_normalized_images():
+    with pytest.raises(ValueError):
+        evaluator.TestSetCache(Pixels(20, 3, transform=NORMALIZE), storage="ram", normalize=NORMALIZE)
+
+
+def test_disk_cache_is_mapped_again_when_unpickled(tmp_path):
+    dataset = Pixels(40, 3, transform=NORMALIZE)
+    cache = evaluator.TestSetCache(dataset, storage="disk", storage_dir=str(tmp_path))
+    copy = pickle.loads(pickle.dumps(cache))
+    assert copy.path == cache.path
+    assert torch.equal(copy.images, cache.images)
+    assert_same_evaluation(run_evaluation(dataset, cache, [0, 2]), run_evaluation(dataset, copy, [0, 2]))
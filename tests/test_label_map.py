@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import torch
+
+from utils.label_map import LabelMap
+
+
+def test_remap_matches_list_index_as_classes_are_exposed():
+    rng = np.random.RandomState(0)
+    exposed = []
+    label_map = LabelMap(exposed)
+    for cls in rng.permutation(50).tolist():
+        exposed.append(cls)
+        labels = rng.choice(exposed, size=64)
+        expected = [exposed.index(label) for label in labels.tolist()]
+        assert label_map(torch.from_numpy(labels)).tolist() == expected
+        assert label_map(labels).tolist() == expected
+        assert label_map(labels.tolist()).tolist() == expected
+
+
+def test_remap_keeps_the_type_of_its_input():
+    label_map = LabelMap([4, 2])
+    remapped = label_map(torch.tensor([2, 4], dtype=torch.int32))
+    assert remapped.dtype == torch.long and remapped.tolist() == [1, 0]
+    remapped = label_map(np.array([2, 4]))
+    assert isinstance(remapped, np.ndarray) and remapped.tolist() == [1, 0]
+
+
+def test_classes_not_exposed_map_to_minus_one():
+    label_map = LabelMap([10, 3])
+    assert label_map(torch.tensor([3, 5, 10, 0])).tolist() == [1, -1, 0, -1]
+
+
+def test_unseen_matches_a_list_scan():
+    rng = np.random.RandomState(1)
+    exposed = []
+    label_map = LabelMap(exposed)
+    for _ in range(30):
+        labels = rng.randint(0, 40, size=16)
+        expected = []
+        for label in labels.tolist():
+            if label not in exposed and label not in expected:
+                expected.append(label)
+        assert label_map.unseen(torch.from_numpy(labels)) == expected
+        # Methods expose the new classes one after the other, the table follows the shared list
+        for cls in expected:
+            exposed.append(cls)
+            assert label_map.unseen([cls]) == []
+    assert label_map(torch.tensor(exposed)).tolist() == list(range(len(exposed)))
+
+
+def test_table_is_rebuilt_when_the_list_is_cut_back():
+    exposed = [5, 1, 7]
+    label_map = LabelMap(exposed)
+    assert label_map([7]).tolist() == [2]
+    del exposed[1:]
+    exposed.append(7)
+    assert label_map(torch.tensor([5, 1, 7])).tolist() == [0, -1, 1]
+    assert label_map.unseen([1, 7]) == [1]
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs CUDA")
+def test_remap_stays_on_the_device_of_the_labels():
+    exposed = [3, 0]
+    label_map = LabelMap(exposed)
+    assert label_map(torch.tensor([0, 3], device="cuda")).device.type == "cuda"
+    exposed.append(9)
+    assert label_map(torch.tensor([9], device="cuda")).tolist() == [2]
@@ -0,0 +1,90 @@
+import os
+import time
+
+import numpy as np
+from PIL import Image
+from torchvision.datasets import ImageFolder
+
+from datasets._manifest import Manifest, ManifestFolder
+
+
+def make_folder(root, counts):
+    # An image folder with counts[c] tiny PNGs in class_<c>
+    for cls, count in enumerate(counts):
+        os.makedirs(os.path.join(root, f"class_{cls}"), exist_ok=True)
+        for i in range(count):
+            Image.new("RGB", (2, 2), (cls, i, 0)).save(os.path.join(root, f"class_{cls}", f"{i:03d}.png"))
+
+
+def touch_later(path):
+    # A new file a clock tick after the folder was stamped, even on file systems with coarse mtimes
+    time.sleep(0.01)
+    Image.new("RGB", (2, 2)).save(path)
+
+
+def test_manifest_round_trips_samples(tmp_path):
+    root = str(tmp_path / "data")
+    samples = [(os.path.join(root, "a", "1.png"), 0), (os.path.join(root, "b", "é.png"), 1), ("/elsewhere/2.png", 1)]
+    manifest = Manifest.from_samples(root, samples)
+    assert len(manifest) == 3
+    assert list(manifest) == samples
+    assert manifest[1] == samples[1]
+    assert manifest.labels.dtype == np.int64 and manifest.labels.tolist() == [0, 1, 1]
+    assert manifest.leaves() == sorted({"a", "b", "/elsewhere"})
+
+
+def test_manifest_folder_lists_what_image_folder_lists(tmp_path):
+    root = str(tmp_path / "data")
+    make_folder(root, [3, 5, 2])
+    expected = ImageFolder(root)
+    built = ManifestFolder(root, cache_dir=str(tmp_path / "cache"))
+    loaded = ManifestFolder(root, cache_dir=str(tmp_path / "cache"))
+    for dataset in (built, ManifestFolder(root), loaded):
+        assert dataset.classes == expected.classes
+        assert list(dataset.samples) == expected.samples
+        assert list(dataset.targets) == expected.targets
+        assert len(dataset) == len(expected)
+        assert dataset[4][1] == expected[4][1]
+    # The second construction maps the saved arrays instead of walking the folder
+    assert isinstance(loaded.samples.labels, np.memmap)
+
+
+def test_manifest_is_rebuilt_when_the_folder_changes(tmp_path):
+    root = str(tmp_path / "data")
+    cache_dir = str(tmp_path / "cache")
+    make_folder(root, [2, 2])
+    assert len(ManifestFolder(root, cache_dir=cache_dir)) == 4
+
+    touch_later(os.path.join(root, "class_1", "new.png"))
+    assert len(ManifestFolder(root, cache_dir=cache_dir)) == 5
+
+    os.remove(os.path.join(root, "class_0", "000.png"))
+    assert len(ManifestFolder(root, cache_dir=cache_dir)) == 4
+
+    os.makedirs(os.path.join(root, "class_2"))
+    touch_later(os.path.join(root, "class_2", "000.png"))
+    dataset = ManifestFolder(root, cache_dir=cache_dir)
+    assert len(dataset) == 5 and dataset.classes == ["class_0", "class_1", "class_2"]
+    assert list(dataset.samples) == ImageFolder(root).samples
+
+
+def test_manifest_is_rebuilt_when_a_source_file_changes(tmp_path):
+    root = str(tmp_path / "data")
+    make_folder(root, [2, 2])
+    source = tmp_path / "relabel.txt"
+    source.write_text("0")
+
+    class Relabeled(ManifestFolder):
+        # Labels come from a file next to the images, like the annotation files of TinyImageNet
+        def make_dataset(self, directory, class_to_idx, extensions=None, is_valid_file=None, allow_empty=False):
+            offset = int(source.read_text())
+            samples = super().make_dataset(directory, class_to_idx, extensions, is_valid_file, allow_empty)
+            return [(path, label + offset) for path, label in samples]
+
+        def manifest_sources(self):
+            return [str(source)]
+
+    assert list(Relabeled(root, cache_dir=str(tmp_path / "cache")).targets) == [0, 0, 1, 1]
+    time.sleep(0.01)
+    source.write_text("10")
+    assert list(Relabeled(root, cache_dir=str(tmp_path / "cache")).targets) == [10, 10, 11, 11]
@@ -0,0 +1,195 @@
+import numpy as np
+import pytest
+import torch
+
+from utils.data_loader import MemoryDataset
+from utils.memory import ClassIndex, TensorStorage
+
+
+def images_like_to_tensor(num, shape=(3, 4, 4), seed=0):
+    # ToTensor output, uint8 pixels divided by 255
+    pixels = torch.from_numpy(np.random.RandomState(seed).randint(0, 256, size=(num, *shape)).astype(np.uint8))
+    return pixels, pixels.float().div(255)
+
+
+def test_storage_keeps_to_tensor_images_exactly():
+    pixels, images = images_like_to_tensor(5)
+    storage = TensorStorage(capacity=8)
+    storage.write_batch(np.arange(5), images, [3, 1, 4, 1, 5])
+    assert len(storage) == 5
+    assert storage.images.dtype == torch.uint8 and storage.images.shape == (8, 3, 4, 4)
+    read, labels = storage.read([4, 0, 2])
+    assert torch.equal(read, pixels[[4, 0, 2]])
+    assert labels.tolist() == [5, 3, 4]
+    assert torch.equal(read.float().div(255), images[[4, 0, 2]])
+
+
+def test_storage_skips_negative_slots_and_keeps_the_later_write():
+    pixels, images = images_like_to_tensor(4)
+    storage = TensorStorage(capacity=4)
+    storage.write_batch([0, -1, 1, 0], images, [10, 11, 12, 13])
+    assert len(storage) == 2
+    read, labels = storage.read([0, 1])
+    assert torch.equal(read, pixels[[3, 2]])
+    assert labels.tolist() == [13, 12]
+    assert storage.version[:2].tolist() == [1, 1]
+
+
+def test_storage_without_capacity_grows_and_keeps_what_it_holds():
+    pixels, images = images_like_to_tensor(600)
+    storage = TensorStorage()
+    for begin in range(0, 600, 100):
+        storage.write_batch(np.arange(begin, begin + 100), images[begin:begin + 100], np.arange(begin, begin + 100))
+    assert len(storage) == 600 and len(storage.labels) >= 600
+    assert torch.equal(storage.get_images(), pixels)
+    assert storage.get_labels().tolist() == list(range(600))
+
+
+def test_memory_dataset_replaces_samples_in_place():
+    # replace_sample appends without an index and overwrites the given slot otherwise, as the list version did
+    pixels, images = images_like_to_tensor(6)
+    classes = []
+    memory = MemoryDataset(cls_list=classes, memory_size=4)
+    for cls in (7, 9):
+        classes.append(cls)
+        memory.add_new_class(classes)
+    labels = torch.tensor([7, 9, 9, 7, 9, 7])
+    for i in range(4):
+        memory.replace_sample((images[i], labels[i]))
+    memory.replace_sample((images[4], labels[4]), idx=0)
+    memory.replace_sample((images[5], labels[5]), idx=2)
+    assert len(memory) == 4
+    assert torch.equal(memory.images, pixels[[4, 1, 5, 3]])
+    assert memory.labels.tolist() == [1, 1, 0, 0]
+    assert memory.cls_count.tolist() == [2, 2]
+    assert sorted(memory.cls_idx[0].tolist()) == [2, 3]
+    assert sorted(memory.cls_idx[1].tolist()) == [0, 1]
+
+
+def check_class_index(index, reference):
+    # Members of every class, the counts and the back pointers agree with a plain set per class
+    assert len(index) == len(reference)
+    for cls, slots in enumerate(reference):
+        members = index[cls]
+        assert sorted(members.tolist()) == sorted(slots)
+        assert index.counts[cls] == len(slots)
+        for position, slot in enumerate(members.tolist()):
+            assert index.position[slot] == position
+            assert index.slot_class[slot] == cls
+
+
+def test_class_index_matches_sets_under_random_updates():
+    rng = np.random.RandomState(0)
+    index = ClassIndex(capacity=8)
+    reference = []
+    stored = {}
+    for step in range(3000):
+        if len(reference) < 12 and rng.rand() < 0.01 or len(reference) == 0:
+            index.add_class()
+            reference.append(set())
+        cls = rng.randint(len(reference))
+        slot = rng.randint(64)
+        if slot in stored:
+            assert index.remove(slot) == stored[slot]
+            reference[stored.pop(slot)].discard(slot)
+        index.add(slot, cls)
+        reference[cls].add(slot)
+        stored[slot] = cls
+        if step % 100 == 0:
+            check_class_index(index, reference)
+    check_class_index(index, reference)
+    assert [list(members) for members in index] == [index[cls].tolist() for cls in range(len(index))]
+
+
+def test_class_index_grows_past_its_capacity():
+    index = ClassIndex(capacity=2)
+    index.add_class()
+    for slot in range(100):
+        index.add(slot, 0)
+    assert index[0].tolist() == list(range(100))
+    assert index.remove(0) == 0
+    # The last member fills the hole
+    assert index[0].tolist() == [99] + list(range(1, 99))
+
+
+def filled_memory(policy, size, n_classes, seed):
+    rng = np.random.RandomState(seed)
+    classes = []
+    memory = MemoryDataset(cls_list=classes, memory_size=size, policy=policy)
+    for cls in range(n_classes):
+        classes.append(cls)
+        memory.add_new_class(classes)
+    memory.store((torch.zeros(size, 1, 1, 1), torch.from_numpy(rng.randint(0, n_classes, size=size))))
+    memory.loss_decrease[:size] = rng.permutation(size) / size
+    memory.policy.attach(memory)
+    return memory
+
+
+class BaselineIndex:
+    def __init__(self, labels, n_classes) -> None:
+        # The class lists of the memory before ClassIndex, appended on insert and list.remove'd on eviction
+        self.labels = list(labels)
+        self.cls_idx = [[] for _ in range(n_classes)]
+        for slot, label in enumerate(self.labels):
+            self.cls_idx[label].append(slot)
+
+    def replace(self, slot, cls):
+        self.cls_idx[self.labels[slot]].remove(slot)
+        self.cls_idx[cls].append(slot)
+        self.labels[slot] = cls
+
+    def scan(self, cls):
+        # The per sample scan of GDumb, RM and CLIB before the policies
+        label_frequency = [len(indices) for indices in self.cls_idx]
+        label_frequency[cls] += 1
+        return self.cls_idx[np.argmax(label_frequency)]
+
+
+@pytest.mark.parametrize("policy", ["class_balanced_random", "class_balanced_min_score"])
+def test_policy_victims_match_the_scan(policy):
+    memory = filled_memory(policy, 50, 3, seed=0)
+    baseline = BaselineIndex(memory.labels, 3)
+    stream = np.random.RandomState(2).randint(0, 3, size=500)
+    for step, cls in enumerate(stream.tolist()):
+        cand_idx = baseline.scan(cls)
+        victim = int(memory.policy.victim(memory, 0, cls))
+        if policy == "class_balanced_min_score":
+            # np.argmin keeps the first of equal scores in the list, inserted samples take the mean score
+            # of their class so ties do happen
+            assert victim == cand_idx[np.argmin(memory.others_loss_decrease[cand_idx])]
+        else:
+            # The members are drawn from in another order, the draw is uniform over the same candidates
+            assert victim in cand_idx
+            assert sorted(memory.cls_idx[memory.cls_idx.slot_class[victim]].tolist()) == sorted(cand_idx)
+        memory.assign_slot(victim, cls, None, len(memory))
+        baseline.replace(victim, cls)
+        if policy == "class_balanced_min_score" and step % 10 == 0:
+            # Rescored slots, as update_loss_history does after a training step
+            rescored = np.random.RandomState(step).choice(50, size=20, replace=False)
+            memory.loss_decrease[rescored] = np.random.RandomState(step).rand(20) + step
+            memory.policy.scored(memory, rescored)
+    assert memory.cls_count.tolist() == [len(indices) for indices in baseline.cls_idx]
+
+
+def test_class_balanced_store_evicts_from_the_largest_class():
+    memory = filled_memory("class_balanced_random", 30, 3, seed=0)
+    for _ in range(10):
+        memory.store((torch.zeros(6, 1, 1, 1), torch.tensor([0, 0, 0, 1, 2, 2])))
+    # Full memory, a stream of one half class 0 converges to the most balanced split
+    assert len(memory) == 30
+    assert memory.cls_count.tolist() == [10, 10, 10]
+
+
+def test_reservoir_store_matches_sample_by_sample_updates():
+    # The batched reservoir draws the same numbers as filling the memory one sample at a time
+    labels = np.random.RandomState(3).randint(0, 4, size=300)
+    memory = filled_memory("reservoir", 50, 4, seed=0)
+    np.random.seed(5)
+    slots = np.concatenate([memory.store((torch.zeros(10, 1, 1, 1), torch.from_numpy(labels[i:i + 10])))
+                            for i in range(0, 300, 10)])
+    np.random.seed(5)
+    expected = []
+    for seen in range(50, 350):
+        j = np.random.randint(0, seen + 1)
+        expected.append(j if j < 50 else -1)
+    assert slots.tolist() == expected
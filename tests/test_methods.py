@@ -0,0 +1,161 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import torch
+from torch import nn
+from torchvision import transforms
+
+import methods.er_baseline
+from configuration import config
+from utils.method_manager import select_method
+
+
+# The train and test transforms of main.py without the resizing and cropping
+TRANSFORM = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.5, 0.5, 0.5), (0.25, 0.25, 0.25))])
+
+
+def make_method(mode, *argv):
+    args = config.base_parser(["--mode", mode, "--dataset", "synthetic", "--model_name", "mlp400",
+                               "--memory_size", "50", "--batchsize", "16", *argv])
+    return select_method(args, nn.CrossEntropyLoss(), torch.device("cpu"), TRANSFORM, TRANSFORM, 10)
+
+
+def stream_batches(num, batch_size=16, num_classes=5, seed=0):
+    # ToTensor images and labels as the train loader hands them out
+    rng = np.random.RandomState(seed)
+    for _ in range(num):
+        images = torch.from_numpy(rng.randint(0, 256, size=(batch_size, 3, 28, 28)).astype(np.uint8)).float().div(255)
+        yield images, torch.from_numpy(rng.randint(0, num_classes, size=batch_size))
+
+
+def test_gdumb_fills_the_whole_memory():
+    # ER leaves room for a stream batch in its memory, GDumb trains on the memory alone
+    method = make_method("gdumb")
+    assert method.memory.policy.memory_size == 50
+    for sample_num, batch in enumerate(stream_batches(10), 1):
+        method.online_step(batch, sample_num * 16, 0)
+    assert len(method.memory) == 50
+    assert method.memory.cls_count.sum() == 50
+    assert method.memory.cls_count.max() - method.memory.cls_count.min() <= 1
+
+
+def test_clib_builds_a_single_memory(monkeypatch):
+    # A memory built by ER and replaced afterwards would keep its prefetcher alive
+    built = []
+
+    class Counted(methods.er_baseline.MemoryDataset):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            built.append(self)
+
+    monkeypatch.setattr(methods.er_baseline, "MemoryDataset", Counted)
+    method = make_method("clib", "--replay_workers", "1")
+    assert built == [method.memory]
+    assert method.memory.prefetcher is not None
+    assert method.memory.policy.memory_size == 50 and method.memory.save_test and method.memory.keep_history
+
+
+def test_legacy_methods_report_every_report_freq_stream_batches(monkeypatch):
+    args = config.base_parser(["--mode", "er", "--dataset", "synthetic", "--model_name", "mlp400", "--memory_size", "50",
+                               "--batchsize", "16", "--online_iter", "0.0625", "--report_freq", "4"])
+    method = methods.er_baseline.ER(nn.CrossEntropyLoss(), torch.device("cpu"), TRANSFORM, TRANSFORM, 10, **vars(args))
+    reported = []
+    monkeypatch.setattr(method, "report_training", reported.append)
+    sample_num = 0
+    # A short batch leaves the sample count off the multiples of the batch size
+    for images, labels in [*stream_batches(3), *stream_batches(1, batch_size=5), *stream_batches(6, seed=1)]:
+        sample_num += len(labels)
+        method.online_step((images, labels), sample_num, 0)
+    assert reported == [53, 117]
+
+
+def test_importing_main_loads_no_dataset_module():
+    # A fresh interpreter, the test session has imported datasets already
+    code = "import sys, main; print(sorted(m for m in sys.modules if m.startswith(('datasets.', 'pandas'))))"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True).stdout
+    assert out.strip() == "[]"
+
+
+class HeldOutImages(torch.utils.data.Dataset):
+    def __init__(self, num, num_classes=5) -> None:
+        rng = np.random.RandomState(3)
+        self.images = torch.from_numpy(rng.rand(num, 3, 28, 28).astype(np.float32))
+        self.targets = rng.randint(0, num_classes, size=num).tolist()
+        self.classes = list(range(num_classes))
+
+    def __getitem__(self, index):
+        return self.images[index], self.targets[index]
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def test_gdumb_trains_one_model_per_snapshot(monkeypatch):
+    method = make_method("gdumb")
+    trained = []
+
+    def train_snapshot(images, labels, num_classes, n_epoch, batch_size):
+        trained.append(len(labels))
+        torch.manual_seed(len(trained))
+        return nn.Sequential(nn.Flatten(), nn.Linear(3 * 28 * 28, num_classes))
+
+    monkeypatch.setattr(method, "train_snapshot", train_snapshot)
+    batches = stream_batches(9)
+    sample_num = 0
+    # Task 0 has two online snapshots, task 1 none and task 2 one
+    for task, evaluate_after in enumerate([(1, 2), (), (1,)]):
+        for step in range(3):
+            sample_num += 16
+            method.online_step(next(batches), sample_num, 0)
+            if step in evaluate_after:
+                method.online_evaluate(None, sample_num)
+        assert method.evaluation(None, method.criterion)["avg_acc"] == 0.0
+    assert trained == []
+
+    eval_results, task_records = method.evaluate_all(HeldOutImages(40), 1, 16, 0)
+    # The snapshot taken at the end of task 1 is trained on but is not an online result
+    assert trained == [32, 48, 50, 50]
+    assert eval_results["data_cnt"] == [32, 48, 128]
+    assert len(task_records["task_acc"]) == 3
+    assert task_records["task_acc"][0] == eval_results["test_acc"][1]
+    assert task_records["task_acc"][2] == eval_results["test_acc"][2]
+
+
+class TinyViT(nn.Module):
+    # The layout of models/vit.py the ViT methods rely on: fc1 and fc2 in the blocks, fc_norm and the fc classifier
+    def __init__(self, num_classes) -> None:
+        super().__init__()
+        self.embed_dim = 8
+        self.patch_embed = nn.Linear(3 * 28 * 28, self.embed_dim)
+        self.blocks = nn.ModuleList([nn.ModuleDict({"fc1": nn.Linear(8, 8), "fc2": nn.Linear(8, 8)}) for _ in range(2)])
+        self.fc_norm = nn.LayerNorm(self.embed_dim)
+        self.reset_classifier(num_classes)
+
+    def reset_classifier(self, num_classes):
+        self.fc = nn.Linear(self.embed_dim, num_classes)
+
+    def forward(self, x):
+        x = self.patch_embed(x.flatten(1))
+        for block in self.blocks:
+            x = block["fc2"](block["fc1"](x))
+        return self.fc(self.fc_norm(x))
+
+
+def test_clib_vit_runs_in_the_online_loop(monkeypatch):
+    import methods.clib_vit
+    monkeypatch.setattr(methods.clib_vit, "select_model", lambda model_name, dataset, num_classes: TinyViT(num_classes))
+    method = make_method("clib_vit", "--opt_name", "adam")
+    method.online_before_task(0)
+    for sample_num, batch in enumerate(stream_batches(4), 1):
+        method.online_step(batch, sample_num * 16, 0)
+    method.online_after_task(0)
+
+    # Only the classifier is in the group that add_new_class replaces
+    assert method.model.fc.out_features == len(method.exposed_classes) == 5
+    classifier = [id(param) for param in method.optimizer.param_groups[1]["params"]]
+    assert classifier == [id(method.model.fc.weight), id(method.model.fc.bias)]
+    assert len(method.optimizer.param_groups[0]["params"]) == len(list(method.model.parameters())) - 2
+    assert method.evaluation([(torch.rand(10, 3, 28, 28), torch.randint(0, 5, (10,)))], method.criterion)["avg_acc"] >= 0
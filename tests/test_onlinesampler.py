@@ -0,0 +1,162 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from utils.onlinesampler import ExposedIndex, OnlineSampler, OnlineTestSampler
+
+
+class Labels:
+    def __init__(self, targets, num_classes) -> None:
+        self.targets = targets
+        self.classes = list(range(num_classes))
+
+
+def baseline_split(targets, num_classes, num_tasks, m, n, rnd_seed, varing_NM):
+    # The task split as OnlineSampler built it before it was vectorized, one sample and one task at a time
+    generator = torch.Generator().manual_seed(rnd_seed)
+    disjoint_num = num_classes * n // 100
+    disjoint_num = int(disjoint_num // num_tasks) * num_tasks
+    blurry_num = num_classes - disjoint_num
+    blurry_num = int(blurry_num // num_tasks) * num_tasks
+
+    class_order = torch.randperm(num_classes, generator=generator)
+    if not varing_NM:
+        disjoint_classes = class_order[:disjoint_num].reshape(num_tasks, -1).tolist()
+    else:
+        disjoint_classes = class_order[:disjoint_num].tolist()
+        if disjoint_num > 0:
+            disjoint_slice = [0] + torch.randint(0, disjoint_num, (num_tasks - 1,), generator=generator).sort().values.tolist() + [disjoint_num]
+            disjoint_classes = [disjoint_classes[disjoint_slice[i]:disjoint_slice[i + 1]] for i in range(num_tasks)]
+        else:
+            disjoint_classes = [[] for _ in range(num_tasks)]
+    blurry_classes = class_order[disjoint_num:disjoint_num + blurry_num].reshape(num_tasks, -1).tolist()
+
+    disjoint_indices = [[] for _ in range(num_tasks)]
+    blurry_indices = [[] for _ in range(num_tasks)]
+    for i in range(len(targets)):
+        for j in range(num_tasks):
+            if targets[i] in disjoint_classes[j]:
+                disjoint_indices[j].append(i)
+                break
+            elif targets[i] in blurry_classes[j]:
+                blurry_indices[j].append(i)
+                break
+
+    blurred = []
+    if not varing_NM:
+        for i in range(num_tasks):
+            blurred += blurry_indices[i][:len(blurry_indices[i]) * m // 100]
+            blurry_indices[i] = blurry_indices[i][len(blurry_indices[i]) * m // 100:]
+        blurred = torch.tensor(blurred)
+        blurred = blurred[torch.randperm(len(blurred), generator=generator)].tolist()
+        num_blurred = len(blurred) // num_tasks
+        for i in range(num_tasks):
+            blurry_indices[i] += blurred[:num_blurred]
+            blurred = blurred[num_blurred:]
+    else:
+        num_blurred = sum(len(indices) for indices in blurry_indices) * m // 100
+        num_blurred = [0] + torch.randint(0, num_blurred, (num_tasks - 1,), generator=generator).sort().values.tolist() + [num_blurred]
+        for i in range(num_tasks):
+            blurred += blurry_indices[i][:num_blurred[i + 1] - num_blurred[i]]
+            blurry_indices[i] = blurry_indices[i][num_blurred[i + 1] - num_blurred[i]:]
+        blurred = torch.tensor(blurred)
+        blurred = blurred[torch.randperm(len(blurred), generator=generator)].tolist()
+        for i in range(num_tasks):
+            blurry_indices[i] += blurred[:num_blurred[i + 1] - num_blurred[i]]
+            blurred = blurred[num_blurred[i + 1] - num_blurred[i]:]
+
+    indices = []
+    for i in range(num_tasks):
+        task_indices = disjoint_indices[i] + blurry_indices[i]
+        indices.append(torch.tensor(task_indices)[torch.randperm(len(task_indices), generator=generator)].tolist())
+    return indices
+
+
+@pytest.mark.parametrize("varing_NM", [False, True])
+@pytest.mark.parametrize("num_classes, num_tasks, n, m", [(10, 5, 50, 10), (20, 4, 20, 30), (16, 4, 75, 100), (9, 3, 0, 50)])
+def test_split_matches_baseline(varing_NM, num_classes, num_tasks, n, m):
+    targets = np.random.RandomState(num_classes).randint(0, num_classes, size=600).tolist()
+    sampler = OnlineSampler(Labels(targets, num_classes), num_tasks, m, n, rnd_seed=3, varing_NM=varing_NM)
+    expected = baseline_split(targets, num_classes, num_tasks, m, n, 3, varing_NM)
+    assert [indices.tolist() for indices in sampler.indices] == expected
+    for task in range(num_tasks):
+        sampler.set_task(task)
+        assert list(iter(sampler)) == expected[task]
+        assert len(sampler) == len(expected[task])
+    assert sampler.stream_size() == sum(len(indices) for indices in expected)
+
+
+def test_cached_split_is_reused(tmp_path, capsys):
+    targets = np.random.RandomState(0).randint(0, 10, size=300)
+    built = OnlineSampler(Labels(targets, 10), 5, 10, 50, rnd_seed=1, cache_dir=str(tmp_path))
+    assert os.path.exists(built.cache_path + "_indices.npy")
+    capsys.readouterr()
+
+    loaded = OnlineSampler(Labels(targets, 10), 5, 10, 50, rnd_seed=1, cache_dir=str(tmp_path))
+    assert f"Loaded task split from {built.cache_path}" in capsys.readouterr().out
+    assert [indices.tolist() for indices in loaded.indices] == [indices.tolist() for indices in built.indices]
+
+
+def test_cached_split_is_keyed_on_targets(tmp_path):
+    # Same dataset type, size, setting and seed, only the labels differ
+    first = OnlineSampler(Labels(np.arange(300) % 10, 10), 5, 10, 50, rnd_seed=1, cache_dir=str(tmp_path))
+    second = OnlineSampler(Labels(np.arange(300)[::-1] % 10, 10), 5, 10, 50, rnd_seed=1, cache_dir=str(tmp_path))
+    assert first.split_name != second.split_name
+    expected = baseline_split((np.arange(300)[::-1] % 10).tolist(), 10, 5, 10, 50, 1, False)
+    assert [indices.tolist() for indices in second.indices] == expected
+
+
+def baseline_test_indices(targets, exposed_class):
+    return [i for i in range(len(targets)) if targets[i] in exposed_class]
+
+
+def test_exposed_index_matches_list_scan_as_classes_are_exposed():
+    targets = np.random.RandomState(0).randint(0, 20, size=1000).tolist()
+    index = ExposedIndex(targets)
+    exposed = []
+    handed_out = []
+    for cls in np.random.RandomState(1).permutation(20).tolist():
+        exposed.append(cls)
+        indices = index.update(exposed)
+        assert indices.tolist() == baseline_test_indices(targets, exposed)
+        handed_out.append((indices, indices.tolist()))
+    # Index arrays handed out earlier are left as they were
+    assert all(indices.tolist() == copy for indices, copy in handed_out)
+
+
+def test_exposed_index_ignores_classes_without_test_samples():
+    targets = [0, 2, 2, 5, 0]
+    index = ExposedIndex(targets)
+    assert index.update([]).tolist() == []
+    assert index.update([2, 7, -1]).tolist() == [1, 2]
+    assert index.update([2, 7, -1, 0]).tolist() == [0, 1, 2, 4]
+
+
+def test_exposed_index_is_only_rebuilt_when_the_classes_change():
+    index = ExposedIndex([1, 0, 1])
+    exposed = [1]
+    first = index.update(exposed)
+    assert index.update(exposed) is first
+    exposed.append(0)
+    assert index.update(exposed) is not first
+
+
+@pytest.mark.parametrize("num_replicas", [1, 3, 4])
+def test_test_sampler_shards_like_the_baseline(num_replicas):
+    targets = np.random.RandomState(2).randint(0, 10, size=301).tolist()
+    exposed = [3, 8, 1]
+    expected = baseline_test_indices(targets, exposed)
+    total_size = len(expected) // num_replicas * num_replicas
+    shards = []
+    for rank in range(num_replicas):
+        sampler = OnlineTestSampler(Labels(targets, 10), [])
+        # What the constructor sets up under torch.distributed
+        sampler.distributed, sampler.num_replicas, sampler.rank = True, num_replicas, rank
+        sampler.set_exposed(exposed)
+        shard = list(iter(sampler))
+        assert shard == expected[rank:total_size:num_replicas]
+        assert len(sampler) == len(shard)
+        shards.extend(shard)
+    assert sorted(shards) == expected[:total_size]
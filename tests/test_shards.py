@@ -0,0 +1,85 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+from torchvision import transforms
+
+from datasets._shards import Shards, ToArray
+
+
+class Pictures(Dataset):
+    def __init__(self, sizes, num_classes=3, transform=None, seed=0) -> None:
+        # PIL images of the given sizes, what an image folder decodes
+        rng = np.random.RandomState(seed)
+        self.images = [Image.fromarray(rng.randint(0, 256, size=(h, w, 3)).astype(np.uint8)) for w, h in sizes]
+        self.targets = rng.randint(0, num_classes, size=len(sizes)).tolist()
+        self.classes = [f"class_{cls}" for cls in range(num_classes)]
+        self.transform = transform
+
+    def __getitem__(self, index):
+        image = self.images[index]
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[index]
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def test_shards_read_back_what_was_decoded(tmp_path):
+    dataset = Pictures([(5, 4)] * 23)
+    path = Shards.convert(Pictures([(5, 4)] * 23, transform=ToArray()), str(tmp_path / "split"), shard_length=7, num_workers=0)
+    assert sorted(os.listdir(path)) == ["index.json"] + [f"shard_{n:05d}.npy" for n in range(4)] + ["targets.npy"]
+    shards = Shards(path, transforms.ToTensor())
+    assert shards.classes == dataset.classes
+    assert len(shards) == len(dataset) and shards.targets.tolist() == dataset.targets
+    for index in range(len(dataset)):
+        image, label = shards[index]
+        assert torch.equal(image, transforms.ToTensor()(dataset.images[index]))
+        assert label == dataset.targets[index]
+
+
+def test_shards_resize_images_of_different_sizes(tmp_path):
+    sizes = [(5, 4), (8, 8), (3, 6)]
+    with pytest.raises(ValueError):
+        Shards.convert(Pictures(sizes, transform=ToArray()), str(tmp_path / "raw"), shard_length=4, num_workers=0)
+    # Neither the split nor the private directory it was written to are left behind
+    assert os.listdir(tmp_path) == []
+
+    path = Shards.convert(Pictures(sizes, transform=ToArray(6)), str(tmp_path / "resized"), shard_length=4, num_workers=0)
+    shards = Shards(path)
+    for index, picture in enumerate(Pictures(sizes).images):
+        expected = np.asarray(picture.resize((6, 6), Image.BILINEAR))
+        assert np.array_equal(np.asarray(shards[index][0]), expected)
+
+
+def test_convert_skips_a_finished_split(tmp_path):
+    path = Shards.convert(Pictures([(4, 4)] * 5, transform=ToArray()), str(tmp_path / "split"), num_workers=0)
+    # A different dataset converted to the same path keeps the shards already there
+    Shards.convert(Pictures([(4, 4)] * 9, transform=ToArray(), seed=1), path, num_workers=0)
+    assert len(Shards(path)) == 5
+    assert not any(name.endswith(".tmp") for name in os.listdir(tmp_path))
+
+
+def test_gray_shards_take_the_channel_mean(tmp_path):
+    dataset = Pictures([(4, 4)] * 6)
+    path = Shards.convert(Pictures([(4, 4)] * 6, transform=ToArray()), str(tmp_path / "split"), num_workers=0)
+    shards = Shards(path, transforms.ToTensor(), gray=True)
+    for index in range(len(dataset)):
+        image = transforms.ToTensor()(dataset.images[index])
+        assert torch.equal(shards[index][0], image.mean(dim=0, keepdim=True).expand(3, -1, -1))
+
+
+def test_pickled_shards_map_their_files_again(tmp_path):
+    path = Shards.convert(Pictures([(4, 4)] * 10, transform=ToArray()), str(tmp_path / "split"), shard_length=4, num_workers=0)
+    shards = Shards(path, transforms.ToTensor())
+    first = shards[9][0]
+    assert len(shards.shards) == 1
+    copy = pickle.loads(pickle.dumps(shards))
+    # What DataLoader workers get, no open maps
+    assert copy.shards == {}
+    assert torch.equal(copy[9][0], first) and copy.targets.tolist() == shards.targets.tolist()
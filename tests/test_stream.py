@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader, Dataset
+from torchvision import transforms
+
+from utils.onlinesampler import OnlineSampler
+from utils.stream import PackedStream
+
+
+class Pixels(Dataset):
+    def __init__(self, num, num_classes, shape=(3, 5, 5), transform=None, seed=0) -> None:
+        # ToTensor images, uint8 pixels divided by 255, followed by `transform`
+        rng = np.random.RandomState(seed)
+        self.pixels = torch.from_numpy(rng.randint(0, 256, size=(num, *shape)).astype(np.uint8))
+        self.targets = rng.randint(0, num_classes, size=num).tolist()
+        self.classes = list(range(num_classes))
+        self.transform = transform
+
+    def __getitem__(self, index):
+        image = self.pixels[index].float().div(255)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[index]
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def assert_same_batches(stream, loader):
+    expected = list(loader)
+    batches = list(stream)
+    assert len(stream) == len(loader) == len(batches) == len(expected)
+    for (x, y), (packed_x, packed_y) in zip(expected, batches):
+        assert torch.equal(packed_x, x)
+        assert torch.equal(packed_y, y)
+
+
+@pytest.mark.parametrize("batch_size, depth", [(16, 2), (7, 1), (1000, 0)])
+def test_stream_yields_what_a_data_loader_yields(batch_size, depth, tmp_path):
+    dataset = Pixels(333, 10)
+    sampler = OnlineSampler(dataset, 5, 10, 50, rnd_seed=1)
+    stream = PackedStream(dataset, sampler, batch_size, str(tmp_path), depth=depth)
+    for task in range(5):
+        sampler.set_task(task)
+        assert_same_batches(stream, DataLoader(dataset, batch_size=batch_size, sampler=sampler))
+
+
+def test_packed_stream_is_reused_and_keeps_the_task(tmp_path, capsys):
+    dataset = Pixels(100, 4)
+    sampler = OnlineSampler(dataset, 2, 10, 50, rnd_seed=1)
+    sampler.set_task(1)
+    first = PackedStream(dataset, sampler, 8, str(tmp_path))
+    assert sampler.task == 1
+    modified = os.path.getmtime(os.path.join(first.path, "task_0.bin"))
+    capsys.readouterr()
+
+    second = PackedStream(dataset, sampler, 8, str(tmp_path))
+    assert second.path == first.path
+    assert os.path.getmtime(os.path.join(second.path, "task_0.bin")) == modified
+    assert "packing it again" not in capsys.readouterr().out
+    assert_same_batches(second, DataLoader(dataset, batch_size=8, sampler=sampler))
+
+
+def test_stream_not_matching_the_dataset_is_packed_again(tmp_path, capsys):
+    dataset = Pixels(100, 4)
+    sampler = OnlineSampler(dataset, 2, 10, 50, rnd_seed=1)
+    stream = PackedStream(dataset, sampler, 8, str(tmp_path))
+    with open(os.path.join(stream.path, "index.json"), "r") as f:
+        index = json.load(f)
+    index["counts"] = [count + 1 for count in index["counts"]]
+    with open(os.path.join(stream.path, "index.json"), "w") as f:
+        json.dump(index, f)
+
+    stream = PackedStream(dataset, sampler, 8, str(tmp_path))
+    assert "packing it again" in capsys.readouterr().out
+    assert_same_batches(stream, DataLoader(dataset, batch_size=8, sampler=sampler))
+
+
+def test_stream_refuses_images_that_are_not_to_tensor(tmp_path):
+    dataset = Pixels(50, 2, transform=transforms.Normalize((0.5, 0.5, 0.5), (0.2, 0.2, 0.2)))
+    sampler = OnlineSampler(dataset, 1, 10, 50, rnd_seed=1)
+    with pytest.raises(ValueError):
+        PackedStream(dataset, sampler, 8, str(tmp_path))
+    # Nothing half packed is left behind
+    assert os.listdir(tmp_path) == []
+
+
+def test_stopping_early_ends_the_reader(tmp_path):
+    dataset = Pixels(200, 4)
+    sampler = OnlineSampler(dataset, 1, 10, 50, rnd_seed=1)
+    stream = PackedStream(dataset, sampler, 4, str(tmp_path), depth=2)
+    threads = threading.active_count()
+    for i, _ in enumerate(stream):
+        if i == 2:
+            break
+    assert threading.active_count() == threads
+    assert len(list(stream)) == len(stream)
+
+
+def test_truncated_stream_raises_instead_of_waiting(tmp_path):
+    dataset = Pixels(100, 4)
+    sampler = OnlineSampler(dataset, 1, 10, 50, rnd_seed=1)
+    stream = PackedStream(dataset, sampler, 8, str(tmp_path))
+    path = os.path.join(stream.path, "task_0.bin")
+    os.truncate(path, os.path.getsize(path) // 2)
+    with pytest.raises(EOFError):
+        list(PackedStream(dataset, sampler, 8, str(tmp_path)))
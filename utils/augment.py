@@ -168,6 +168,26 @@ class SVHNPolicy(object):
         return "AutoAugment SVHN Policy"
 
 
+# Magnitudes of the 10 levels of every operation, shared with the batched policies in utils/batch_augment.py
+RANGES = {
+    "shearX": np.linspace(0, 0.3, 10),
+    "shearY": np.linspace(0, 0.3, 10),
+    "translateX": np.linspace(0, 150 / 331, 10),
+    "translateY": np.linspace(0, 150 / 331, 10),
+    "rotate": np.linspace(0, 30, 10),
+    "color": np.linspace(0.0, 0.9, 10),
+    "posterize": np.round(np.linspace(8, 4, 10), 0).astype(int),
+    "solarize": np.linspace(256, 0, 10),
+    "contrast": np.linspace(0.0, 0.9, 10),
+    "sharpness": np.linspace(0.0, 0.9, 10),
+    "brightness": np.linspace(0.0, 0.9, 10),
+    "autocontrast": [0] * 10,
+    "equalize": [0] * 10,
+    "invert": [0] * 10,
+    "cutout": np.round(np.linspace(0, 20, 10), 0).astype(int),
+}
+
+
 class SubPolicy(object):
     def __init__(
         self,
@@ -179,23 +199,6 @@ class SubPolicy(object):
         magnitude_idx2,
         fillcolor=(128, 128, 128),
     ):
-        ranges = {
-            "shearX": np.linspace(0, 0.3, 10),
-            "shearY": np.linspace(0, 0.3, 10),
-            "translateX": np.linspace(0, 150 / 331, 10),
-            "translateY": np.linspace(0, 150 / 331, 10),
-            "rotate": np.linspace(0, 30, 10),
-            "color": np.linspace(0.0, 0.9, 10),
-            "posterize": np.round(np.linspace(8, 4, 10), 0).astype(np.int),
-            "solarize": np.linspace(256, 0, 10),
-            "contrast": np.linspace(0.0, 0.9, 10),
-            "sharpness": np.linspace(0.0, 0.9, 10),
-            "brightness": np.linspace(0.0, 0.9, 10),
-            "autocontrast": [0] * 10,
-            "equalize": [0] * 10,
-            "invert": [0] * 10,
-        }
-
         # from https://stackoverflow.com/questions/5252170/specify-image-filling-color-when-rotating-in-python-with-pil-and-setting-expand
         def rotate_with_fill(img, magnitude):
             rot = img.convert("RGBA").rotate(magnitude)
@@ -248,14 +251,17 @@ class SubPolicy(object):
             "autocontrast": lambda img, magnitude: ImageOps.autocontrast(img),
             "equalize": lambda img, magnitude: ImageOps.equalize(img),
             "invert": lambda img, magnitude: ImageOps.invert(img),
+            "cutout": lambda img, magnitude: Cutout(magnitude)(img),
         }
 
         self.p1 = p1
+        self.name1 = operation1
         self.operation1 = func[operation1]
-        self.magnitude1 = ranges[operation1][magnitude_idx1]
+        self.magnitude1 = RANGES[operation1][magnitude_idx1]
         self.p2 = p2
+        self.name2 = operation2
         self.operation2 = func[operation2]
-        self.magnitude2 = ranges[operation2][magnitude_idx2]
+        self.magnitude2 = RANGES[operation2][magnitude_idx2]
 
     def __call__(self, img):
         if random.random() < self.p1:
@@ -0,0 +1,440 @@
+# Augmentations that work on whole image batches as tensors, on the CPU or on any device.
+# They follow the PIL transforms of torchvision and utils/augment.py with random parameters drawn per sample,
+# so a batch no longer makes a tensor -> PIL -> tensor round trip per image.
+# Images come in as uint8 in [0, 255] or floats in [0, 1] of shape (N, C, H, W).
+
+import math
+import weakref
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torchvision import transforms
+
+from utils.augment import RANGES, CIFAR10Policy, ImageNetPolicy, SVHNPolicy
+
+FILL = 128 / 255
+CUTOUT_FILL = (125 / 255, 122 / 255, 113 / 255)
+
+
+def to_float(images):
+    # A fresh float copy, the operations below are free to work in place on it
+    if images.dtype == torch.uint8:
+        return images.float().div_(255)
+    return images.to(torch.float32, copy=True)
+
+
+def to_levels(images):
+    return images.mul(255).round_()
+
+
+def to_uint8(images):
+    # Bitwise operations on uint8 are much cheaper than masked float arithmetic on the CPU
+    return to_levels(images).to(torch.uint8)
+
+
+def per_sample(values, images):
+    return values.view(-1, *([1] * (images.dim() - 1)))
+
+
+def grayscale(images):
+    # ITU-R 601-2 luma like PIL's convert("L")
+    if images.size(1) == 1:
+        return images
+    r, g, b = images[:, 0:1], images[:, 1:2], images[:, 2:3]
+    return 0.299 * r + 0.587 * g + 0.114 * b
+
+
+def blend(degenerate, images, factor):
+    # ImageEnhance: factor 0 gives the degenerate image, 1 the original
+    return (degenerate + per_sample(factor, images) * (images - degenerate)).clamp_(0, 1)
+
+
+def affine(images, matrix, mode="nearest", fill=FILL):
+    """Applies per sample affine maps given like PIL's Image.transform, from output to input pixel coordinates.
+    The maps are moved to the normalized coordinates of grid_sample, pixels outside the image get `fill`.
+    """
+    n, _, h, w = images.shape
+    matrix = torch.cat([matrix, matrix.new_tensor([0, 0, 1]).expand(n, 1, 3)], dim=1)
+    normalize = matrix.new_tensor([[2 / w, 0, -1], [0, 2 / h, -1], [0, 0, 1]])
+    theta = (normalize @ matrix @ torch.linalg.inv(normalize))[:, :2]
+    grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+    # Sampling the offset from the fill colour makes the zero padding come out as the fill colour
+    out = F.grid_sample(images - fill, grid, mode=mode, padding_mode="zeros", align_corners=False)
+    return out.add_(fill).clamp_(0, 1)
+
+
+def unit_matrix(images, magnitude):
+    matrix = torch.zeros(len(images), 2, 3, device=images.device)
+    matrix[:, 0, 0] = 1
+    matrix[:, 1, 1] = 1
+    return matrix, magnitude.to(images.device, torch.float32)
+
+
+def shear_x(images, magnitude):
+    matrix, magnitude = unit_matrix(images, magnitude)
+    matrix[:, 0, 1] = magnitude
+    return affine(images, matrix, mode="bicubic")
+
+
+def shear_y(images, magnitude):
+    matrix, magnitude = unit_matrix(images, magnitude)
+    matrix[:, 1, 0] = magnitude
+    return affine(images, matrix, mode="bicubic")
+
+
+def translate_x(images, magnitude):
+    # magnitude is a fraction of the width
+    matrix, magnitude = unit_matrix(images, magnitude)
+    matrix[:, 0, 2] = magnitude * images.size(3)
+    return affine(images, matrix)
+
+
+def translate_y(images, magnitude):
+    matrix, magnitude = unit_matrix(images, magnitude)
+    matrix[:, 1, 2] = magnitude * images.size(2)
+    return affine(images, matrix)
+
+
+def rotate(images, magnitude):
+    # Counter clockwise by magnitude degrees around the center, like Image.rotate
+    matrix, magnitude = unit_matrix(images, magnitude)
+    angle = -magnitude * math.pi / 180
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    cx, cy = images.size(3) / 2, images.size(2) / 2
+    matrix[:, 0, 0], matrix[:, 0, 1], matrix[:, 0, 2] = cos, sin, cx - cos * cx - sin * cy
+    matrix[:, 1, 0], matrix[:, 1, 1], matrix[:, 1, 2] = -sin, cos, cy + sin * cx - cos * cy
+    return affine(images, matrix)
+
+
+def color(images, magnitude):
+    return blend(grayscale(images), images, 1 + magnitude.to(images.device))
+
+
+def contrast(images, magnitude):
+    mean = to_levels(grayscale(images)).mean(dim=(1, 2, 3)).add_(0.5).floor_().div_(255)
+    return blend(per_sample(mean, images), images, 1 + magnitude.to(images.device))
+
+
+def brightness(images, magnitude):
+    return blend(torch.zeros_like(images), images, 1 + magnitude.to(images.device))
+
+
+def sharpness(images, magnitude):
+    # PIL's SMOOTH filter ([[1, 1, 1], [1, 5, 1], [1, 1, 1]] / 13), the border pixels stay as they are.
+    # Summed from shifted views, a depthwise conv2d is several times slower on the CPU
+    rows = images[:, :, :-2] + images[:, :, 1:-1] + images[:, :, 2:]
+    box = rows[:, :, :, :-2] + rows[:, :, :, 1:-1] + rows[:, :, :, 2:]
+    degenerate = images.clone()
+    degenerate[:, :, 1:-1, 1:-1] = box.add_(images[:, :, 1:-1, 1:-1], alpha=4).div_(13)
+    return blend(degenerate, images, 1 + magnitude.to(images.device))
+
+
+def posterize(images, magnitude):
+    # Keeps the `magnitude` most significant bits of every channel
+    bits = magnitude.to(images.device).long()
+    mask = per_sample((255 << (8 - bits)) & 255, images).to(torch.uint8)
+    return (to_uint8(images) & mask).float().div_(255)
+
+
+def solarize(images, magnitude):
+    # Inverts the levels at or above the threshold, 255 - x is x ^ 255 in uint8
+    levels = to_uint8(images)
+    threshold = per_sample(magnitude.to(images.device), images)
+    return (levels ^ (levels >= threshold).to(torch.uint8).mul_(255)).float().div_(255)
+
+
+def autocontrast(images, magnitude):
+    # Stretches every channel to the full range, channels with a single level stay as they are
+    levels = to_levels(images)
+    low = levels.amin(dim=(2, 3), keepdim=True)
+    high = levels.amax(dim=(2, 3), keepdim=True)
+    stretch = high > low
+    scale = torch.where(stretch, 255 / (high - low).clamp_(min=1), torch.ones_like(low))
+    low = torch.where(stretch, low, torch.zeros_like(low))
+    return levels.sub_(low).mul_(scale).floor_().clamp_(0, 255).div_(255)
+
+
+def equalize(images, magnitude):
+    # Per channel histogram equalization with the lookup table of ImageOps.equalize
+    n, c, h, w = images.shape
+    levels = to_levels(images).long().view(n * c, h * w)
+    histogram = torch.zeros(n * c, 256, device=images.device).scatter_add_(1, levels, torch.ones_like(levels, dtype=torch.float32))
+    last = histogram.gather(1, levels.amax(dim=1, keepdim=True))
+    step = torch.div(h * w - last, 255, rounding_mode="floor")
+    below = histogram.cumsum(dim=1) - histogram
+    lut = torch.div(torch.div(step, 2, rounding_mode="floor") + below, step.clamp(min=1), rounding_mode="floor")
+    lut = torch.where(step > 0, lut.clamp_(max=255), torch.arange(256, device=images.device, dtype=torch.float32))
+    return lut.gather(1, levels).view(n, c, h, w).div_(255)
+
+
+def invert(images, magnitude):
+    return 1 - images
+
+
+def cutout(images, magnitude):
+    # Fills a square of side `magnitude` centered on a random pixel, clipped at the border like utils.augment.Cutout
+    n, c, h, w = images.shape
+    half = torch.div(magnitude.to(images.device).long(), 2, rounding_mode="floor").view(n, 1)
+    cy = torch.randint(0, h, (n, 1), device=images.device)
+    cx = torch.randint(0, w, (n, 1), device=images.device)
+    rows = torch.arange(h, device=images.device)
+    cols = torch.arange(w, device=images.device)
+    inside_rows = (rows >= cy - half) & (rows < cy + half)
+    inside_cols = (cols >= cx - half) & (cols < cx + half)
+    mask = (inside_rows[:, :, None] & inside_cols[:, None, :]).unsqueeze(1)
+    fill = images.new_tensor(CUTOUT_FILL[:c] if c <= 3 else [FILL] * c).view(1, c, 1, 1)
+    return torch.where(mask, fill, images)
+
+
+# name -> (operation, whether the magnitude gets a random sign)
+OPERATIONS = {
+    "shearx": (shear_x, True),
+    "sheary": (shear_y, True),
+    "translatex": (translate_x, True),
+    "translatey": (translate_y, True),
+    "rotate": (rotate, False),
+    "color": (color, True),
+    "posterize": (posterize, False),
+    "solarize": (solarize, False),
+    "contrast": (contrast, True),
+    "sharpness": (sharpness, True),
+    "brightness": (brightness, True),
+    "autocontrast": (autocontrast, False),
+    "equalize": (equalize, False),
+    "invert": (invert, False),
+    "cutout": (cutout, False),
+}
+OPERATION_NAMES = list(OPERATIONS)
+SIGNED = torch.tensor([OPERATIONS[name][1] for name in OPERATION_NAMES])
+
+
+def apply_operations(images, operation, magnitude, applied):
+    """Applies operation[i] with magnitude[i] to the samples where applied[i] is set.
+    The samples are grouped by operation so every operation runs once on its whole group.
+    """
+    signed = applied & SIGNED.to(images.device)[operation]
+    sign = torch.where(signed & (torch.rand(len(images), device=images.device) < 0.5), -1.0, 1.0)
+    magnitude = magnitude * sign
+    for op in torch.unique(operation[applied]).tolist():
+        selected = torch.nonzero(applied & (operation == op)).squeeze(1)
+        function, _ = OPERATIONS[OPERATION_NAMES[op]]
+        images.index_copy_(0, selected, function(images.index_select(0, selected), magnitude[selected]))
+    return images
+
+
+class BatchTransform:
+    def __call__(self, images):
+        raise NotImplementedError
+
+    def single(self, image):
+        # A lone PIL image, as a per image pipeline hands it out, goes through as a batch of one
+        images = to_float(transforms.functional.pil_to_tensor(image).unsqueeze(0))
+        return transforms.functional.to_pil_image(self(images)[0])
+
+    def __repr__(self):
+        return self.__class__.__name__ + "()"
+
+
+class BatchCompose(BatchTransform):
+    def __init__(self, transforms) -> None:
+        self.transforms = transforms
+
+    def __call__(self, images):
+        images = to_float(images)
+        for transform in self.transforms:
+            images = transform(images)
+        return images
+
+    def __repr__(self):
+        return "BatchCompose(" + ", ".join(repr(transform) for transform in self.transforms) + ")"
+
+
+class BatchResize(BatchTransform):
+    def __init__(self, size) -> None:
+        # An int resizes the smaller edge like transforms.Resize
+        self.size = size
+
+    def __call__(self, images):
+        h, w = images.shape[-2:]
+        if isinstance(self.size, int):
+            short = min(h, w)
+            size = (self.size * h // short, self.size * w // short)
+        else:
+            size = tuple(self.size)
+        if size == (h, w):
+            return images
+        return F.interpolate(images, size=size, mode="bilinear", align_corners=False, antialias=True).clamp_(0, 1)
+
+
+class BatchRandomCrop(BatchTransform):
+    def __init__(self, size, padding=0) -> None:
+        self.size = (size, size) if isinstance(size, int) else tuple(size)
+        self.padding = padding
+
+    def __call__(self, images):
+        if self.padding > 0:
+            images = F.pad(images, [self.padding] * 4)
+        n, c, h, w = images.shape
+        th, tw = self.size
+        top = torch.randint(0, h - th + 1, (n, 1), device=images.device) + torch.arange(th, device=images.device)
+        left = torch.randint(0, w - tw + 1, (n, 1), device=images.device) + torch.arange(tw, device=images.device)
+        images = images.gather(2, top.view(n, 1, th, 1).expand(n, c, th, w))
+        return images.gather(3, left.view(n, 1, 1, tw).expand(n, c, th, tw))
+
+
+class BatchRandomHorizontalFlip(BatchTransform):
+    def __init__(self, p=0.5) -> None:
+        self.p = p
+
+    def __call__(self, images):
+        flip = torch.rand(len(images), device=images.device) < self.p
+        return torch.where(per_sample(flip, images), images.flip(3), images)
+
+
+class BatchCutout(BatchTransform):
+    def __init__(self, size=16) -> None:
+        self.size = size
+
+    def __call__(self, images):
+        return cutout(images, torch.full((len(images),), self.size, device=images.device))
+
+
+class BatchNormalize(BatchTransform):
+    def __init__(self, mean, std) -> None:
+        self.mean = torch.as_tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = torch.as_tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+
+    def __call__(self, images):
+        return images.sub_(self.mean.to(images.device)).div_(self.std.to(images.device))
+
+
+class BatchAutoAugment(BatchTransform):
+    def __init__(self, policy) -> None:
+        """Batched version of the AutoAugment policies of utils/augment.py (CIFAR10Policy, ImageNetPolicy, SVHNPolicy).
+        Every sample draws one of the sub-policies, then applies each of its two operations with its probability.
+        The operations approximate the PIL ones (enhance factors, shear resampling), it is only used with --batch_augment.
+        """
+        self.policy = policy
+        stages = [[(sub.p1, sub.name1, sub.magnitude1) for sub in policy.policies],
+                  [(sub.p2, sub.name2, sub.magnitude2) for sub in policy.policies]]
+        self.probability = [torch.tensor([p for p, _, _ in stage]) for stage in stages]
+        self.operation = [torch.tensor([OPERATION_NAMES.index(name.lower()) for _, name, _ in stage]) for stage in stages]
+        self.magnitude = [torch.tensor([float(m) for _, _, m in stage]) for stage in stages]
+
+    def __call__(self, images):
+        if isinstance(images, Image.Image):
+            return self.single(images)
+        n = len(images)
+        choice = torch.randint(0, len(self.policy.policies), (n,), device=images.device)
+        for probability, operation, magnitude in zip(self.probability, self.operation, self.magnitude):
+            applied = torch.rand(n, device=images.device) < probability.to(images.device)[choice]
+            images = apply_operations(images, operation.to(images.device)[choice],
+                                      magnitude.to(images.device)[choice], applied)
+        return images
+
+    def __repr__(self):
+        return f"BatchAutoAugment({self.policy!r})"
+
+
+class BatchRandAugment(BatchTransform):
+    # Operations of the RandAugment of the randaugment package, each drawn with a level in 1..9
+    OPERATIONS = ["invert", "cutout", "sharpness", "autocontrast", "posterize", "shearX", "translateX",
+                  "translateY", "shearY", "rotate", "equalize", "contrast", "color", "solarize", "brightness"]
+
+    def __init__(self, p=0.5) -> None:
+        """Two operations per sample, each drawn uniformly among all operations and levels and applied with probability p.
+        Close to the randaugment package but not the same distribution, it is only used with --batch_augment.
+        """
+        self.p = p
+        self.operation = torch.tensor([OPERATION_NAMES.index(name.lower()) for name in self.OPERATIONS for _ in range(1, 10)])
+        self.magnitude = torch.tensor([float(RANGES[name][level]) for name in self.OPERATIONS for level in range(1, 10)])
+
+    def __call__(self, images):
+        if isinstance(images, Image.Image):
+            return self.single(images)
+        n = len(images)
+        for _ in range(2):
+            choice = torch.randint(0, len(self.operation), (n,), device=images.device)
+            applied = torch.rand(n, device=images.device) < self.p
+            images = apply_operations(images, self.operation.to(images.device)[choice],
+                                      self.magnitude.to(images.device)[choice], applied)
+        return images
+
+
+AUTOAUGMENT_POLICIES = {
+    transforms.AutoAugmentPolicy.CIFAR10: CIFAR10Policy,
+    transforms.AutoAugmentPolicy.IMAGENET: ImageNetPolicy,
+    transforms.AutoAugmentPolicy.SVHN: SVHNPolicy,
+}
+
+
+def convert_transform(transform):
+    # Batched counterpart of a PIL transform, None if some part of it has none
+    if isinstance(transform, BatchTransform):
+        return transform
+    if isinstance(transform, transforms.Compose):
+        parts = [convert_transform(t) for t in transform.transforms if not isinstance(t, transforms.ToTensor)]
+        return None if any(part is None for part in parts) else BatchCompose(parts)
+    if isinstance(transform, transforms.Resize):
+        return BatchResize(transform.size)
+    if isinstance(transform, transforms.RandomCrop):
+        if transform.padding is not None and not isinstance(transform.padding, int):
+            return None
+        if transform.padding_mode != "constant" or transform.fill != 0:
+            return None
+        return BatchRandomCrop(transform.size, transform.padding or 0)
+    if isinstance(transform, transforms.RandomHorizontalFlip):
+        return BatchRandomHorizontalFlip(transform.p)
+    if isinstance(transform, transforms.Normalize):
+        return BatchNormalize(transform.mean, transform.std)
+    # AutoAugment and RandAugment have no exact batched counterpart and keep the PIL pipeline,
+    # BatchAutoAugment and BatchRandAugment are only there when asked for with --batch_augment
+    name = type(transform).__name__
+    if name == "Cutout" and hasattr(transform, "size"):
+        return BatchCutout(transform.size)
+    return None
+
+
+def augment_transforms(names, dataset, batched=False):
+    # The randaug/autoaug part of the train transform, the batched approximations with `batched`
+    augment = []
+    if "randaug" in names:
+        if batched:
+            augment.append(BatchRandAugment())
+        else:
+            from randaugment import RandAugment
+            augment.append(RandAugment())
+    if "autoaug" in names:
+        policy = None
+        if 'cifar' in dataset:
+            policy = transforms.AutoAugmentPolicy('cifar10')
+        elif 'imagenet' in dataset:
+            policy = transforms.AutoAugmentPolicy('imagenet')
+        elif 'svhn' in dataset:
+            policy = transforms.AutoAugmentPolicy('svhn')
+        if policy is not None:
+            augment.append(BatchAutoAugment(AUTOAUGMENT_POLICIES[policy]()) if batched else transforms.AutoAugment(policy))
+    return augment
+
+
+converted = weakref.WeakKeyDictionary()
+
+
+def batch_transform(transform):
+    # Converted once per transform object and remembered for as long as the transform lives
+    try:
+        return converted[transform]
+    except KeyError:
+        converted[transform] = convert_transform(transform)
+        return converted[transform]
+    except TypeError:
+        return convert_transform(transform)
+
+
+def transform_batch(images, transform):
+    # Runs the batched version of the transform where there is one and the per image PIL pipeline otherwise
+    batch = batch_transform(transform)
+    if batch is not None:
+        return batch(images)
+    return torch.stack([transform(transforms.ToPILImage()(image)) for image in images.cpu()])
@@ -5,11 +5,13 @@ import time
 
 import PIL
 import numpy as np
-import pandas as pd
 import torch
 from torchvision import transforms
 from torch.utils.data import Dataset
-from datasets import *
+from utils.memory import ClassIndex, grow, select_policy, select_storage
+from utils.batch_augment import transform_batch
+from utils.label_map import LabelMap
+from utils.prefetch import ReplayPrefetcher
 from time import perf_counter
 
 logger = logging.getLogger()
@@ -101,20 +103,18 @@ class StreamDataset(Dataset):
         return data
 
 class MemoryDataset(Dataset):
-    def __init__(self, transform=None, test_transform=None, cls_list=None, save_test=None, keep_history=False):
+    def __init__(self, transform=None, test_transform=None, cls_list=None, save_test=None, keep_history=False, memory_size=None,
+                 policy="reservoir", storage="ram", storage_dir=None, cache_size=512, decode_workers=4):
         
-        self.datalist = []
-        self.labels = []
-        self.images = []
+        self.storage = select_storage(storage, memory_size, storage_dir, cache_size, decode_workers)
         
         self.transform = transform
         self.cls_list = cls_list
-        self.cls_dict = {cls_list[i]:i for i in range(len(cls_list))}
-        self.cls_count = []
-        self.cls_idx = []
+        self.label_map = LabelMap(cls_list)
+        self.cls_idx = ClassIndex(memory_size)
         self.cls_train_cnt = np.array([])
         self.score = []
-        self.others_loss_decrease = np.array([])
+        self.loss_decrease = np.zeros(memory_size if memory_size is not None else 0)
         self.previous_idx = np.array([], dtype=int)
         self.test_transform = test_transform
         self.keep_history = keep_history
@@ -122,25 +122,56 @@ class MemoryDataset(Dataset):
         self.save_test = save_test
         if self.save_test is not None:
             self.device_img = []
+        self.prefetcher = None
+        self.set_policy(policy, memory_size)
+
+    def set_policy(self, name, memory_size):
+        self.policy = select_policy(name, memory_size)
+        self.policy.attach(self)
+
+    def enable_prefetch(self, num_workers=2, depth=2):
+        # get_batch with the default transform then comes from batches prepared ahead by worker processes
+        self.prefetcher = ReplayPrefetcher(self.storage, self.transform, num_workers, depth)
 
     def __len__(self):
-        return len(self.images)
+        return len(self.storage)
+
+    @property
+    def images(self):
+        return self.storage.get_images()
+
+    @property
+    def labels(self):
+        return self.storage.get_labels()
+
+    @property
+    def cls_count(self):
+        return self.cls_idx.counts[:len(self.cls_idx)]
+
+    @property
+    def others_loss_decrease(self):
+        return self.loss_decrease[:len(self)]
+
+    @property
+    def datalist(self):
+        return [{'image':image,'label':label} for image, label in zip(self.images, self.labels.tolist())]
 
     def add_new_class(self, cls_list):
         self.cls_list = cls_list
-        self.cls_count.append(0)
-        self.cls_idx.append([])
-        self.cls_dict = {self.cls_list[i]:i for i in range(len(self.cls_list))}
+        self.cls_idx.add_class()
+        if self.label_map.classes is not cls_list:
+            self.label_map = LabelMap(cls_list)
         self.cls_train_cnt = np.append(self.cls_train_cnt, 0)
 
     def __getitem__(self, idx):
         sample = dict()
         if torch.is_tensor(idx):
-            idx = idx.value()
-        label = self.labels[idx]
-        image = self.images[idx]
+            idx = idx.item()
+        images, labels = self.storage.read([idx])
+        label = int(labels[0])
+        image = images[0]
         if self.transform:
-            image = self.transform(image)
+            image = self.transform_batch(image.unsqueeze(0), self.transform)[0]
         sample["image"] = image
         sample["label"] = label
         return sample
@@ -153,59 +184,84 @@ class MemoryDataset(Dataset):
 
     def replace_sample(self, sample, idx=None):
         x, y = sample
-        y = y.item()
-        self.cls_count[self.cls_dict[y]] += 1
-
-        if idx is None:
-            self.cls_idx[self.cls_dict[y]].append(len(self.images))
-            self.datalist.append({'image':x,'label':self.cls_dict[y]})
-            self.images.append(x)
-            self.labels.append(self.cls_dict[y])
+        self.replace_batch([x.unsqueeze(0), y.reshape(1)], [len(self) if idx is None else idx])
+
+    def replace_batch(self, samples, slots):
+        """Stores a whole stream batch, the i-th sample goes to slots[i].
+        len(self) appends a sample, -1 skips it and a slot used twice keeps the later sample.
+        The bookkeeping is updated sample by sample, the images are written in one go.
+        """
+        x, y = samples
+        labels = self.label_map(np.asarray(y))
+        slots = np.asarray(slots, dtype=np.int64)
+        num_stored = len(self)
+        for i in np.flatnonzero(slots >= 0):
+            self.assign_slot(int(slots[i]), labels[i], x[i], num_stored)
+            num_stored = max(num_stored, int(slots[i]) + 1)
+        self.storage.write_batch(slots, x, labels)
+
+    def store(self, samples):
+        """Stores a whole stream batch wherever the eviction policy puts it and returns the slots used.
+        The bookkeeping is updated sample by sample, the images are written in one go.
+        """
+        x, y = samples
+        labels = self.label_map(np.asarray(y))
+        slots = np.full(len(labels), -1, dtype=np.int64)
+        num_stored = len(self)
+        self.policy.begin(num_stored, labels)
+        for i, label in enumerate(labels):
+            slot = int(self.policy.slot(self, i, label, num_stored))
+            if slot < 0:
+                continue
+            self.assign_slot(slot, label, x[i], num_stored)
+            num_stored = max(num_stored, slot + 1)
+            slots[i] = slot
+        self.storage.write_batch(slots, x, labels)
+        return slots
+
+    def assign_slot(self, idx, y, x, num_stored):
+        # Class index, score and test image of a slot, the image itself is written by the caller
+        if idx >= num_stored:
+            self.cls_idx.add(idx, y)
+            self.loss_decrease = grow(self.loss_decrease, idx + 1)
             if self.save_test:
                 self.device_img.append(self.test_transform(transforms.ToPILImage()(x)).unsqueeze(0))
-            if self.cls_count[self.cls_dict[y]] == 1:
-                self.others_loss_decrease = np.append(self.others_loss_decrease, 0)
+            if self.cls_count[y] == 1:
+                self.loss_decrease[idx] = 0
             else:
-                self.others_loss_decrease = np.append(self.others_loss_decrease, np.mean(self.others_loss_decrease[self.cls_idx[self.cls_dict[y]][:-1]]))
+                self.loss_decrease[idx] = np.mean(self.loss_decrease[self.cls_idx[y][:-1]])
         else:
-            self.cls_count[self.labels[idx]] -= 1
-            self.cls_idx[self.labels[idx]].remove(idx)
-            self.datalist[idx] = {'image':x,'label':self.cls_dict[y]}
-            self.cls_idx[self.cls_dict[y]].append(idx)
-            self.images[idx] = x
-            self.labels[idx] = self.cls_dict[y]
+            self.policy.removed(self, idx, self.cls_idx.remove(idx))
+            self.cls_idx.add(idx, y)
             if self.save_test:
                 self.device_img[idx] = self.test_transform(transforms.ToPILImage()(x)).unsqueeze(0)
-            if self.cls_count[self.cls_dict[y]] == 1:
-                self.others_loss_decrease[idx] = np.mean(self.others_loss_decrease)
+            if self.cls_count[y] == 1:
+                self.loss_decrease[idx] = np.mean(self.loss_decrease[:num_stored])
             else:
-                self.others_loss_decrease[idx] = np.mean(self.others_loss_decrease[self.cls_idx[self.cls_dict[y]][:-1]])
+                self.loss_decrease[idx] = np.mean(self.loss_decrease[self.cls_idx[y][:-1]])
+        self.policy.inserted(self, idx, y)
 
     def get_weight(self):
-        weight = np.zeros(len(self.images))
-        for i, indices in enumerate(self.cls_idx):
-            weight[indices] = 1/self.cls_count[i]
-        return weight
+        return 1 / self.cls_count[self.labels]
+
+    def transform_batch(self, images, transform):
+        return transform_batch(images, transform)
 
     @torch.no_grad()
     def get_batch(self, batch_size, use_weight=False, transform=None):
-        if use_weight:
-            weight = self.get_weight()
-            indices = np.random.choice(range(len(self.images)), size=batch_size, p=weight/np.sum(weight), replace=False)
-        else:
-            indices = np.random.choice(range(len(self.images)), size=batch_size, replace=False)
         data = dict()
-        images = []
-        labels = []
-        for i in indices:
-            if transform is None:
-                images.append(self.transform(transforms.ToPILImage()(self.images[i])))
+        if self.prefetcher is not None and not use_weight and transform is None:
+            data['image'], indices, labels = self.prefetcher.get_batch(batch_size, len(self))
+        else:
+            if use_weight:
+                weight = self.get_weight()
+                indices = np.random.choice(range(len(self)), size=batch_size, p=weight/np.sum(weight), replace=False)
             else:
-                images.append(transform(transforms.ToPILImage()(self.images[i])))
-            labels.append(self.labels[i])
-            self.cls_train_cnt[self.labels[i]] += 1
-        data['image'] = torch.stack(images)
-        data['label'] = torch.LongTensor(labels)
+                indices = np.random.choice(range(len(self)), size=batch_size, replace=False)
+            images, labels = self.storage.read(indices)
+            data['image'] = self.transform_batch(images, self.transform if transform is None else transform)
+        data['label'] = torch.from_numpy(labels)
+        np.add.at(self.cls_train_cnt, labels, 1)
         if self.keep_history:
             self.previous_idx = np.append(self.previous_idx, indices)
         return data
@@ -221,29 +277,18 @@ class MemoryDataset(Dataset):
             loss_diff = 0
         difference = loss_diff - np.mean(self.others_loss_decrease[self.previous_idx]) / len(self.previous_idx)
         self.others_loss_decrease[self.previous_idx] -= (1 - ema_ratio) * difference
+        self.policy.scored(self, self.previous_idx)
         self.previous_idx = np.array([], dtype=int)
 
     def get_two_batches(self, batch_size, test_transform):
-        indices = np.random.choice(range(len(self.images)), size=batch_size, replace=False)
+        indices = np.random.choice(range(len(self)), size=batch_size, replace=False)
         data_1 = dict()
         data_2 = dict()
-        images = []
-        labels = []
-        for i in indices:
-            if self.transform_on_gpu:
-                images.append(self.transform_gpu(self.images[i].to(self.device)))
-            else:
-                images.append(self.transform(self.images[i]))
-            labels.append(self.labels[i])
-        data_1['image'] = torch.stack(images)
-        data_1['label'] = torch.LongTensor(labels)
-        images = []
-        labels = []
-        for i in indices:
-            images.append(self.test_transform(self.images[i]))
-            labels.append(self.labels[i])
-        data_2['image'] = torch.stack(images)
-        data_2['label'] = torch.LongTensor(labels)
+        images, labels = self.storage.read(indices)
+        data_1['image'] = self.transform_batch(images, self.transform)
+        data_1['label'] = torch.from_numpy(labels)
+        data_2['image'] = self.transform_batch(images, test_transform)
+        data_2['label'] = torch.from_numpy(labels)
         return data_1, data_2
 
     def make_cls_dist_set(self, labels, transform=None):
@@ -254,18 +299,14 @@ class MemoryDataset(Dataset):
             indices.append(np.random.choice(self.cls_idx[label]))
         indices = np.array(indices)
         data = dict()
-        images = []
-        labels = []
-        for i in indices:
-            images.append(transform(self.images[i]))
-            labels.append(self.labels[i])
-        data['image'] = torch.stack(images)
-        data['label'] = torch.LongTensor(labels)
+        images, labels = self.storage.read(indices)
+        data['image'] = self.transform_batch(images, transform)
+        data['label'] = torch.from_numpy(labels)
         return data
 
     def make_val_set(self, size=None, transform=None):
         if size is None:
-            size = int(0.1*len(self.images))
+            size = int(0.1*len(self))
         if transform is None:
             transform = self.transform
         size_per_cls = size//len(self.cls_list)
@@ -277,17 +318,13 @@ class MemoryDataset(Dataset):
                 indices.append(np.random.choice(cls_list, size=size_per_cls, replace=True))
         indices = np.concatenate(indices)
         data = dict()
-        images = []
-        labels = []
-        for i in indices:
-            images.append(transform(self.images[i]))
-            labels.append(self.labels[i])
-        data['image'] = torch.stack(images)
-        data['label'] = torch.LongTensor(labels)
+        images, labels = self.storage.read(indices)
+        data['image'] = self.transform_batch(images, transform)
+        data['label'] = torch.from_numpy(labels)
         return data
 
     def is_balanced(self):
-        mem_per_cls = len(self.images)//len(self.cls_list)
+        mem_per_cls = len(self)//len(self.cls_list)
         for cls in self.cls_count:
             if cls < mem_per_cls or cls > mem_per_cls+1:
                 return False
@@ -295,6 +332,8 @@ class MemoryDataset(Dataset):
 
 
 def get_train_datalist(dataset, n_tasks, m, n, rnd_seed, cur_iter: int) -> List:
+    # pandas is only needed by the json datalists of the older scripts
+    import pandas as pd
     if n == 100 or m == 0:
         n = 100
         m = 0
@@ -303,6 +342,7 @@ def get_train_datalist(dataset, n_tasks, m, n, rnd_seed, cur_iter: int) -> List:
     ).to_dict(orient="records")
 
 def get_test_datalist(dataset) -> List:
+    import pandas as pd
     return pd.read_json(f"collections/{dataset}/{dataset}_val.json").to_dict(orient="records")
 
 
@@ -324,6 +364,7 @@ def get_statistics(dataset: str):
         "imagenet100",
         "imagenet1000",
         "tinyimagenet",
+        "synthetic",
     ]
     mean = {
         "mnist": (0.1307,),
@@ -337,6 +378,7 @@ def get_statistics(dataset: str):
         "tinyimagenet": (0.4802, 0.4481, 0.3975),
         "imagenet100": (0.485, 0.456, 0.406),
         "imagenet1000": (0.485, 0.456, 0.406),
+        "synthetic": (0.5, 0.5, 0.5),
     }
 
     std = {
@@ -351,6 +393,7 @@ def get_statistics(dataset: str):
         "tinyimagenet": (0.2302, 0.2265, 0.2262),
         "imagenet100": (0.229, 0.224, 0.225),
         "imagenet1000": (0.229, 0.224, 0.225),
+        "synthetic": (0.208, 0.208, 0.208),
     }
 
     classes = {
@@ -365,6 +408,7 @@ def get_statistics(dataset: str):
         "tinyimagenet": 200,
         "imagenet100": 100,
         "imagenet1000": 1000,
+        "synthetic": 10,
     }
 
     in_channels = {
@@ -379,6 +423,7 @@ def get_statistics(dataset: str):
         "tinyimagenet": 3,
         "imagenet100": 3,
         "imagenet1000": 3,
+        "synthetic": 3,
     }
 
     inp_size = {
@@ -393,6 +438,7 @@ def get_statistics(dataset: str):
         "tinyimagenet": 64,
         "imagenet100": 224,
         "imagenet1000": 224,
+        "synthetic": 32,
     }
     return (
         mean[dataset],
@@ -428,8 +474,8 @@ def rand_bbox(size, lam):
     W = size[2]
     H = size[3]
     cut_rat = np.sqrt(1.0 - lam)
-    cut_w = np.int(W * cut_rat)
-    cut_h = np.int(H * cut_rat)
+    cut_w = int(W * cut_rat)
+    cut_h = int(H * cut_rat)
 
     # uniform
     cx = np.random.randint(W)
@@ -0,0 +1,225 @@
+import copy
+import math
+import queue
+import tempfile
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch import nn
+from torch.utils.data import DataLoader
+
+from utils.label_map import LabelMap
+
+
+def interpret_pred(y, pred, n_classes):
+    # Number of samples and of correct predictions per class, scattered on the device of y
+    ret_num_data = torch.zeros(n_classes, device=y.device).index_add_(0, y, torch.ones_like(y, dtype=torch.float))
+    ret_corrects = torch.zeros(n_classes, device=y.device).index_add_(0, y, (y == pred).float())
+    return ret_num_data, ret_corrects
+
+
+class MetricsAccumulator:
+    def __init__(self, n_classes, topk=1, device="cpu") -> None:
+        """Sums of the evaluation metrics over the batches, kept on `device`.
+        update() only queues device work, the host waits for the device once in result().
+        """
+        self.n_classes = n_classes
+        self.topk = topk
+        self.num_batches = 0
+        self.total_loss = torch.zeros((), dtype=torch.float64, device=device)
+        self.total_correct = torch.zeros((), dtype=torch.long, device=device)
+        self.total_num_data = torch.zeros((), dtype=torch.long, device=device)
+        self.correct_l = torch.zeros(n_classes, device=device)
+        self.num_data_l = torch.zeros(n_classes, device=device)
+
+    @torch.no_grad()
+    def update(self, logit, y, loss):
+        pred = torch.argmax(logit, dim=-1)
+        _, preds = logit.topk(self.topk, 1, True, True)
+        self.total_correct += torch.sum(preds == y.unsqueeze(1))
+        self.total_num_data += y.size(0)
+        self.correct_l.index_add_(0, y, (y == pred).float())
+        self.num_data_l.index_add_(0, y, torch.ones_like(y, dtype=torch.float))
+        self.total_loss += loss.detach()
+        self.num_batches += 1
+
+    def result(self):
+        avg_acc = self.total_correct.item() / self.total_num_data.item()
+        avg_loss = self.total_loss.item() / self.num_batches
+        cls_acc = (self.correct_l / (self.num_data_l + 1e-5)).cpu().numpy().tolist()
+        return {"avg_loss": avg_loss, "avg_acc": avg_acc, "cls_acc": cls_acc}
+
+
+# Test sets up to this size are cached in RAM with --test_cache auto, larger ones go to disk
+TEST_CACHE_RAM_LIMIT = 2 ** 31
+
+
+class TestSetCache:
+    def __init__(self, test_dataset, storage="auto", storage_dir=None, batch_size=256, n_worker=0, normalize=None) -> None:
+        """The test split after its (deterministic) test transform, computed once in a single pass.
+        Images live in one contiguous tensor, in shared memory or in a memory-mapped file under
+        `storage_dir`, and evaluation reads the exposed classes from it without per image work.
+        With `normalize`, `test_dataset` hands out the ToTensor images before normalization: they are kept as
+        uint8, a quarter of the float size, and `normalize` is applied to every batch read from the cache.
+        """
+        self.targets = np.asarray(test_dataset.targets)
+        self.normalize = normalize
+        image, _ = test_dataset[0]
+        self.shape = (len(test_dataset), *image.shape)
+        self.dtype = np.dtype(np.uint8) if normalize is not None else image.numpy().dtype
+        nbytes = math.prod(self.shape) * self.dtype.itemsize
+        if storage == "auto":
+            storage = "ram" if nbytes <= TEST_CACHE_RAM_LIMIT else "disk"
+        if storage == "disk":
+            self.file = tempfile.NamedTemporaryFile(dir=storage_dir, prefix="test_cache_")
+            self.file.truncate(nbytes)
+            self.path = self.file.name
+            self.images = self.map("r+")
+        elif storage == "ram":
+            self.file = None
+            self.path = None
+            # Shared from the start, so handing the cache to the evaluation worker does not copy it
+            self.images = torch.from_numpy(np.empty(self.shape, dtype=self.dtype)).share_memory_()
+        else:
+            raise NotImplementedError(f"Unknown test cache storage {storage}")
+        self.labels = torch.empty(len(test_dataset), dtype=torch.long).share_memory_()
+
+        begin = 0
+        for x, y in DataLoader(test_dataset, batch_size=batch_size, num_workers=n_worker, generator=torch.Generator()):
+            if normalize is not None:
+                packed = x.mul(255).round_().to(torch.uint8)
+                if not torch.equal(packed.float().div_(255), x):
+                    raise ValueError("The test cache keeps uint8 images, the test set has to hand out ToTensor images before Normalize")
+                x = packed
+            self.images[begin:begin + len(x)] = x
+            self.labels[begin:begin + len(x)] = y
+            begin += len(x)
+
+    def map(self, mode):
+        return torch.from_numpy(np.memmap(self.path, dtype=self.dtype, mode=mode, shape=self.shape))
+
+    def __getstate__(self):
+        # A mapped cache is mapped again by path in the receiving process
+        state = self.__dict__.copy()
+        state["file"] = None
+        if self.path is not None:
+            state["images"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self.images = self.map("c")
+
+    def loader(self, test_sampler, batch_size):
+        # Same samples in the same order and batches as a DataLoader with the sampler
+        return CachedTestLoader(self.images, self.labels, torch.from_numpy(test_sampler.selected()), batch_size, self.normalize)
+
+
+class CachedTestLoader:
+    def __init__(self, images, labels, indices, batch_size, normalize=None) -> None:
+        self.images = images
+        self.labels = labels
+        self.indices = indices
+        self.batch_size = batch_size
+        self.normalize = normalize
+
+    def __len__(self):
+        return math.ceil(len(self.indices) / self.batch_size)
+
+    def __iter__(self):
+        for begin in range(0, len(self.indices), self.batch_size):
+            indices = self.indices[begin:begin + self.batch_size]
+            images = torch.index_select(self.images, 0, indices)
+            if self.normalize is not None:
+                images = self.normalize(images.float().div_(255))
+            yield images, torch.index_select(self.labels, 0, indices)
+
+
+def test_loader(test_set, test_sampler, exposed_classes, batch_size, n_worker):
+    # test_set is the test dataset or its TestSetCache, test_sampler the OnlineTestSampler kept over the run.
+    # The loader seeds its workers from its own generator, so evaluating does not move the training RNG
+    # and the training run is the same whether and wherever the evaluation happens
+    test_sampler.set_exposed(exposed_classes)
+    if isinstance(test_set, TestSetCache):
+        return test_set.loader(test_sampler, batch_size)
+    return DataLoader(test_set, batch_size=batch_size, sampler=test_sampler, num_workers=n_worker,
+                      generator=torch.Generator())
+
+
+@torch.no_grad()
+def evaluate(model, test_loader, exposed_classes, criterion, topk, n_classes, device):
+    metrics = MetricsAccumulator(n_classes, topk, device)
+    label_map = LabelMap(list(exposed_classes))
+    model.eval()
+    for i, data in enumerate(test_loader):
+        x, y = data
+        x = x.to(device)
+        y = label_map(y.to(device))
+        logit = model(x)
+        metrics.update(logit, y, criterion(logit, y))
+    return metrics.result()
+
+
+def eval_worker(test_set, test_sampler, batch_size, topk, n_classes, device, requests, results):
+    # A daemon process can not start DataLoader workers, the test set is read in this process
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        tag, model, exposed_classes = request
+        model.to(device)
+        criterion = model.loss_fn if hasattr(model, "loss_fn") else nn.CrossEntropyLoss(reduction="mean")
+        loader = test_loader(test_set, test_sampler, exposed_classes, batch_size, 0)
+        results.put((tag, evaluate(model, loader, exposed_classes, criterion, topk, n_classes, device)))
+
+
+class AsyncEvaluator:
+    def __init__(self, test_set, test_sampler, batch_size, topk, n_classes, device, callback, max_snapshots=2) -> None:
+        """Evaluates copies of the model in a background process while training goes on.
+        submit() copies the weights and the exposed classes at the eval point and returns right away,
+        blocking only while `max_snapshots` snapshots are already in flight. Results are handed to
+        `callback(tag, eval_dict)` in submission order from poll(), submit() and close().
+        """
+        self.callback = callback
+        self.max_snapshots = max_snapshots
+        self.in_flight = 0
+        # CUDA does not survive a fork, the worker is spawned and gets the test set (or its cache) pickled once
+        ctx = mp.get_context("spawn")
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.worker = ctx.Process(target=eval_worker, daemon=True,
+                                  args=(test_set, test_sampler, batch_size, topk, n_classes, str(device), self.requests, self.results))
+        self.worker.start()
+
+    def submit(self, tag, model, exposed_classes):
+        while self.in_flight >= self.max_snapshots:
+            self.receive(block=True)
+        snapshot = copy.deepcopy(model).cpu()
+        self.requests.put((tag, snapshot, list(exposed_classes)))
+        self.in_flight += 1
+
+    def receive(self, block):
+        while True:
+            try:
+                tag, eval_dict = self.results.get(timeout=1) if block else self.results.get_nowait()
+                break
+            except queue.Empty:
+                if not block:
+                    return False
+                if not self.worker.is_alive():
+                    raise RuntimeError(f"Evaluation worker exited with code {self.worker.exitcode}")
+        self.in_flight -= 1
+        self.callback(tag, eval_dict)
+        return True
+
+    def poll(self):
+        while self.in_flight > 0 and self.receive(block=False):
+            pass
+
+    def close(self):
+        while self.in_flight > 0:
+            self.receive(block=True)
+        self.requests.put(None)
+        self.worker.join()
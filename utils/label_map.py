@@ -0,0 +1,62 @@
+import numpy as np
+import torch
+
+
+class LabelMap:
+    def __init__(self, classes=None) -> None:
+        """Maps dataset class ids to their index in `classes`, the exposed classes in the order they were seen.
+        The list is shared with the caller, who keeps appending new classes to it, and the lookup table
+        follows it lazily. Remapping a batch is then one gather on the device of the labels and finding
+        the classes of a batch not exposed yet is one pass over it, instead of a list.index per sample.
+        Classes that are not exposed map to -1.
+        """
+        self.classes = [] if classes is None else classes
+        self.table = torch.full((0,), -1, dtype=torch.long)
+        self.num_synced = 0
+        self.device_tables = {}
+
+    def __len__(self):
+        return len(self.classes)
+
+    def sync(self):
+        if self.num_synced == len(self.classes):
+            return
+        if self.num_synced > len(self.classes):
+            # The list was cut back, the table is built again from scratch
+            self.table.fill_(-1)
+            self.num_synced = 0
+        new = torch.as_tensor(self.classes[self.num_synced:], dtype=torch.long)
+        size = int(new.max()) + 1
+        if size > len(self.table):
+            # Grown by doubling, so the classes of a long stream cost a logarithmic number of copies
+            table = torch.full((max(size, 2 * len(self.table)),), -1, dtype=torch.long)
+            table[:len(self.table)] = self.table
+            self.table = table
+        self.table[new] = torch.arange(self.num_synced, len(self.classes))
+        self.num_synced = len(self.classes)
+        self.device_tables.clear()
+
+    def lookup(self, device):
+        self.sync()
+        device = torch.device(device)
+        if device.type == "cpu":
+            return self.table
+        if device not in self.device_tables:
+            self.device_tables[device] = self.table.to(device)
+        return self.device_tables[device]
+
+    def __call__(self, labels):
+        # A tensor is remapped on its own device, anything else comes back as an int64 array
+        if torch.is_tensor(labels):
+            return self.lookup(labels.device)[labels.long()]
+        return self.lookup("cpu").numpy()[np.asarray(labels, dtype=np.int64)]
+
+    def unseen(self, labels):
+        # Classes of the batch that are not exposed yet, in the order they first appear in it
+        labels = np.asarray(labels.cpu() if torch.is_tensor(labels) else labels, dtype=np.int64).reshape(-1)
+        classes, first = np.unique(labels, return_index=True)
+        classes = classes[np.argsort(first)]
+        table = self.lookup("cpu").numpy()
+        known = classes < len(table)
+        known[known] = table[classes[known]] >= 0
+        return classes[~known].tolist()
@@ -1,44 +1,547 @@
+import heapq
+import io
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.distributed as dist
 import numpy as np
+from PIL import Image
 from typing import Optional, Sized
 
+from utils.batch_augment import transform_batch
+from utils.label_map import LabelMap
+from utils.prefetch import ReplayPrefetcher
+
+def to_uint8(image):
+    # Samples come from ToTensor as floats in [0, 1], which are exactly representable in uint8
+    if image.dtype == torch.uint8:
+        return image
+    return image.mul(255).round_().clamp_(0, 255).to(torch.uint8)
+
+def grow(array, size):
+    # Amortized growth of a preallocated array, new entries are zero
+    if size <= len(array):
+        return array
+    grown = np.zeros(max(2 * len(array), size), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+def reservoir_slots(num_stored, memory_size, seen, batch_size):
+    """Memory slots picked by reservoir sampling for a whole stream batch, -1 for samples that are not stored.
+    `seen` is the number of stream samples before this batch.
+    Draws the same random numbers as updating the memory one sample at a time.
+    """
+    slots = np.full(batch_size, -1, dtype=np.int64)
+    num_append = min(batch_size, max(memory_size - num_stored, 0))
+    slots[:num_append] = num_stored + np.arange(num_append)
+    if num_append < batch_size:
+        j = np.random.randint(0, seen + np.arange(num_append + 1, batch_size + 1))
+        slots[num_append:] = np.where(j < memory_size, j, -1)
+    return slots
+
+class ClassIndex:
+    def __init__(self, capacity=None) -> None:
+        """Memory slots grouped by class.
+        Every class keeps its slots in a growable array and every slot remembers its position in it,
+        so inserting, evicting (by moving the last member of the class into the hole) and listing
+        the members of a class take constant time.
+        """
+        self.members = []
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.position = np.zeros(capacity if capacity is not None else 0, dtype=np.int64)
+        self.slot_class = np.zeros(capacity if capacity is not None else 0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __getitem__(self, cls):
+        return self.members[cls][:self.counts[cls]]
+
+    def __iter__(self):
+        return (self[cls] for cls in range(len(self)))
+
+    def add_class(self):
+        self.members.append(np.zeros(16, dtype=np.int64))
+        self.counts = grow(self.counts, len(self.members))
+
+    def add(self, slot, cls):
+        count = self.counts[cls]
+        self.members[cls] = grow(self.members[cls], count + 1)
+        self.position = grow(self.position, slot + 1)
+        self.slot_class = grow(self.slot_class, slot + 1)
+        self.members[cls][count] = slot
+        self.position[slot] = count
+        self.slot_class[slot] = cls
+        self.counts[cls] = count + 1
+
+    def remove(self, slot):
+        cls = self.slot_class[slot]
+        last = self.members[cls][self.counts[cls] - 1]
+        self.members[cls][self.position[slot]] = last
+        self.position[last] = self.position[slot]
+        self.counts[cls] -= 1
+        return cls
+
+class EvictionPolicy:
+    def __init__(self, memory_size) -> None:
+        """Decides which memory slot every sample of a stream batch goes to, -1 if it is not stored.
+        Memories report every change of their class index and scores, so policies can keep
+        incremental structures instead of scanning the memory for every sample.
+        """
+        self.memory_size = memory_size
+
+    def attach(self, memory):
+        # Rebuild the policy state from what the memory already holds
+        pass
+
+    def begin(self, num_stored, labels):
+        pass
+
+    def slot(self, memory, i, cls, num_stored):
+        if num_stored < self.memory_size:
+            return num_stored
+        return self.victim(memory, i, cls)
+
+    def victim(self, memory, i, cls):
+        raise NotImplementedError
+
+    def inserted(self, memory, slot, cls):
+        pass
+
+    def removed(self, memory, slot, cls):
+        pass
+
+    def scored(self, memory, slots):
+        pass
+
+class Reservoir(EvictionPolicy):
+    def __init__(self, memory_size) -> None:
+        super().__init__(memory_size)
+        self.seen = 0
+        self.slots = np.zeros(0, dtype=np.int64)
+
+    def begin(self, num_stored, labels):
+        self.slots = reservoir_slots(num_stored, self.memory_size, self.seen, len(labels))
+        self.seen += len(labels)
+
+    def slot(self, memory, i, cls, num_stored):
+        return self.slots[i]
+
+class ClassBalancedRandom(EvictionPolicy):
+    def __init__(self, memory_size) -> None:
+        """Evicts from the largest class once the incoming sample is counted, ties go to the lower class.
+        The class sizes are kept in a max-heap with lazy deletion: every change pushes a new entry
+        and entries that no longer match the class size are dropped when they reach the top.
+        """
+        super().__init__(memory_size)
+        self.count_heap = []
+
+    def attach(self, memory):
+        self.build_count_heap(memory)
+
+    def build_count_heap(self, memory):
+        self.count_heap = [(-count, cls) for cls, count in enumerate(memory.cls_count.tolist())]
+        heapq.heapify(self.count_heap)
+
+    def victim_class(self, memory, cls):
+        counts = memory.cls_count
+        heap = self.count_heap
+        while -heap[0][0] != counts[heap[0][1]]:
+            heapq.heappop(heap)
+        count, largest = -heap[0][0], heap[0][1]
+        if counts[cls] + 1 > count or (counts[cls] + 1 == count and cls < largest):
+            return cls
+        return largest
+
+    def victim(self, memory, i, cls):
+        members = memory.cls_idx[self.victim_class(memory, cls)]
+        return members[np.random.randint(0, len(members))]
+
+    def push_count(self, memory, cls):
+        counts = memory.cls_count
+        if len(self.count_heap) > 4 * len(counts) + 64:
+            self.build_count_heap(memory)
+        else:
+            heapq.heappush(self.count_heap, (-counts[cls], cls))
+
+    def inserted(self, memory, slot, cls):
+        self.push_count(memory, cls)
+
+    def removed(self, memory, slot, cls):
+        self.push_count(memory, cls)
+
+class ClassBalancedMinScore(ClassBalancedRandom):
+    def __init__(self, memory_size) -> None:
+        """Evicts the member of the largest class with the lowest score (memory.loss_decrease),
+        ties go to the sample that joined its class first, as the scan over the class list did.
+        Every class keeps a min-heap of (score, joined, slot, version) and a slot's version changes
+        whenever it is evicted or rescored, which invalidates older entries.
+        """
+        super().__init__(memory_size)
+        self.score_heaps = []
+        self.version = np.zeros(0, dtype=np.int64)
+        # Insertion clock of every slot, kept when the slot is rescored
+        self.joined = np.zeros(0, dtype=np.int64)
+        self.clock = 0
+
+    def attach(self, memory):
+        super().attach(memory)
+        self.version = grow(self.version, len(memory))
+        self.joined = grow(self.joined, len(memory))
+        self.score_heaps = [self.build_heap(memory, cls) for cls in range(len(memory.cls_idx))]
+
+    def build_heap(self, memory, cls):
+        members = memory.cls_idx[cls]
+        heap = list(zip(memory.loss_decrease[members].tolist(), self.joined[members].tolist(),
+                        members.tolist(), self.version[members].tolist()))
+        heapq.heapify(heap)
+        return heap
+
+    def victim(self, memory, i, cls):
+        heap = self.score_heaps[self.victim_class(memory, cls)]
+        while heap[0][3] != self.version[heap[0][2]]:
+            heapq.heappop(heap)
+        return heap[0][2]
+
+    def push_score(self, memory, slot, cls):
+        self.version = grow(self.version, slot + 1)
+        self.version[slot] += 1
+        while len(self.score_heaps) <= cls:
+            self.score_heaps.append([])
+        heap = self.score_heaps[cls]
+        if len(heap) > 2 * memory.cls_count[cls] + 16:
+            self.score_heaps[cls] = self.build_heap(memory, cls)
+        else:
+            heapq.heappush(heap, (memory.loss_decrease[slot], self.joined[slot], slot, self.version[slot]))
+
+    def inserted(self, memory, slot, cls):
+        super().inserted(memory, slot, cls)
+        self.joined = grow(self.joined, slot + 1)
+        self.joined[slot] = self.clock
+        self.clock += 1
+        self.push_score(memory, slot, cls)
+
+    def removed(self, memory, slot, cls):
+        super().removed(memory, slot, cls)
+        self.version = grow(self.version, slot + 1)
+        self.version[slot] += 1
+
+    def scored(self, memory, slots):
+        for slot in np.unique(slots).tolist():
+            self.push_score(memory, slot, memory.cls_idx.slot_class[slot])
+
+EVICTION_POLICIES = {
+    "reservoir": Reservoir,
+    "class_balanced_random": ClassBalancedRandom,
+    "class_balanced_min_score": ClassBalancedMinScore,
+}
+
+def select_policy(name, memory_size):
+    if name not in EVICTION_POLICIES:
+        raise NotImplementedError(f"Unknown eviction policy {name}, choose from {list(EVICTION_POLICIES)}")
+    return EVICTION_POLICIES[name](memory_size)
+
+class TensorStorage:
+    def __init__(self, capacity=None) -> None:
+        """Fixed capacity replay storage.
+        Images are kept in one contiguous uint8 tensor allocated on the first write,
+        labels in an integer array of the same capacity.
+        If no capacity is given, the storage doubles whenever it runs out of slots.
+        Every slot counts its writes in `version`, so readers can tell whether a slot changed.
+        """
+        self.capacity = capacity
+        self.shape = None
+        self.images = None
+        self.labels = np.zeros(0, dtype=np.int64)
+        self.version = np.zeros(0, dtype=np.int64)
+        self.num_filled = 0
+
+    def __len__(self):
+        return self.num_filled
+
+    def reserve(self, size, shape):
+        if self.shape is None:
+            self.allocate(max(self.capacity if self.capacity is not None else 256, size), shape)
+        elif size > len(self.labels):
+            self.allocate(max(2 * len(self.labels), size), shape)
+
+    def allocate(self, capacity, shape):
+        images = torch.empty((capacity, *shape), dtype=torch.uint8)
+        if self.images is not None:
+            images[:self.num_filled] = self.images[:self.num_filled]
+        self.images = images
+        self.allocate_labels(capacity, shape)
+
+    def allocate_labels(self, capacity, shape):
+        labels = np.zeros(capacity, dtype=np.int64)
+        labels[:self.num_filled] = self.labels[:self.num_filled]
+        self.labels = labels
+        self.version = grow(self.version, capacity)
+        self.shape = tuple(shape)
+
+    def write(self, idx, image, label):
+        self.write_batch([idx], image.unsqueeze(0), [label])
+
+    def write_batch(self, slots, images, labels):
+        # Negative slots are skipped and a slot written twice keeps the later sample
+        slots = np.asarray(slots, dtype=np.int64)
+        _, last = np.unique(slots[::-1], return_index=True)
+        keep = np.sort(len(slots) - 1 - last)
+        keep = keep[slots[keep] >= 0]
+        if len(keep) == 0:
+            return
+        slots = slots[keep]
+        images = to_uint8(images[torch.from_numpy(keep)])
+        self.reserve(int(slots.max()) + 1, images.shape[1:])
+        self.put(slots, images)
+        self.labels[slots] = np.asarray(labels)[keep]
+        self.version[slots] += 1
+        self.num_filled = max(self.num_filled, int(slots.max()) + 1)
+
+    def put(self, slots, images):
+        # numpy scatters rows much faster than index_put on uint8 tensors
+        self.images.numpy()[slots] = images.cpu().numpy()
+
+    def share(self):
+        # Image tensor that child processes see writes to, None if samples can not be shared
+        self.images.share_memory_()
+        return self.images
+
+    def read(self, indices):
+        # index_select is an order of magnitude faster than advanced indexing for large rows
+        indices = np.asarray(indices, dtype=np.int64)
+        return torch.index_select(self.images, 0, torch.from_numpy(indices)), self.labels[indices]
+
+    def get_images(self):
+        if self.images is None:
+            return torch.empty((0,), dtype=torch.uint8)
+        return self.images[:self.num_filled]
+
+    def get_labels(self):
+        return self.labels[:self.num_filled]
+
+    def nbytes(self):
+        return self.num_filled * int(np.prod(self.shape)) if self.shape is not None else 0
+
+class MappedStorage(TensorStorage):
+    def __init__(self, capacity=None, storage_dir=None, cache_size=512) -> None:
+        """Replay storage in a memory-mapped file on local disk, so its size is bounded by the disk instead of RAM.
+        The file is private to the process and removed once it is closed. Labels stay in RAM and
+        the most recently gathered samples are kept in a small RAM cache, replaced first in first out.
+        """
+        super().__init__(capacity)
+        self.file = tempfile.TemporaryFile(dir=storage_dir, prefix="replay_")
+        self.cache_size = cache_size
+        self.cache = None
+        self.cache_line = np.zeros(0, dtype=np.int64)
+        self.line_slot = np.full(cache_size, -1, dtype=np.int64)
+        self.next_line = 0
+
+    def allocate(self, capacity, shape):
+        # The file keeps what is already stored, growing it only needs a new mapping
+        self.file.truncate(capacity * int(np.prod(shape)))
+        self.images = torch.from_numpy(np.memmap(self.file, dtype=np.uint8, mode="r+", shape=(capacity, *shape)))
+        self.allocate_labels(capacity, shape)
+        cache_line = np.full(capacity, -1, dtype=np.int64)
+        cache_line[:len(self.cache_line)] = self.cache_line
+        self.cache_line = cache_line
+        if self.cache is None:
+            self.cache = torch.empty((self.cache_size, *shape), dtype=torch.uint8)
+
+    def invalidate(self, slots):
+        slots = np.asarray(slots, dtype=np.int64)
+        slots = slots[slots >= 0]
+        lines = self.cache_line[slots]
+        self.line_slot[lines[lines >= 0]] = -1
+        self.cache_line[slots] = -1
+
+    def put(self, slots, images):
+        super().put(slots, images)
+        self.invalidate(slots)
+
+    def share(self):
+        # The file mapping is shared with forked processes as it is
+        return self.images
+
+    def read(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        lines = self.cache_line[indices]
+        hit = lines >= 0
+        images = np.empty((len(indices), *self.images.shape[1:]), dtype=np.uint8)
+        images[hit] = self.cache.numpy()[lines[hit]]
+        if not hit.all():
+            # Sorted unique slots turn the gather into a forward scan over the file
+            missing, inverse = np.unique(indices[~hit], return_inverse=True)
+            fetched = self.images.numpy()[missing]
+            images[~hit] = fetched[inverse.reshape(-1)]
+            keep = len(missing) - min(len(missing), self.cache_size)
+            self.insert(missing[keep:], fetched[keep:])
+        return torch.from_numpy(images), self.labels[indices]
+
+    def insert(self, slots, images):
+        if len(slots) == 0 or self.cache_size == 0:
+            return
+        lines = (self.next_line + np.arange(len(slots))) % self.cache_size
+        evicted = self.line_slot[lines]
+        self.cache_line[evicted[evicted >= 0]] = -1
+        self.line_slot[lines] = slots
+        self.cache_line[slots] = lines
+        self.cache.numpy()[lines] = images
+        self.next_line = (self.next_line + len(slots)) % self.cache_size
+
+class EncodedStorage(TensorStorage):
+    def __init__(self, capacity=None, format="png", quality=95, num_workers=4) -> None:
+        """Replay storage that keeps every sample as PNG (lossless) or JPEG (lossy) bytes.
+        Samples are encoded when stored and only decoded when a batch is gathered, both by a pool
+        of worker threads since PIL releases the GIL while coding.
+        """
+        super().__init__(capacity)
+        self.format = format.upper()
+        self.quality = quality
+        self.encoded = []
+        self.pool = ThreadPoolExecutor(num_workers) if num_workers > 0 else None
+
+    def map(self, fn, items):
+        if self.pool is None:
+            return list(map(fn, items))
+        return list(self.pool.map(fn, items))
+
+    def allocate(self, capacity, shape):
+        self.encoded.extend([b""] * (capacity - len(self.encoded)))
+        self.allocate_labels(capacity, shape)
+
+    def encode(self, image):
+        buffer = io.BytesIO()
+        Image.fromarray(image[..., 0] if image.shape[-1] == 1 else image).save(buffer, format=self.format, quality=self.quality)
+        return buffer.getvalue()
+
+    @staticmethod
+    def decode(data):
+        image = np.asarray(Image.open(io.BytesIO(data)))
+        return image.reshape(image.shape[0], image.shape[1], -1)
+
+    def put(self, slots, images):
+        images = np.ascontiguousarray(images.cpu().permute(0, 2, 3, 1).numpy())
+        for slot, data in zip(slots.tolist(), self.map(self.encode, images)):
+            self.encoded[slot] = data
+
+    def read(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        images = np.empty((len(indices), *self.shape), dtype=np.uint8)
+        for i, image in enumerate(self.map(self.decode, [self.encoded[idx] for idx in indices.tolist()])):
+            images[i] = image.transpose(2, 0, 1)
+        return torch.from_numpy(images), self.labels[indices]
+
+    def share(self):
+        return None
+
+    def get_images(self):
+        if self.shape is None:
+            return torch.empty((0,), dtype=torch.uint8)
+        return self.read(np.arange(self.num_filled))[0]
+
+    def nbytes(self):
+        return sum(len(data) for data in self.encoded[:self.num_filled])
+
+def select_storage(name, capacity=None, storage_dir=None, cache_size=512, num_workers=4):
+    if name == "ram":
+        return TensorStorage(capacity)
+    elif name == "disk":
+        return MappedStorage(capacity, storage_dir, cache_size)
+    elif name in ("png", "jpeg"):
+        return EncodedStorage(capacity, name, num_workers=num_workers)
+    raise NotImplementedError(f"Unknown memory storage {name}, choose from ram, disk, png, jpeg")
+
 class Memory:
-    def __init__(self, data_source: Optional[Sized]) -> None:
+    def __init__(self, data_source: Optional[Sized], memory_size=None, policy="reservoir",
+                 storage="ram", storage_dir=None, cache_size=512, decode_workers=4) -> None:
         self.data_source = data_source
-        self.memory = []
-        self.images = []
-        self.labels = []
-        self.cls_idx = []
-        self.cls_dict = {}
+        self.storage = select_storage(storage, memory_size, storage_dir, cache_size, decode_workers)
+        self.cls_idx = ClassIndex(memory_size)
+        self.label_map = LabelMap()
         self.cls_train_cnt = np.array([], dtype=int)
-    
+        self.prefetcher = None
+        self.set_policy(policy, memory_size)
+
+    def set_policy(self, name, memory_size):
+        self.policy = select_policy(name, memory_size)
+        self.policy.attach(self)
+
+    def enable_prefetch(self, transform, num_workers=2, depth=2):
+        # get_batch with this transform then comes from batches prepared ahead by worker processes
+        self.prefetcher = ReplayPrefetcher(self.storage, transform, num_workers, depth)
+
+    @property
+    def cls_count(self):
+        return self.cls_idx.counts[:len(self.cls_idx)]
+
+    @property
+    def images(self):
+        return self.storage.get_images()
+
+    @property
+    def labels(self):
+        return self.storage.get_labels()
+
     def add_new_class(self, cls_list):
         self.cls_list = cls_list
-        self.cls_idx.append([])
-        self.cls_dict = {self.cls_list[i]:i for i in range(len(self.cls_list))}
+        self.cls_idx.add_class()
+        if self.label_map.classes is not cls_list:
+            self.label_map = LabelMap(cls_list)
         self.cls_train_cnt = np.append(self.cls_train_cnt, 0)
 
     def replace_data(self, data, idx=None, distributed=False):
         image, label = data
-        if idx is None:
-            self.images.append(image)
-            self.labels.append(label)
-            self.cls_idx[self.cls_dict[label]].append(len(self.memory)-1)
-        else:
-            self.cls_idx[self.cls_dict[label[idx]]].remove(idx)
-            self.images[idx] = image
-            self.labels[idx] = label
-            self.cls_idx[self.cls_dict[label]].append(idx)
-        
+        self.replace_batch([image.unsqueeze(0), torch.as_tensor(label).reshape(1)], [len(self) if idx is None else idx])
+
         if distributed:
-            memory = torch.tensor(self.memory, dtype=torch.int64)
-            dist.broadcast(memory, dist.get_rank(), async_op=False)
-            self.memory = memory.tolist()
+            labels = torch.from_numpy(self.storage.get_labels().copy())
+            dist.broadcast(labels, dist.get_rank(), async_op=False)
+            self.storage.labels[:len(labels)] = labels.numpy()
             for i in range(len(self.cls_idx)):
-                cls_idx = torch.tensor(self.cls_idx[i], dtype=torch.int64)
+                cls_idx = torch.from_numpy(self.cls_idx[i].copy())
                 dist.broadcast(cls_idx, dist.get_rank(), async_op=False)
-                self.cls_idx[i] = cls_idx.tolist()
+                self.cls_idx[i][:] = cls_idx.numpy()
+
+    def replace_batch(self, data, slots):
+        """Stores a whole stream batch, the i-th sample goes to slots[i].
+        len(self) appends a sample, -1 skips it and a slot used twice keeps the later sample.
+        """
+        images, labels = data
+        classes = self.label_map(labels).tolist()
+        labels = labels.tolist()
+        num_stored = len(self)
+        for cls, slot in zip(classes, np.asarray(slots).tolist()):
+            if slot < 0:
+                continue
+            self.assign_slot(slot, cls, num_stored)
+            num_stored = max(num_stored, slot + 1)
+        self.storage.write_batch(slots, images, labels)
+
+    def store(self, data):
+        # Stores a whole stream batch wherever the eviction policy puts it and returns the slots used
+        images, labels = data
+        classes = self.label_map(labels).tolist()
+        labels = labels.tolist()
+        slots = np.full(len(labels), -1, dtype=np.int64)
+        num_stored = len(self)
+        self.policy.begin(num_stored, labels)
+        for i, cls in enumerate(classes):
+            slot = int(self.policy.slot(self, i, cls, num_stored))
+            if slot < 0:
+                continue
+            self.assign_slot(slot, cls, num_stored)
+            num_stored = max(num_stored, slot + 1)
+            slots[i] = slot
+        self.storage.write_batch(slots, images, labels)
+        return slots
+
+    def assign_slot(self, slot, cls, num_stored):
+        if slot < num_stored:
+            self.policy.removed(self, slot, self.cls_idx.remove(slot))
+        self.cls_idx.add(slot, cls)
+        self.policy.inserted(self, slot, cls)
 
     def update_gss_score(self, score, idx=None):
         if idx is None:
@@ -47,21 +550,23 @@ class Memory:
             self.score[idx] = score
 
     @torch.no_grad()
-    def get_batch(self, batch_size, use_weight=False):
-        if use_weight:
-            weight = self.get_weight()
-            indices = np.random.choice(range(len(self.memory)), size=batch_size, p=weight/np.sum(weight), replace=False)
+    def get_batch(self, batch_size, use_weight=False, transform=None):
+        # Without a transform the images come back as floats in [0, 1]
+        if self.prefetcher is not None and not use_weight and transform is self.prefetcher.transform:
+            images, indices, labels = self.prefetcher.get_batch(batch_size, len(self))
         else:
-            indices = np.random.choice(range(len(self.memory)), size=batch_size, replace=False)
-        images = []
-        labels = []
-        for i in indices:
-            images.append(self.images[i])
-            labels.append(self.cls_dict[self.labels[i]])
-            self.cls_train_cnt[self.cls_dict[self.labels[i]]] += 1
+            if use_weight:
+                weight = self.get_weight()
+                indices = np.random.choice(range(len(self)), size=batch_size, p=weight/np.sum(weight), replace=False)
+            else:
+                indices = np.random.choice(range(len(self)), size=batch_size, replace=False)
+            images, labels = self.storage.read(indices)
+            images = images.float().div_(255) if transform is None else transform_batch(images, transform)
+        labels = self.label_map(labels)
+        np.add.at(self.cls_train_cnt, labels, 1)
         # self.previous_idx = np.append(self.previous_idx, indices)
-        return torch.stack(images), torch.LongTensor(labels)
-    
+        return images, torch.from_numpy(labels)
+
     def update_loss_history(self, loss, prev_loss, ema_ratio=0.90, dropped_idx=None):
         if dropped_idx is None:
             loss_diff = np.mean(loss - prev_loss)
@@ -74,12 +579,12 @@ class Memory:
         difference = loss_diff - np.mean(self.others_loss_decrease[self.previous_idx]) / len(self.previous_idx)
         self.others_loss_decrease[self.previous_idx] -= (1 - ema_ratio) * difference
         self.previous_idx = np.array([], dtype=int)
-    
+
     def get_weight(self):
-        weight = np.zeros(len(self.images))
+        weight = np.zeros(len(self))
         for i, indices in enumerate(self.cls_idx):
             weight[indices] = 1/self.cls_count[i]
         return weight
 
     def __len__(self):
-        return len(self.memory)
\ No newline at end of file
+        return len(self.storage)
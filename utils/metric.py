@@ -1,9 +1,13 @@
+import atexit
+import json
+import os
+import shutil
+import threading
 from enum import Enum
-from turtle import update
 
+import numpy as np
 import torch
 import torch.distributed as dist
-from torch.utils.tensorboard import SummaryWriter
 
 class Summary(Enum):
     NONE = 0
@@ -75,11 +79,13 @@ class ProgressMeter(object):
         print(' '.join(entries))
 
     def write(self, save_path, epoch, batch, prefix=""):
+        from torch.utils.tensorboard import SummaryWriter
         with SummaryWriter(save_path) as writer:
             for meter in self.meters:
                writer.add_scalar(meter.name + prefix, meter.val, epoch * self.num_batches + batch)
 
     def write_summary(self, save_path, epoch, prefix=""):
+        from torch.utils.tensorboard import SummaryWriter
         with SummaryWriter(save_path) as writer:
             for meter in self.meters:
                writer.add_scalar("Epoch/"+ prefix + meter.name, meter.val, epoch)
@@ -103,4 +109,191 @@ def accuracy(output, target, topk=(1,)):
         for k in topk:
             correct_k = correct[:k].reshape(-1).float().sum(0, keepdim=True)
             res.append(correct_k.mul_(100.0 / batch_size))
-        return res
\ No newline at end of file
+        return res
+
+
+class TrainMetrics:
+    def __init__(self) -> None:
+        """Training loss and accuracy summed over the steps since the last flush().
+        The sums stay on the device of the losses, so update() never waits for the device and
+        consecutive steps queue up behind each other. flush() reads them back once.
+        """
+        self.total_loss = None
+        self.total_correct = None
+        self.num_data = 0
+        self.iterations = 0
+
+    def __len__(self):
+        return self.iterations
+
+    @torch.no_grad()
+    def update(self, loss, preds, y):
+        # preds are the top-k predictions of the step, a sample counts as correct when its label is among them
+        if self.total_loss is None:
+            self.total_loss = torch.zeros((), dtype=torch.float64, device=loss.device)
+            self.total_correct = torch.zeros((), dtype=torch.long, device=loss.device)
+        self.total_loss += loss.detach()
+        self.total_correct += torch.sum(preds == y.unsqueeze(1))
+        self.num_data += y.size(0)
+        self.iterations += 1
+
+    def flush(self):
+        # Average loss per step and accuracy since the last flush, None when there was no step
+        if self.iterations == 0:
+            return None
+        train_loss = self.total_loss.item() / self.iterations
+        train_acc = self.total_correct.item() / self.num_data
+        self.total_loss.zero_()
+        self.total_correct.zero_()
+        self.num_data = 0
+        self.iterations = 0
+        return train_loss, train_acc
+
+
+class MetricsSink:
+    def __init__(self, path=None, tensorboard_dir=None, flush_period=10.0, max_buffer=256) -> None:
+        """Collects metric records in memory and writes them from a background thread.
+        log(table, step, **values) only appends to a buffer. The thread empties it into a columnar store
+        under `path` and into TensorBoard under `tensorboard_dir`, when `max_buffer` records are waiting,
+        every `flush_period` seconds, on flush() and at exit, so an interrupted run keeps what it logged.
+        Each column of a table is a file of float64 rows, read back with load_metrics(path).
+        The thread starts with the first record, a sink without path nor tensorboard_dir drops everything.
+        """
+        self.path = path
+        self.tensorboard_dir = tensorboard_dir
+        self.flush_period = flush_period
+        self.max_buffer = max_buffer
+        self.buffer = []
+        self.logged = 0
+        self.written = 0
+        self.flushing = 0
+        self.closed = False
+        self.lock = threading.Condition()
+        self.thread = None
+        self.writer = None
+        if tensorboard_dir is not None:
+            # TensorBoard takes seconds to import, only sinks that write to it pay for it
+            from torch.utils.tensorboard import SummaryWriter
+            self.summary_writer = SummaryWriter
+        self.columns = {}
+        self.rows = {}
+
+    @property
+    def enabled(self):
+        return self.path is not None or self.tensorboard_dir is not None
+
+    def log(self, table, step, **values):
+        # Scalars go to TensorBoard as "{table}/{column}" too, sequences such as cls_acc only to the store
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.start()
+            self.buffer.append((table, step, values))
+            self.logged += 1
+            if len(self.buffer) >= self.max_buffer:
+                self.lock.notify_all()
+
+    def start(self):
+        if self.path is not None:
+            # A sink starts its store afresh, like the np.save of the results at the end of a run
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        closed = False
+        while not closed:
+            with self.lock:
+                self.lock.wait_for(lambda: self.closed or self.flushing or len(self.buffer) >= self.max_buffer,
+                                   timeout=self.flush_period)
+                records, self.buffer = self.buffer, []
+                closed = self.closed
+            self.write(records)
+            with self.lock:
+                self.written += len(records)
+                self.lock.notify_all()
+        if self.writer is not None:
+            self.writer.close()
+
+    def write(self, records):
+        tables = {}
+        for table, step, values in records:
+            tables.setdefault(table, []).append((step, values))
+            if self.tensorboard_dir is not None:
+                if self.writer is None:
+                    self.writer = self.summary_writer(self.tensorboard_dir)
+                for column, value in values.items():
+                    if np.ndim(value) == 0:
+                        self.writer.add_scalar(f"{table}/{column}", value, step)
+        if self.path is None:
+            return
+        for table, rows in tables.items():
+            self.write_table(table, rows)
+
+    def write_table(self, table, rows):
+        columns = self.columns.setdefault(table, {"step": 1})
+        num_rows = self.rows.get(table, 0)
+        directory = os.path.join(self.path, table)
+        os.makedirs(directory, exist_ok=True)
+        new = {}
+        for _, values in rows:
+            for column, value in values.items():
+                if column not in columns and column not in new:
+                    new[column] = int(np.size(value))
+        for column, width in new.items():
+            # Rows written before the column showed up read as NaN
+            columns[column] = width
+            np.full((num_rows, width), np.nan).tofile(os.path.join(directory, f"{column}.bin"))
+        if new:
+            with open(os.path.join(self.path, "columns.tmp"), "w") as f:
+                json.dump(self.columns, f)
+            os.replace(os.path.join(self.path, "columns.tmp"), os.path.join(self.path, "columns.json"))
+        for column, width in columns.items():
+            data = np.full((len(rows), width), np.nan)
+            for i, (step, values) in enumerate(rows):
+                value = step if column == "step" else values.get(column)
+                if value is not None:
+                    data[i] = np.asarray(value, dtype=np.float64).reshape(-1)
+            with open(os.path.join(directory, f"{column}.bin"), "ab") as f:
+                f.write(data.tobytes())
+        self.rows[table] = num_rows + len(rows)
+
+    def flush(self):
+        # Returns once everything logged so far is written
+        with self.lock:
+            if self.thread is None:
+                return
+            logged = self.logged
+            self.flushing += 1
+            self.lock.notify_all()
+            while self.written < logged and self.thread.is_alive():
+                self.lock.wait(1)
+            self.flushing -= 1
+
+    def close(self):
+        with self.lock:
+            if self.thread is None or self.closed:
+                return
+            self.closed = True
+            self.lock.notify_all()
+        self.thread.join()
+
+
+def load_metrics(path):
+    # {table: {column: array with a row per record}} from the store of a MetricsSink, a row cut short is dropped
+    with open(os.path.join(path, "columns.json")) as f:
+        columns = json.load(f)
+    metrics = {}
+    for table, widths in columns.items():
+        data = {}
+        for column, width in widths.items():
+            file = os.path.join(path, table, f"{column}.bin")
+            values = np.fromfile(file, dtype=np.float64) if os.path.exists(file) else np.empty(0)
+            data[column] = values[:len(values) // width * width].reshape(-1, width)
+        num_rows = min(len(values) for values in data.values())
+        metrics[table] = {column: values[:num_rows, 0] if widths[column] == 1 else values[:num_rows]
+                          for column, values in data.items()}
+    return metrics
@@ -1,10 +1,14 @@
+import hashlib
+import os
+
+import numpy as np
 import torch
 import torch.distributed as dist
 from torch.utils.data.sampler import Sampler
 from typing import Optional, Sized
 
 class OnlineSampler(Sampler):
-    def __init__(self, data_source: Optional[Sized], num_tasks, m, n, rnd_seed, cur_iter = 0, varing_NM = False, num_replicas=None, rank=None) -> None:
+    def __init__(self, data_source: Optional[Sized], num_tasks, m, n, rnd_seed, cur_iter = 0, varing_NM = False, num_replicas=None, rank=None, cache_dir=None) -> None:
 
         self.data_source    = data_source
         self.classes    = self.data_source.classes
@@ -34,6 +38,30 @@ class OnlineSampler(Sampler):
         self.blurry_num     = len(self.classes) - self.disjoint_num
         self.blurry_num     = int(self.blurry_num // num_tasks) * num_tasks
 
+        # Task splits only depend on the targets, the setting and the seed, so they are shared across ranks and runs.
+        # The targets are hashed, datasets of the same class and size (Shards, synthetic) do not share a split
+        digest = hashlib.sha1(np.ascontiguousarray(self.targets, dtype=np.int64).tobytes()).hexdigest()[:16]
+        self.split_name = (f"{type(self.data_source).__name__.lower()}_{len(self.targets)}_{digest}"
+                           f"_split{num_tasks}_n{n}_m{m}_rnd{int(varing_NM)}_seed{rnd_seed}")
+        self.cache_path = None
+        if cache_dir is not None:
+            self.cache_path = os.path.join(cache_dir, self.split_name)
+        self.indices = self.load_split(num_tasks)
+        if self.indices is None:
+            self.indices = self.build_split(num_tasks, m)
+            self.save_split()
+
+        if self.distributed:
+            self.num_samples = int(len(self.indices[self.task]) // self.num_replicas)
+            self.total_size = self.num_samples * self.num_replicas  
+            self.num_selected_samples = int(len(self.indices[self.task]) // self.num_replicas)
+        else:
+            self.num_samples = int(len(self.indices[self.task]))
+            self.total_size = self.num_samples
+            self.num_selected_samples = int(len(self.indices[self.task]))
+
+    def build_split(self, num_tasks, m):
+        targets = torch.as_tensor(self.targets, dtype=torch.long)
         if not self.varing_NM:
             # Divide classes into N% of disjoint and (100 - N)% of blurry
             class_order         = torch.randperm(len(self.classes), generator=self.generator)
@@ -45,35 +73,18 @@ class OnlineSampler(Sampler):
             print("disjoint classes: ", self.disjoint_classes)
             print("blurry classes: ", self.blurry_classes)
             # Get indices of disjoint and blurry classes
-            self.disjoint_indices   = [[] for _ in range(num_tasks)]
-            self.blurry_indices     = [[] for _ in range(num_tasks)]
-            for i in range(len(self.targets)):
-                for j in range(num_tasks):
-                    if self.targets[i] in self.disjoint_classes[j]:
-                        self.disjoint_indices[j].append(i)
-                        break
-                    elif self.targets[i] in self.blurry_classes[j]:
-                        self.blurry_indices[j].append(i)
-                        break
+            disjoint_indices    = self.split_by_class(targets, self.disjoint_classes)
+            blurry_indices      = self.split_by_class(targets, self.blurry_classes)
 
             # Randomly shuffle M% of blurry indices
-            blurred = []
-            for i in range(num_tasks):
-                blurred += self.blurry_indices[i][:len(self.blurry_indices[i]) * m // 100]
-                self.blurry_indices[i] = self.blurry_indices[i][len(self.blurry_indices[i]) * m // 100:]
-            blurred = torch.tensor(blurred)
-            blurred = blurred[torch.randperm(len(blurred), generator=self.generator)].tolist()
+            num_blurred = [len(blurry_indices[i]) * m // 100 for i in range(num_tasks)]
+            blurred = torch.cat([blurry_indices[i][:num_blurred[i]] for i in range(num_tasks)])
+            blurry_indices = [blurry_indices[i][num_blurred[i]:] for i in range(num_tasks)]
+            blurred = blurred[torch.randperm(len(blurred), generator=self.generator)]
             print("blurry indices: ", len(blurred))
             num_blurred = len(blurred) // num_tasks
             for i in range(num_tasks):
-                self.blurry_indices[i] += blurred[:num_blurred]
-                blurred = blurred[num_blurred:]
-            
-            self.indices = [[] for _ in range(num_tasks)]
-            for i in range(num_tasks):
-                print("task %d: disjoint %d, blurry %d" % (i, len(self.disjoint_indices[i]), len(self.blurry_indices[i])))
-                self.indices[i] = self.disjoint_indices[i] + self.blurry_indices[i]
-                self.indices[i] = torch.tensor(self.indices[i])[torch.randperm(len(self.indices[i]), generator=self.generator)].tolist()
+                blurry_indices[i] = torch.cat([blurry_indices[i], blurred[i * num_blurred:(i + 1) * num_blurred]])
         else:
             # Divide classes into N% of disjoint and (100 - N)% of blurry
             class_order         = torch.randperm(len(self.classes), generator=self.generator)
@@ -91,62 +102,79 @@ class OnlineSampler(Sampler):
             print("blurry classes: ", self.blurry_classes)
             
             # Get indices of disjoint and blurry classes
-            self.disjoint_indices   = [[] for _ in range(num_tasks)]
-            self.blurry_indices     = [[] for _ in range(num_tasks)]
-            num_blurred = 0
-            for i in range(len(self.targets)):
-                for j in range(num_tasks):
-                    if self.targets[i] in self.disjoint_classes[j]:
-                        self.disjoint_indices[j].append(i)
-                        break
-                    elif self.targets[i] in self.blurry_classes[j]:
-                        self.blurry_indices[j].append(i)
-                        num_blurred += 1
-                        break
+            disjoint_indices    = self.split_by_class(targets, self.disjoint_classes)
+            blurry_indices      = self.split_by_class(targets, self.blurry_classes)
 
             # Randomly shuffle M% of blurry indices
-            blurred = []
+            num_blurred = sum(len(blurry_indices[i]) for i in range(num_tasks))
             num_blurred = num_blurred * m // 100
             num_blurred = [0] + torch.randint(0, num_blurred, (num_tasks-1,), generator=self.generator).sort().values.tolist() + [num_blurred]
 
-            for i in range(num_tasks):
-                blurred += self.blurry_indices[i][:num_blurred[i + 1] - num_blurred[i]]
-                self.blurry_indices[i] = self.blurry_indices[i][num_blurred[i + 1] - num_blurred[i]:]
-            blurred = torch.tensor(blurred)
-            blurred = blurred[torch.randperm(len(blurred), generator=self.generator)].tolist()
+            blurred = torch.cat([blurry_indices[i][:num_blurred[i + 1] - num_blurred[i]] for i in range(num_tasks)])
+            blurry_indices = [blurry_indices[i][num_blurred[i + 1] - num_blurred[i]:] for i in range(num_tasks)]
+            blurred = blurred[torch.randperm(len(blurred), generator=self.generator)]
             print("blurry indices: ", len(blurred))
-            # num_blurred = len(blurred) // num_tasks
+            offset = 0
             for i in range(num_tasks):
-                self.blurry_indices[i] += blurred[:num_blurred[i + 1] - num_blurred[i]]
-                blurred = blurred[num_blurred[i + 1] - num_blurred[i]:]
-            
-            self.indices = [[] for _ in range(num_tasks)]
-            for i in range(num_tasks):
-                print("task %d: disjoint %d, blurry %d" % (i, len(self.disjoint_indices[i]), len(self.blurry_indices[i])))
-                self.indices[i] = self.disjoint_indices[i] + self.blurry_indices[i]
-                self.indices[i] = torch.tensor(self.indices[i])[torch.randperm(len(self.indices[i]), generator=self.generator)].tolist()
+                blurry_indices[i] = torch.cat([blurry_indices[i], blurred[offset:offset + num_blurred[i + 1] - num_blurred[i]]])
+                offset += num_blurred[i + 1] - num_blurred[i]
 
-        if self.distributed:
-            self.num_samples = int(len(self.indices[self.task]) // self.num_replicas)
-            self.total_size = self.num_samples * self.num_replicas  
-            self.num_selected_samples = int(len(self.indices[self.task]) // self.num_replicas)
-        else:
-            self.num_samples = int(len(self.indices[self.task]))
-            self.total_size = self.num_samples
-            self.num_selected_samples = int(len(self.indices[self.task]))
+        indices = []
+        for i in range(num_tasks):
+            print("task %d: disjoint %d, blurry %d" % (i, len(disjoint_indices[i]), len(blurry_indices[i])))
+            task_indices = torch.cat([disjoint_indices[i], blurry_indices[i]])
+            indices.append(task_indices[torch.randperm(len(task_indices), generator=self.generator)].numpy())
+        return indices
+
+    def split_by_class(self, targets, class_groups):
+        # Class-to-task lookup table, -1 for classes that belong to no group
+        lookup = torch.full((len(self.classes),), -1, dtype=torch.long)
+        for j, group in enumerate(class_groups):
+            lookup[torch.as_tensor(group, dtype=torch.long)] = j
+        task_of = lookup[targets]
+        return [torch.nonzero(task_of == j).flatten() for j in range(len(class_groups))]
+
+    def load_split(self, num_tasks):
+        if self.cache_path is None:
+            return None
+        if not (os.path.exists(self.cache_path + "_indices.npy") and os.path.exists(self.cache_path + "_offsets.npy")):
+            return None
+        offsets = np.load(self.cache_path + "_offsets.npy")
+        if len(offsets) != num_tasks + 1:
+            return None
+        indices = np.load(self.cache_path + "_indices.npy", mmap_mode='r')
+        print(f"Loaded task split from {self.cache_path}")
+        return [indices[offsets[i]:offsets[i + 1]] for i in range(num_tasks)]
+
+    def save_split(self):
+        if self.cache_path is None:
+            return
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        offsets = np.cumsum([0] + [len(indices) for indices in self.indices])
+        # Write to a private file and rename, so ranks racing on the same split never read a partial file.
+        # The offsets are published first since a split is only considered cached once the indices exist.
+        for suffix, array in (("_offsets.npy", offsets), ("_indices.npy", np.concatenate(self.indices))):
+            tmp_path = f"{self.cache_path}{suffix}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array.astype(np.int64))
+            os.replace(tmp_path, self.cache_path + suffix)
 
     def __iter__(self):
         if self.distributed:
             # subsample
             indices = self.indices[self.task][self.rank:self.total_size:self.num_replicas]
             assert len(indices) == self.num_samples
-            return iter(indices[:self.num_selected_samples])
+            return iter(indices[:self.num_selected_samples].tolist())
         else:
-            return iter(self.indices[self.task])
+            return iter(self.indices[self.task].tolist())
 
     def __len__(self):
         return self.num_selected_samples
 
+    def stream_size(self):
+        # Number of samples this rank goes through over all the tasks
+        return sum(len(indices) // self.num_replicas for indices in self.indices)
+
     def set_task(self, cur_iter):
 
         if cur_iter >= len(self.indices) or cur_iter < 0:
@@ -165,15 +193,35 @@ class OnlineSampler(Sampler):
     def get_task(self, cur_iter):
         indices = self.indices[cur_iter][self.rank:self.total_size:self.num_replicas]
         assert len(indices) == self.num_samples
-        return indices[:self.num_selected_samples]
+        return indices[:self.num_selected_samples].tolist()
+
+class ExposedIndex:
+    def __init__(self, targets) -> None:
+        """Test indices of the exposed classes, in dataset order as the sampler always had them.
+        An exposed-class lookup table over the targets turns an update into one vectorized pass
+        instead of a Python loop over the test set, and updates only happen when the exposed set changes.
+        """
+        self.targets = np.asarray(targets, dtype=np.int64)
+        self.lookup = np.zeros(int(self.targets.max()) + 1 if len(self.targets) else 0, dtype=bool)
+        self.exposed = []
+        self.indices = np.empty(0, dtype=np.int64)
+
+    def update(self, exposed_class):
+        if list(exposed_class) == self.exposed:
+            return self.indices
+        self.exposed = list(exposed_class)
+        self.lookup[:] = False
+        classes = np.asarray([cls for cls in self.exposed if 0 <= cls < len(self.lookup)], dtype=np.int64)
+        self.lookup[classes] = True
+        # A new array on every change, indices handed out before stay as they were
+        self.indices = np.flatnonzero(self.lookup[self.targets])
+        return self.indices
+
 
 class OnlineTestSampler(Sampler):
     def __init__(self, data_source: Optional[Sized], exposed_class, num_replicas=None, rank=None) -> None:
-        self.data_source    = data_source
-        self.classes    = self.data_source.classes
-        self.targets    = self.data_source.targets
-        self.exposed_class  = exposed_class
-        self.indices    = [i for i in range(self.data_source.__len__()) if self.targets[i] in self.exposed_class]
+        self.classes    = data_source.classes
+        self.exposed_index  = ExposedIndex(data_source.targets)
 
         if num_replicas is not None:
             if not dist.is_available():
@@ -187,7 +235,12 @@ class OnlineTestSampler(Sampler):
         self.distributed = num_replicas is not None and rank is not None
         self.num_replicas = num_replicas if num_replicas is not None else 1
         self.rank = rank if rank is not None else 0
+        self.set_exposed(exposed_class)
 
+    def set_exposed(self, exposed_class):
+        # Extends the sampled set with the classes exposed since the last call
+        self.indices = self.exposed_index.update(exposed_class)
+        self.exposed_class = self.exposed_index.exposed
         if self.distributed:
             self.num_samples = int(len(self.indices) // self.num_replicas)
             self.total_size = self.num_samples * self.num_replicas  
@@ -197,14 +250,18 @@ class OnlineTestSampler(Sampler):
             self.total_size = self.num_samples
             self.num_selected_samples = int(len(self.indices))
 
-    def __iter__(self):
+    def selected(self):
+        # Indices of this rank as an array
         if self.distributed:
             # subsample
             indices = self.indices[self.rank:self.total_size:self.num_replicas]
             assert len(indices) == self.num_samples
-            return iter(indices[:self.num_selected_samples])
+            return indices[:self.num_selected_samples]
         else:
-            return iter(self.indices)
+            return self.indices.copy()
+
+    def __iter__(self):
+        return iter(self.selected().tolist())
 
     def __len__(self):
-        return self.num_selected_samples
\ No newline at end of file
+        return self.num_selected_samples
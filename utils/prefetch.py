@@ -0,0 +1,112 @@
+import random
+from collections import deque
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from utils.batch_augment import transform_batch
+
+
+def prefetch_worker(worker_id, seed, images, decode, transform, requests, results):
+    # Workers fork with the RNG state of the trainer, reseed them so their augmentations differ
+    torch.set_num_threads(1)
+    random.seed(seed + worker_id)
+    np.random.seed((seed + worker_id) % 2 ** 32)
+    torch.manual_seed(seed + worker_id)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        batch_id, payload = request
+        if images is None:
+            batch = torch.from_numpy(np.stack([decode(data) for data in payload]).transpose(0, 3, 1, 2).copy())
+        else:
+            batch = torch.index_select(images, 0, torch.from_numpy(payload))
+        results.put((batch_id, transform_batch(batch, transform)))
+
+
+class ReplayPrefetcher:
+    def __init__(self, storage, transform, num_workers=2, depth=2) -> None:
+        """Assembles and augments the next `depth` replay batches in worker processes while the current step trains.
+        The trainer draws the indices and records the slot versions when a batch is requested, the workers
+        read the images from the storage through shared memory (or get the encoded bytes) and augment them.
+        When a batch is taken, samples whose slot was rewritten since the request are gathered again,
+        so a prefetched batch always holds the current content of its slots, like a synchronous gather would.
+        """
+        self.storage = storage
+        self.transform = transform
+        self.num_workers = num_workers
+        self.depth = depth
+        self.images = None
+        self.workers = []
+        self.pending = deque()
+        self.ready = {}
+        self.next_id = 0
+
+    def start(self):
+        if self.storage.capacity is not None:
+            # Allocate the whole capacity up front, growing the storage would mean restarting the workers
+            self.storage.reserve(self.storage.capacity, self.storage.shape)
+        self.images = self.storage.share()
+        decode = self.storage.decode if self.images is None else None
+        # Forked workers inherit the storage mapping and the transform without pickling them
+        ctx = mp.get_context("fork")
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        seed = torch.initial_seed()
+        for worker_id in range(self.num_workers):
+            worker = ctx.Process(target=prefetch_worker, daemon=True,
+                                 args=(worker_id, seed, self.images, decode, self.transform, self.requests, self.results))
+            worker.start()
+            self.workers.append(worker)
+
+    def close(self):
+        self.flush()
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def flush(self):
+        while self.pending:
+            self.wait(self.pending.popleft()[0])
+
+    def wait(self, batch_id):
+        while batch_id not in self.ready:
+            done_id, images = self.results.get()
+            self.ready[done_id] = images
+        return self.ready.pop(batch_id)
+
+    def request(self, batch_size, num_stored):
+        indices = np.random.choice(range(num_stored), size=batch_size, replace=False)
+        if self.images is None:
+            payload = [self.storage.encoded[idx] for idx in indices.tolist()]
+        else:
+            payload = indices
+        self.pending.append((self.next_id, indices, self.storage.labels[indices].copy(), self.storage.version[indices].copy()))
+        self.requests.put((self.next_id, payload))
+        self.next_id += 1
+
+    def get_batch(self, batch_size, num_stored):
+        # Returns the augmented images, the slots and the labels of the next replay batch
+        if not self.workers:
+            self.start()
+        elif self.images is not None and self.storage.images is not self.images:
+            # The storage grew into a new tensor the workers do not see
+            self.close()
+            self.start()
+        if self.pending and len(self.pending[0][1]) != batch_size:
+            self.flush()
+        while len(self.pending) < self.depth:
+            self.request(batch_size, num_stored)
+        batch_id, indices, labels, version = self.pending.popleft()
+        self.request(batch_size, num_stored)
+        images = self.wait(batch_id)
+        stale = np.flatnonzero(self.storage.version[indices] != version)
+        if len(stale) > 0:
+            fresh, fresh_labels = self.storage.read(indices[stale])
+            images[torch.from_numpy(stale)] = transform_batch(fresh, self.transform)
+            labels[stale] = fresh_labels
+        return images, indices, labels
@@ -0,0 +1,138 @@
+import contextlib
+import json
+import resource
+import time
+from collections import defaultdict
+
+import torch
+
+
+# What phase() hands out when profiling is off
+NULL_PHASE = contextlib.nullcontext()
+
+
+class Phase:
+    def __init__(self, profiler, name) -> None:
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.enter(self.name)
+
+    def __exit__(self, *exc):
+        self.profiler.exit()
+
+
+class PhaseProfiler:
+    def __init__(self, enabled=False, device=None, trace_path=None) -> None:
+        """Wall time per phase of the online loop, with samples/s and peak memory per task.
+        Phases nest and each one is charged its self time, the time with no inner phase open, so the
+        phases of a task add up to the task. On CUDA the device is synchronized when a phase closes,
+        which charges the kernels queued in a phase to it. With `trace_path` every phase is also kept
+        as a Chrome trace event (chrome://tracing, Perfetto) and written out by close().
+        Disabled, phase() and iterate() hand back a shared no-op context and the iterable itself,
+        and only the sample count behind eta() is kept.
+        """
+        self.enabled = enabled
+        self.device = torch.device(device) if device is not None else None
+        self.sync = enabled and self.device is not None and self.device.type == "cuda"
+        self.trace_path = trace_path if enabled else None
+        self.trace = []
+        self.start = time.perf_counter()
+        self.samples = 0
+        self.tasks = []
+        self.task = None
+        self.stack = []
+        self.mark = 0.0
+
+    def phase(self, name):
+        return Phase(self, name) if self.enabled else NULL_PHASE
+
+    def iterate(self, iterable, name):
+        # Charges the time spent waiting for each item of `iterable` to the phase `name`
+        if not self.enabled:
+            return iterable
+        return self.timed_iter(iterable, name)
+
+    def timed_iter(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            self.charge(now)
+        self.stack.append((name, now))
+        self.mark = now
+
+    def exit(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        now = time.perf_counter()
+        self.charge(now)
+        name, begin = self.stack.pop()
+        if self.task is not None:
+            self.task["calls"][name] += 1
+        if self.trace_path is not None:
+            self.trace.append({"name": name, "ph": "X", "ts": (begin - self.start) * 1e6, "dur": (now - begin) * 1e6,
+                               "pid": 0, "tid": 0})
+        self.mark = now
+
+    def charge(self, now):
+        if self.task is not None:
+            self.task["time"][self.stack[-1][0]] += now - self.mark
+
+    def begin_task(self, task_id):
+        self.task = {"id": task_id, "begin": time.perf_counter(), "samples": 0,
+                     "time": defaultdict(float), "calls": defaultdict(int)}
+        if self.enabled and self.device is not None and self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def end_task(self):
+        task = self.task
+        task["wall"] = time.perf_counter() - task["begin"]
+        if self.device is not None and self.device.type == "cuda":
+            task["peak_memory"] = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+        else:
+            # The peak resident size of the process so far, the OS does not reset it per task
+            task["peak_memory"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+        self.tasks.append(task)
+        self.task = None
+        return task
+
+    def add_samples(self, n):
+        self.samples += n
+        if self.task is not None:
+            self.task["samples"] += n
+
+    def eta(self, total_samples):
+        # Seconds left at the average rate of the run so far, evaluations included
+        if self.samples == 0:
+            return 0.0
+        return (time.perf_counter() - self.start) * (total_samples - self.samples) / self.samples
+
+    def summary(self):
+        # Per task seconds and share of the task for each phase, then samples/s and peak memory
+        names = list(dict.fromkeys(name for task in self.tasks for name in task["time"]))
+        header = f"{'phase':<16}" + "".join(f" | {'task ' + str(task['id']):>15}" for task in self.tasks)
+        lines = [header, "-" * len(header)]
+        for name in names + ["other"]:
+            cells = []
+            for task in self.tasks:
+                seconds = task["time"].get(name, 0.0) if name != "other" else task["wall"] - sum(task["time"].values())
+                cells.append(f" | {seconds:>8.2f}s {100 * seconds / max(task['wall'], 1e-9):>4.0f}%")
+            lines.append(f"{name:<16}" + "".join(cells))
+        lines.append(f"{'samples/s':<16}" + "".join(f" | {task['samples'] / max(task['wall'], 1e-9):>15.1f}" for task in self.tasks))
+        lines.append(f"{'peak memory MB':<16}" + "".join(f" | {task['peak_memory']:>15.0f}" for task in self.tasks))
+        return "\n".join(lines)
+
+    def close(self):
+        if self.trace_path is not None:
+            with open(self.trace_path, "w") as f:
+                json.dump({"traceEvents": self.trace, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,29 @@
+import importlib
+
+
+class Registry:
+    def __init__(self, kind, entries=None) -> None:
+        """Names mapped to "module:attribute" strings, imported the first time the name is asked for.
+        Declaring everything here costs nothing at startup, a run only imports what it selects.
+        """
+        self.kind = kind
+        self.entries = dict(entries or {})
+        self.loaded = {}
+
+    def register(self, name, target):
+        self.entries[name] = target
+        self.loaded.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def get(self, name):
+        if name not in self.entries:
+            raise NotImplementedError(f"Unknown {self.kind} {name}, choose from {list(self.entries)}")
+        if name not in self.loaded:
+            module, attribute = self.entries[name].split(":")
+            self.loaded[name] = getattr(importlib.import_module(module), attribute)
+        return self.loaded[name]
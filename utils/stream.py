@@ -0,0 +1,135 @@
+import json
+import os
+import queue
+import shutil
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+
+class PackedStream:
+    def __init__(self, dataset, sampler, batch_size, stream_dir, depth=2, n_worker=0) -> None:
+        """The training stream of `sampler`, every task packed once into a file in the exact sampler order.
+        Images are kept as uint8, the ToTensor output of the train dataset times 255, back to back in `task_<t>.bin`.
+        Iterating reads the current task of the sampler front to back and yields the batches a DataLoader
+        over the sampler would, while a thread reads the next `depth` batches ahead.
+        Reads are plain sequential file reads, which release the GIL and let the kernel read ahead too.
+        """
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.depth = depth
+        image, _ = dataset[0]
+        shape = tuple(image.shape)
+        counts = [len(indices) // sampler.num_replicas for indices in sampler.indices]
+        rank = f"_rank{sampler.rank}of{sampler.num_replicas}" if sampler.distributed else ""
+        self.path = os.path.join(stream_dir, f"{sampler.split_name}_{'x'.join(map(str, shape))}{rank}")
+        index = self.load_index()
+        if index is not None and (tuple(index["shape"]) != shape or index["counts"] != counts):
+            # Made from another dataset or split under the same name, packed again
+            print(f"Packed stream {self.path} does not match the dataset, packing it again")
+            shutil.rmtree(self.path, ignore_errors=True)
+            index = None
+        if index is None:
+            self.materialize(dataset, n_worker)
+            index = self.load_index()
+        self.shape = tuple(index["shape"])
+        self.counts = index["counts"]
+        self.labels = [np.load(os.path.join(self.path, f"task_{task}_labels.npy")) for task in range(len(self.counts))]
+
+    def load_index(self):
+        if not os.path.exists(os.path.join(self.path, "index.json")):
+            return None
+        with open(os.path.join(self.path, "index.json"), "r") as f:
+            return json.load(f)
+
+    def materialize(self, dataset, n_worker):
+        # Written to a private directory and renamed, the same as the other caches
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        current = self.sampler.task
+        shape, counts = None, []
+        try:
+            for task in range(len(self.sampler.indices)):
+                self.sampler.set_task(task)
+                order = list(iter(self.sampler))
+                labels = np.empty(len(order), dtype=np.int64)
+                begin = 0
+                with open(os.path.join(tmp_path, f"task_{task}.bin"), "wb") as f:
+                    for x, y in DataLoader(dataset, batch_size=256, sampler=order, num_workers=n_worker):
+                        packed = x.mul(255).round_().to(torch.uint8)
+                        if not torch.equal(packed.float().div_(255), x):
+                            raise ValueError("The stream is packed as uint8, the train dataset has to hand out ToTensor images")
+                        shape = tuple(x.shape[1:])
+                        f.write(packed.numpy().tobytes())
+                        labels[begin:begin + len(y)] = y.numpy()
+                        begin += len(y)
+                np.save(os.path.join(tmp_path, f"task_{task}_labels.npy"), labels)
+                counts.append(len(order))
+        except BaseException:
+            # A failed packing leaves nothing behind
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        finally:
+            self.sampler.set_task(current)
+        # The index is the last file, a directory without it is not a finished stream
+        with open(os.path.join(tmp_path, "index.json"), "w") as f:
+            json.dump({"shape": shape, "counts": counts}, f)
+        try:
+            os.replace(tmp_path, self.path)
+        except OSError:
+            # Another process finished the same stream first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def read_ahead(self, task, batches, stop):
+        # Producer thread, puts the batches of `task` in order and None after the last one,
+        # or the error it ran into so that the training loop raises it instead of waiting forever
+        try:
+            count = self.counts[task]
+            with open(os.path.join(self.path, f"task_{task}.bin"), "rb", buffering=0) as f:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                for begin in range(0, count, self.batch_size):
+                    end = min(begin + self.batch_size, count)
+                    packed = torch.empty((end - begin, *self.shape), dtype=torch.uint8)
+                    buffer = memoryview(packed.numpy()).cast("B")
+                    read = 0
+                    while read < len(buffer):
+                        n = f.readinto(buffer[read:])
+                        if not n:
+                            raise EOFError(f"{f.name} is shorter than its index")
+                        read += n
+                    batches.put((packed.float().div_(255), torch.from_numpy(self.labels[task][begin:end])))
+                    if stop.is_set():
+                        return
+        except Exception as error:
+            batches.put(error)
+            return
+        batches.put(None)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=max(self.depth, 1))
+        stop = threading.Event()
+        reader = threading.Thread(target=self.read_ahead, args=(self.sampler.task, batches, stop), daemon=True)
+        reader.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # The loop may stop early (--debug), unblock the reader so it can end
+            stop.set()
+            while reader.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            reader.join()
+
+    def __len__(self):
+        return (self.counts[self.sampler.task] + self.batch_size - 1) // self.batch_size
@@ -1,24 +1,24 @@
-import torch_optimizer
 from easydict import EasyDict as edict
 from torch import optim
 
-from models import mnist, cifar, imagenet
-from timm.models.registry import register_model
-from timm.models.vision_transformer import _cfg, _create_vision_transformer, default_cfgs
-from timm.models import create_model
-from models.vit import _create_vision_transformer
-from models.L2P import L2P
-
-@register_model
-def vit_base_patch16_224(pretrained=False, **kwargs):
-    """ ViT-Base model (ViT-B/32) from original paper (https://arxiv.org/abs/2010.11929).
-    ImageNet-21k weights @ 224x224, source https://github.com/google-research/vision_transformer.
-    NOTE: this model has valid 21k classifier head and no representation (pre-logits) layer
-    """
-    model_kwargs = dict(
-        patch_size=16, embed_dim=768, depth=12, num_heads=12, **kwargs)
-    model = _create_vision_transformer('vit_base_patch16_224', pretrained=pretrained, **model_kwargs)
-    return model
+from utils.registry import Registry
+
+# Model classes by family, imported when selected. Only the ViT ones import timm
+MODELS = Registry("model", {
+    "mlp": "models.mnist:MLP",
+    "cifar_resnet": "models.cifar:ResNet",
+    "imagenet_resnet": "models.imagenet:ResNet",
+    "vit": "utils.train_utils:create_vit",
+    "L2P": "models.L2P:L2P",
+})
+
+
+def create_vit(num_classes):
+    # Importing models.vit registers its ViT-B/16 with timm in place of timm's own
+    import models.vit
+    from timm.models import create_model
+    return create_model("vit_base_patch16_224", pretrained=True, num_classes=num_classes,
+                        drop_rate=0., drop_path_rate=0., drop_block_rate=None)
 
 def cycle(iterable):
     # iterate with shuffling
@@ -26,22 +26,22 @@ def cycle(iterable):
         for i in iterable:
             yield i
 
-def select_optimizer(opt_name, lr, model):
+def select_optimizer(opt_name, lr, model, is_vit=False):
+    # The classifier gets a param group of its own, it is the head of timm's ViTs and the fc of the other models.
+    # Matched by module name, the fc1 and fc2 of the ViT blocks stay with the backbone
+    head = 'head' if is_vit else 'fc'
+    params = [param for name, param in model.named_parameters() if head not in name.split('.')]
+    fc_params = [param for name, param in model.named_parameters() if head in name.split('.')]
 
     if opt_name == "adam":
         # print("opt_name: adam")
-        params = [param for name, param in model.named_parameters() if 'fc' not in name]
-        fc_params = [param for name, param in model.named_parameters() if 'fc' in name]
         opt = optim.Adam(params, lr=lr, weight_decay=0)
         opt.add_param_group({'params': fc_params})
     elif opt_name == "radam":
-        params = [param for name, param in model.named_parameters() if 'fc' not in name]
-        fc_params = [param for name, param in model.named_parameters() if 'fc' in name]
+        import torch_optimizer
         opt = torch_optimizer.RAdam(params, lr=lr, weight_decay=0.00001)
         opt.add_param_group({'params': fc_params})
     elif opt_name == "sgd":
-        params = [param for name, param in model.named_parameters() if 'fc' not in name]
-        fc_params = [param for name, param in model.named_parameters() if 'fc' in name]
         opt = optim.SGD(
             params, lr=lr, momentum=0.9, nesterov=True, weight_decay=1e-4
         )
@@ -58,6 +58,7 @@ def select_optimizer_with_extern_params(opt_name, lr, model, extern_param=None):
         opt.add_param_group({'params': model.fc.parameters()})
     elif opt_name == "radam":
         params = [param for name, param in extern_param.named_parameters() if 'fc' not in name]
+        import torch_optimizer
         opt = torch_optimizer.RAdam(params, lr=lr, weight_decay=0.00001)
         opt.add_param_group({'params': model.fc.parameters()})
     elif opt_name == "sgd":
@@ -105,13 +106,16 @@ def select_model(model_name, dataset, num_classes=None):
 
 #! cifar and imageNet --> ViT model 추가!!
     if "mnist" in dataset:
-        model_class = getattr(mnist, "MLP")
+        family = "mlp"
     elif "cifar" in dataset:
-        model_class = getattr(cifar, "ResNet")
+        family = "cifar_resnet"
     elif "imagenet" in dataset:
-        model_class = getattr(imagenet, "ResNet")
+        family = "imagenet_resnet"
     elif "vit" in dataset:
         pass
+    elif dataset == "synthetic":
+        # Any image size, but the MLP only takes 28x28
+        family = "mlp" if model_name.startswith("mlp") else "cifar_resnet"
     else:
         raise NotImplementedError(
             "Please select the appropriate datasets (mnist, cifar10, cifar100, imagenet)"
@@ -137,13 +141,11 @@ def select_model(model_name, dataset, num_classes=None):
         )
 
     if model_name == "vit":
-        model = create_model(
-                            "vit_base_patch16_224",pretrained=True,num_classes=num_classes,
-                            drop_rate=0.,drop_path_rate=0.,drop_block_rate=None,)
+        model = MODELS.get("vit")(num_classes)
     elif model_name == "L2P":
-        model = L2P()
+        model = MODELS.get("L2P")()
     else:
-        model = model_class(opt)
+        model = MODELS.get(family)(opt)
 
     print("[Selected Model]:", model_name )
     return model